@@ -10,11 +10,19 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import column_store as cs
 import file_utils as fu
+import gene_models as gm
+import interval_index as ii
 import utils as u
+import vcf_chunks as vcf
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
+"""Records read ahead and resolved together against a column store
+"""
+PREFETCH_SIZE = 10000
+
 def collapseGeneNames(row, indices, region, cnt):
     names = ['bin', 'name', 'chrom', 'transcriptStrand', 'txStart', 'txEnd', 
         'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'score',
@@ -93,6 +101,150 @@ def getFormatSpecificIndices(format='vcf'):
     return [chr_ind, pos_ind, ref_ind, alt_ind]
 
 
+"""Returns the in-memory interval index to use for a table, or None when
+   engine is 'mysql' and every variant is looked up with its own query.
+   engine='sweep' returns a fresh single-pass index for position-sorted
+   input; close it with closeOverlapIndex when the stage is done.
+   engine='store' answers from the local reference snapshot
+"""
+def getOverlapIndex(engine, table, chromColumn='chrom', 
+    startColumn='chromStart', endColumn='chromEnd', columns='*'):
+    if (engine == 'mysql'):
+        return None
+    elif (engine == 'index'):
+        return ii.getIndex(table, chromColumn=chromColumn, 
+            startColumn=startColumn, endColumn=endColumn, columns=columns)
+    elif (engine == 'sweep'):
+        return ii.SweepIndex(table, chromColumn=chromColumn, 
+            startColumn=startColumn, endColumn=endColumn, columns=columns)
+    elif (engine == 'store'):
+        return cs.StoreIndex(cs.getStore(), table, columns=columns)
+    else:
+        raise ValueError(f"Unknown annotation engine '{engine}'")
+
+
+"""Gene models of a table for the given engine ('mysql' queries refGene
+   once per variant and returns None)
+"""
+def getGeneModels(engine, table='refGene'):
+    if (engine == 'mysql'):
+        return None
+    elif (engine == 'index' or engine == 'sweep'):
+        return gm.getGeneModels(table)
+    elif (engine == 'store'):
+        return gm.getGeneModels(table, store=cs.getStore())
+    else:
+        raise ValueError(f"Unknown annotation engine '{engine}'")
+
+
+"""Releases the scan held by a sweep index
+"""
+def closeOverlapIndex(index):
+    if isinstance(index, ii.SweepIndex):
+        index.close()
+
+
+"""Passes lines through; with a column store index, reads them ahead in
+   chunks and resolves the positions of each chunk in one vectorized call
+"""
+def prefetchOverlaps(lines, index, format='vcf', sep='\t', 
+    size=PREFETCH_SIZE):
+    if not isinstance(index, cs.StoreIndex):
+        for line in lines:
+            yield line
+        return
+
+    for chunk in readLineChunks(lines, size):
+        index.prefetch(vcf.fromLines(chunk))
+        for line in chunk:
+            yield line
+
+
+"""Per-variant lookup statements of the stages. The statements are also
+   the lookup cache keys, so the stages and the async lookups must build
+   them identically
+"""
+def dbSnpSql(chr, pos, ref, varclass='SNV'):
+    return 'select * from dbSNP where CHR="' + str(chr) + \
+        '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
+        '" OR REF ="' + str(getComplementary(ref)) + '" )  AND INFO = "' + \
+        varclass + '" ;'
+
+
+"""The three bigRefGene statements, tried in order until one has rows
+"""
+def bigRefGeneSqls(chr, pos, ref, alt):
+    compRef = getComplementary(ref)
+    compAlt = getComplementary(alt)
+
+    sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
+        str(chr) + '" AND start = ' + str(pos) + \
+        ' AND ((haplotypeReference="' + str(ref) + \
+        '" AND haplotypeAlternate ="' + str(alt) + \
+        '") OR (haplotypeReference="' + str(compRef) + \
+        '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
+
+    sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
+        str(chr) + '" AND start = ' + str(pos) + ';'
+
+    sql3 = 'select * from chrom_pos_unequal where CHR="' + \
+        str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
+        str(pos) + ' <= end ;'
+    return (sql1, sql2, sql3)
+
+
+def genesSql(table, chr, pos, promoter_offset):
+    return 'select * from ' + table + ' where chrom="' + \
+        str(chr) + '" AND (txStart - ' + str(promoter_offset) + \
+        ') <= ' + str(pos) + ' AND ' + str(pos) + \
+        ' <= (txEnd + ' + str(promoter_offset) + ');'
+
+
+def cpgIslandSql(chr, pos):
+    return 'select chrom, chromStart, chromEnd, name from ' + \
+        'cpgIslandExt where chrom="' + str(chr) + \
+        '" AND (chromStart <= ' + str(pos) + \
+        ' AND ' + str(pos) + ' <= chromEnd);'
+
+
+def tfbsSql(chrIndex, pos):
+    return 'select chrom, chromStart, chromEnd, name ' + \
+        'from tfbsConsSites' + chrIndex + \
+        ' where  chromStart <= ' + str(pos) + ' AND ' + \
+        str(pos) + ' <= chromEnd;'
+
+
+def gwasSql(table, chr, pos):
+    return 'select * from ' + table + ' where chrom="' + \
+        str(chr) + '" AND chromEnd = ' + str(pos) + ';'
+
+
+def overlapSql(table, chr, pos, chromColumn='chrom', 
+    startColumn='chromStart', endColumn='chromEnd'):
+    return 'select * from ' + table + ' where ' + chromColumn + '="' + \
+        str(chr) + '" AND (' + startColumn + ' <= ' + str(pos) + \
+        ' AND ' + str(pos) + ' <= ' + endColumn + ');'
+
+
+"""Rows overlapping pos, from the index if there is one, else from MySQL
+"""
+def fetchOverlapRows(cursor, sql, index, chr, pos):
+    if index is None:
+        cursor.execute(sql)
+        return cursor.fetchall()
+    return index.query(chr, pos)
+
+
+"""First row overlapping pos (or None), like cursor.fetchone()
+"""
+def fetchOverlapRow(cursor, sql, index, chr, pos):
+    if index is None:
+        cursor.execute(sql)
+        return cursor.fetchone()
+    rows = index.query(chr, pos)
+    return rows[0] if (len(rows) > 0) else None
+
+
 def getComplementary(nuc):
     compNuc = ''
     if (str(nuc) == 'A'):
@@ -107,89 +259,230 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
+"""Reads the file in chunks of up to 'size' lines
+"""
+def readLineChunks(fh, size):
+    chunk = []
+    for line in fh:
+        chunk.append(line)
+        if (len(chunk) >= size):
+            yield chunk
+            chunk = []
+    if (len(chunk) > 0):
+        yield chunk
+
+
+"""Writes the lines produced by a stream stage to outfile
+"""
+def writeLines(lines, outfile):
     fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
+    for line in lines:
+        fh_out.write(line + '\n')
+    fh_out.close()
 
-    inds = getFormatSpecificIndices(format=format)
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+"""Formats the counters collected by a stream stage as count log lines
+"""
+def formatCountLog(counts):
+    if (counts['log'] == 'dbSNP'):
+        linenum = counts['records'] + 1
+        ratioInDbSnp = (counts['var_count'] / float(linenum)) * 100
+        return ["## Please notice that all Isoforms were counted",
+            "## Numbers may exceed number of variants in the annotated file",
+            f"Total: {str(linenum)}",
+            f"In dbSNP: {str(counts['var_count'])} ({str(ratioInDbSnp)}%)"]
+
+    elif (counts['log'] == 'genes'):
+        return ["Variants located:",
+            f"In interGenic {str(counts['interGenic_count'])}",
+            f"In CDS {str(counts['cds_count'])}",
+            f"In \'3 UTR {str(counts['utr3_count'])}",
+            f"In \'5 UTR {str(counts['utr5_count'])}",
+            f"In Intronic {str(counts['intronic_count'])}",
+            f"In Non_coding_intronic {str(counts['non_coding_intronic_count'])}",
+            f"In Exonic {str(counts['exonic_count'])}",
+            f"In Non_coding_exonic {str(counts['non_coding_exonic_count'])}",
+            f"In Putative Promoter Region {str(counts['promoter_count'])}"]
+
+    elif (counts['log'] == 'overlap'):
+        return [f"In {str(counts['table'])}: {str(counts['var_count'])} in " + \
+            f"{str(counts['line_count'])} variants"]
+
+    return []
+
+
+"""Writes a stage's counters to the count log; dbSNP starts a new log and
+   the other stages append to it. Gene locations are also printed
+"""
+def writeCountLog(logcountfile, counts):
+    lines = formatCountLog(counts)
+    if (logcountfile is None or len(lines) == 0):
+        return
+
+    fh_log = open(logcountfile, 'w' if (counts['log'] == 'dbSNP') else 'a')
+    for line in lines:
+        if (counts['log'] == 'genes'):
+            print(line)
+        fh_log.write(line + '\n')
+    fh_log.close()
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
+"""Adds up the counters collected by the same stage over several shards
+"""
+def mergeCounts(countsList):
+    merged = dict(countsList[0])
+    for counts in countsList[1:]:
+        for key in counts:
+            if isinstance(counts[key], int):
+                merged[key] = merged[key] + counts[key]
+    return merged
+
+
+"""Resolves a chunk of (chr, pos, ref) keys against dbSNP with one
+   set-based query per chromosome. Returns rows keyed like the keys;
+   REF is matched case-insensitively, as MySQL does
+"""
+def lookupDbSnpBatch(cursor, keys, varclass='SNV'):
+    # With a lookup cache, variants seen before are answered per key and
+    # only the rest go into the (uncached) set-based queries
+    cache = getattr(cursor, 'cache', None)
+
+    found = {}
+    if cache is not None:
+        for key in keys:
+            rows = cache.get('dbSNP|' + '|'.join(key) + '|' + varclass)
+            if rows is not None:
+                found[key] = rows
+    keys = [key for key in keys if key not in found]
+    if (len(keys) == 0):
+        return found
+    cursor = getattr(cursor, 'raw', cursor)
+
+    positions = {}
+    for (chr, pos, ref) in keys:
+        positions.setdefault(chr, set()).add(int(pos))
+
+    candidates = {}
+    for chr in positions:
+        sql = 'select POS, REF, dbSNP.* from dbSNP where CHR="' + str(chr) + \
+            '" AND POS IN (' + ','.join([str(x) for x in sorted(positions[chr])]) + \
+            ') AND INFO = "' + varclass + '" ;'
+        cursor.execute(sql)
+        for row in cursor.fetchall():
+            candidates.setdefault((chr, int(row[0])), []).append(
+                (str(row[1]).upper(), row[2:]))
+
+    for (chr, pos, ref) in keys:
+        refs = [str(ref).upper(), str(getComplementary(ref)).upper()]
+        found[(chr, pos, ref)] = [row for (r, row) in
+            candidates.get((chr, int(pos)), []) if r in refs]
+        if cache is not None:
+            cache.put('dbSNP|' + '|'.join((chr, pos, ref)) + '|' + varclass,
+                found[(chr, pos, ref)])
+    return found
+
+
+"""Annotates the fields of one record with the matching dbSNP rows
+   Returns True if the record was found in dbSNP
+"""
+def addDbSnpFields(fields, rows, varclass='SNV'):
+    fields[2] = '.'
+    rsids = []
+    mafs = []
+    if (len(rows) > 0):
+        for row in rows:
+            rsids.append(str(row[3]))
+            if (str(row[7]) != '.'):
+                mafs.append('GMAF=' + str(row[7]))
+
+        maf_str=''
+        if (len(mafs) > 0):
+            maf_str = ';' + ';'.join([str(x) for x in mafs])
+
+        if (str(fields[7]) == '.'):
+            fields[7] = 'DB' + maf_str
+        else:
+            fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
+        fields[2] = str(';'.join(rsids))
+        return True
 
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+    ## reset rsid to "." - in case there was annotation from old release of dbSNP
+    return False
 
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
 
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+    With batch_size > 0 the VCF is read in chunks of batch_size lines and
+    each chunk is resolved with lookupDbSnpBatch instead of one query per 
+    variant; the output is the same
+""" 
+def streamSnpsFromDbSnp(lines, logcountfile=None, counts=None, format='vcf',
+    varclass='SNV', sep='\t', batch_size=0):
+    if counts is None:
+        counts = {}
 
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+    var_count = 0
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+    inds = getFormatSpecificIndices(format=format)
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+    with u.db_connection(cached=True) as conn:
+        cursor = conn.cursor()
+        linenum = 1
+
+        for chunk in readLineChunks(lines, max(1, batch_size)):
+            records = []
+            for line in chunk:
+                line = line.strip()
+                if not line.startswith("#"):
+                    fields = line.split(sep)
+                    chr = fields[inds[0]].strip()
+                    if chr.startswith("chr"):
+                        chr = chr.replace('chr', '')
+
+                    pos = fields[inds[1]].strip()
+                    ref = clean_mysql_chars(fields[inds[2]]).strip()
+                    records.append((fields, (chr, pos, ref)))
+                else:
+                    records.append((line, None))
+
+            found = {}
+            if (batch_size > 0):
+                found = lookupDbSnpBatch(cursor, 
+                    [key for (fields, key) in records if key is not None], 
+                    varclass=varclass)
+
+            for (fields, key) in records:
+                if key is None:
+                    yield fields
+                    continue
+
+                (chr, pos, ref) = key
+                if (batch_size > 0):
+                    rows = found[key]
+                else:
+                    cursor.execute(dbSnpSql(chr, pos, ref, varclass))
+                    rows = cursor.fetchall()
 
-            linenum = linenum + 1
+                if addDbSnpFields(fields, rows, varclass=varclass):
+                    var_count = var_count + 1
+                yield '\t'.join([str(x) for x in fields])
 
-        else:
-            fh_out.write(line + '\n')
+                linenum = linenum + 1
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+    counts.update({'log': 'dbSNP', 'records': linenum - 1, 
+        'var_count': var_count})
+    writeCountLog(logcountfile, counts)
 
-    conn.close()
+
+"""File based dbSNP stage: reads vcf, writes vcf + tmpextout
+"""
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t', batch_size=0):
+    fh = open(vcf)
+    writeLines(streamSnpsFromDbSnp(fh, vcf + '.count.log', format=format,
+        varclass=varclass, sep=sep, batch_size=batch_size), vcf + tmpextout)
     fh.close()
-    fh_out.close()
 
 
 """NOTE: all isoforms are collapsed in one record
@@ -197,116 +490,274 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     2. chrom_pos_equal_nobase
     3. chrom_pos_unequal
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
+def streamBigRefGene(lines, logcountfile=None, counts=None, format='vcf', 
+    sep='\t'):
+    if counts is None:
+        counts = {}
 
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
+    inds = getFormatSpecificIndices(format=format)
 
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
+    with u.db_connection(cached=True) as conn:
+        cursor = conn.cursor()
+        vcf_linenum = 1
 
-            if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
+        for line in lines:
+            line = line.strip()
+            if not line.startswith("#"):
+                fields = line.split(sep)
+                chr = fields[inds[0]].strip()
+                if chr.startswith("chr"):
+                    chr = chr.replace('chr', '')
 
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
+                pos = fields[inds[1]].strip()
+                ref = clean_mysql_chars(fields[inds[2]]).strip()
+                alt = clean_mysql_chars(fields[inds[3]]).strip()
 
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+                (sql1, sql2, sql3) = bigRefGeneSqls(chr, pos, ref, alt)
 
-            if (keep_going):
-                cursor.execute(sql2)
+                keep_going = True
+                cursor.execute(sql1)
                 rows = cursor.fetchall()
 
                 if (len(rows) > 0):
                     keep_going = False
                     m = set([])
                     for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
 
                     fields[7] = fields[7] + ';' + ';'.join(m)
                     if (str(fields[7]).startswith(".;")):
                         fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
+
                     l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+                    yield l
 
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+                if (keep_going):
+                    cursor.execute(sql2)
+                    rows = cursor.fetchall()
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+                    if (len(rows) > 0):
+                        keep_going = False
+                        m = set([])
+                        for row in rows:
+                            m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
+                        fields[7] = fields[7] + ';' + ';'.join(m)
+                        if (str(fields[7]).startswith(".;")):
+                            fields[7] = str(fields[7]).replace('.;', '', 1)
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+                        l = '\t'.join([str(x) for x in fields])
+                        yield l
 
-            if (keep_going):
-                fh_out.write(line + '\n')
+                if (keep_going):
+                    cursor.execute(sql3)
+                    rows = cursor.fetchall()
 
-            vcf_linenum = vcf_linenum + 1
+                    if (len(rows) > 0):
+                        keep_going = False
+                        m = set([])
+                        for row in rows:
+                            m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
 
-        else:
-            fh_out.write(line + '\n')
+                        fields[7] = fields[7] + ';' + ';'.join(m)
+                        if (str(fields[7]).startswith(".;")):
+                            fields[7] = str(fields[7]).replace('.;', '', 1)
 
-    conn.close()
+                        l = '\t'.join([str(x) for x in fields])
+                        yield l
+
+                if (keep_going):
+                    yield line
+
+                vcf_linenum = vcf_linenum + 1
+
+            else:
+                yield line
+
+    counts.update({'log': None})
+
+
+"""File based bigRefGene stage
+"""
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
+    fh = open(vcf + tmpextin)
+    writeLines(streamBigRefGene(fh, vcf + '.count.log', format=format,
+        sep=sep), vcf + tmpextout)
     fh.close()
-    fh_out.close()
 
 
 """Get information about location in gene structures
 """
+def streamGenes(lines, logcountfile=None, counts=None, format='vcf', 
+    table='refGene', promoter_offset=500, sep='\t', engine='mysql'):
+    if counts is None:
+        counts = {}
+
+    interGenic_count = 0
+    cds_count = 0
+    utr3_count = 0
+    utr5_count = 0
+    intronic_count = 0
+    non_coding_intronic_count = 0
+    exonic_count = 0
+    non_coding_exonic_count = 0
+    promoter_count = 0
+
+    inds = getFormatSpecificIndices(format=format)
+    models = getGeneModels(engine, table)
+    cpgIndex = getOverlapIndex(engine, 'cpgIslandExt', 
+        columns='chrom, chromStart, chromEnd, name')
+    with u.db_connection(cached=True) as conn:
+        cursor = conn.cursor()
+        linenum = 1
+
+        for line in prefetchOverlaps(lines, cpgIndex, format=format, 
+            sep=sep):
+            line = line.strip()
+            if not line.startswith("#"):
+                fields = line.split(sep)
+                chr = fields[inds[0]].strip()
+
+                if not chr.startswith("chr"):
+                    chr = "chr" + chr
+
+                pos = fields[inds[1]].strip()
+                ref = clean_mysql_chars(fields[inds[2]]).strip()
+                alt = clean_mysql_chars(fields[inds[3]]).strip()
+                info_field = clean_mysql_chars(fields[7]).strip()
+                this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
+
+                if models is None:
+                    cursor.execute(genesSql(table, chr, pos, promoter_offset))
+                    transcripts = [gm.Transcript(row) for row in cursor.fetchall()]
+                else:
+                    transcripts = models.around(chr, pos, promoter_offset)
+                info = []
+
+                if (len(transcripts) > 0):
+                    cnt = 1
+                    for transcript in transcripts:
+                        row = transcript.row
+                        #count location
+                        positionType = str(u.parse_field(info_field, 
+                            'positionType', ';', '='))
+
+                        if (positionType == 'intron'):
+                            intronic_count = intronic_count + 1
+                        elif (positionType == 'non_coding_intron'):
+                            non_coding_intronic_count = non_coding_intronic_count + 1
+                        elif (positionType == 'CDS'):
+                            cds_count = cds_count + 1
+                        elif (positionType == 'non_coding_exon'):
+                            non_coding_exonic_count = non_coding_exonic_count + 1
+                        elif (positionType == 'utr5'):
+                            utr5_count = utr5_count + 1
+                        elif (positionType == 'utr3'):
+                            utr3_count = utr3_count + 1
+
+                        txtStart = transcript.txStart
+                        txtEnd = transcript.txEnd
+                        cdsStart = transcript.cdsStart
+                        cdsEnd = transcript.cdsEnd
+                        exonCount = transcript.exonCount
+                        geneSymbol = str(row[12])
+                        strand = transcript.strand
+
+                        promoter_plus = txtStart - int(promoter_offset)
+                        promoter_minus = txtEnd + int(promoter_offset)
+                        region = ""
+                        pos = int(pos)
+                        exons = []
+
+                        if (cdsStart == cdsEnd):
+                            for e in transcript.exonsAt(pos):
+                                exnum = e + 1
+                                if (strand == '-'):
+                                    exnum = exonCount - e
+                                exons.append("non_coding_exon=" + "ex" + \
+                                    str(exnum) + '/' + str(exonCount))
+                            if (len(exons) > 0):
+                                region = ";".join(exons)
+                        elif (u.isBetween(pos, cdsStart, cdsEnd)):
+                            for e in transcript.exonsAt(pos):
+                                exnum = e + 1
+                                if (strand == '-'):
+                                    exnum = exonCount - e
+                                exons.append("exon=" +  "ex" + \
+                                    str(exnum) + '/' + str(exonCount))
+                                exonic_count = exonic_count + 1
+                            if (len(exons) > 0):
+                                region = ";".join(exons)
+
+                        elif (u.isBetween(pos, promoter_plus, txtStart) and 
+                            (strand == "+")):
+                            rows = fetchOverlapRow(cursor, cpgIslandSql(chr, pos),
+                                cpgIndex, chr, pos)
+
+                            if (rows is not None):
+                                region = 'putativePromoterRegion=' + \
+                                    "".join(str(rows[3]).split())
+                                promoter_count = promoter_count + 1
+
+                        elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
+                            rows = fetchOverlapRow(cursor, cpgIslandSql(chr, pos),
+                                cpgIndex, chr, pos)
+
+                            if (rows is not None):
+                                region = 'putativePromoterRegion=' +  \
+                                    "".join(str(rows[3]).split())
+                                promoter_count = promoter_count + 1
+
+                        else:
+                            region = ''
+
+                        if (region != ''):
+                            info.append(collapseGeneNames(row=row, 
+                                indices=indicesKnownGenes, region=region, cnt=cnt))
+
+                        cnt = cnt + 1
+
+                    str_info = ";".join(info)
+                    fields[7] = fields[7] + ';' + str_info
+                    yield '\t'.join(fields)
+
+                else:
+                    fields[7] = fields[7] + ";positionType=interGenic"
+                    yield '\t'.join(fields)
+                    interGenic_count = interGenic_count + 1
+
+                linenum = linenum + 1
+
+            else:
+                yield line
+
+    closeOverlapIndex(cpgIndex)
+    counts.update({'log': 'genes', 'interGenic_count': interGenic_count,
+        'cds_count': cds_count, 'utr3_count': utr3_count, 
+        'utr5_count': utr5_count, 'intronic_count': intronic_count,
+        'non_coding_intronic_count': non_coding_intronic_count,
+        'exonic_count': exonic_count, 
+        'non_coding_exonic_count': non_coding_exonic_count,
+        'promoter_count': promoter_count})
+    writeCountLog(logcountfile, counts)
+
+
+"""File based gene structure stage
+"""
 def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t', engine='mysql'):
+    fh = open(vcf + tmpextin)
+    writeLines(streamGenes(fh, vcf + '.count.log', format=format, table=table,
+        promoter_offset=promoter_offset, sep=sep, engine=engine),
+        vcf + tmpextout)
+    fh.close()
+
+
+"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""
+def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
     tmpextin='.2', tmpextout='.3', sep='\t'):
-    
+
     basefile = vcf
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
@@ -336,10 +787,10 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
         if not line.startswith("#"):
             fields = line.split(sep)
             chr = fields[inds[0]].strip()
-
+            
             if not chr.startswith("chr"):
                 chr = "chr" + chr
-
+            
             pos = fields[inds[1]].strip()
             ref = clean_mysql_chars(fields[inds[2]]).strip()
             alt = clean_mysql_chars(fields[inds[3]]).strip()
@@ -347,41 +798,22 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
             this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
 
             sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
+                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
                 str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
                 str(promoter_offset) +');'
-
             cursor.execute(sql)
             rows = cursor.fetchall()
             info = []
-
             if (len(rows) > 0):
                 cnt = 1
                 for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
                     txtStart = int(row[4])
                     txtEnd = int(row[5])
                     cdsStart = int(row[6])
                     cdsEnd = int(row[7])
                     exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
+                    exonStarts =str(row[9].decode('utf-8'))
+                    exonEnds = str(row[10].decode('utf-8'))
                     geneSymbol = str(row[12])
                     strand = str(row[3])
 
@@ -398,216 +830,36 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                             if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
                                 exnum = e + 1
                                 if (strand == '-'):
-                                    exnum = exonCount - e
+                                    exnum =  exonCount - e
                                 exons.append("non_coding_exon=" + "ex" + \
                                     str(exnum) + '/' + str(exonCount))
+                                non_coding_exonic_count = non_coding_exonic_count + 1
                         if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
+                            region='positionType=non_coding_exon;' + ";".join(exons)
+                        else:
+                            non_coding_intronic_count = non_coding_intronic_count + 1
+                            region = 'positionType=non_coding_intron'
+
+                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
+                        cds_count = cds_count + 1
                         for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
+                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
                                 exnum = e + 1
                                 if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
+                                    exnum =  exonCount - e
+                                exons.append("exon=" + "ex" + \
                                     str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
+                                exonic_count=exonic_count+1
                         if (len(exons) > 0):
-                            region = ";".join(exons)
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                            region = 'positionType=CDS;' + ";".join(exons)
+                        else:
+                            intronic_count = intronic_count + 1
+                            region = 'positionType=CDS;' + 'intron'
 
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
-
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
-
-            linenum = linenum + 1
-
-        else:
-            fh_out.write(line + '\n')
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
-
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
-
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
-
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
-
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
-
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
-
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
-
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
-
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
-
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
-
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
-
-
-"""Method used in INDELS, where bigRefGeneTable is not applicable
-"""
-def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-            
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if (len(exons) > 0):
-                            region='positionType=non_coding_exon;' + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = 'positionType=non_coding_intron'
-
-                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
-                        if (len(exons) > 0):
-                            region = 'positionType=CDS;' + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = 'positionType=CDS;' + 'intron'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "+")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
+                    elif (u.isBetween(pos, txtStart, cdsStart) and \
+                        (cdsStart < cdsEnd) and (strand == "+")):
+                        utr5_count = utr5_count + 1
+                        region = 'positionType=utr5'
 
                     elif (u.isBetween(pos, cdsEnd, txtEnd) and \
                         (cdsStart < cdsEnd) (strand == "+")):
@@ -714,398 +966,393 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
 """Overlap with tfbsConsSites
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+def streamOverlapWithTfbsConsSites(lines, logcountfile=None, counts=None, 
+    format='vcf', table='tfbsConsSites', sep='\t', engine='mysql'):
+    if counts is None:
+        counts = {}
 
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
+    indexes = {}
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
+    with u.db_connection(cached=True) as conn:
+        cursor = conn.cursor()
 
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
+        linenum = 1
+        for line in lines:
+            line = line.strip()
+            ## not comments
+            if (line.startswith("##")):
+                yield line
 
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
+            #header line
+            elif (line.startswith('#CHROM') or line.startswith('CHROM')):
+                yield line
 
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
+            else:
+                fields = line.split(sep)
+                chr = fields[inds[0]].strip()
+                # For some reason this table has no "chr" preceeding number
+                if not chr.startswith("chr"):
+                    chr = "chr" + chr
 
-            if (chrIndex in allowed_chrom):
+                pos=fields[inds[1]].strip()
                 isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+                chrIndex=chr.replace('chr', '')
+
+                if (chrIndex in allowed_chrom):
+                    isOverlap = False
+                    sql = tfbsSql(chrIndex, pos)
+                    if chrIndex not in indexes:
+                        indexes[chrIndex] = getOverlapIndex(engine, 
+                            'tfbsConsSites' + chrIndex, chromColumn=None, 
+                            columns='chrom, chromStart, chromEnd, name')
+                    rows = fetchOverlapRows(cursor, sql, indexes[chrIndex], 
+                        chr, pos)
+                    records = []
+
+                    if (len(rows) > 0):
+                        records_count = 1
+                        line_count = line_count + 1
+
+                        for row in rows:
+                            var_count = var_count + 1
+                            t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                                str(row[1]) + '.' + str(row[2])
+                            t = t.strip()
+                            records.append('tfbsRegion' + '=' + t)
+                            records_count = records_count + 1
 
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
+                        if str(fields[7]).endswith(';'):
+                            fields[7] = fields[7] + ';'.join(records)
+                        else:
+                            fields[7] = fields[7] + ';' + ';'.join(records)
 
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
+                        yield '\t'.join(fields)
 
-                    fh_out.write('\t'.join(fields) + '\n')
+                    else: # chrom is not on the list
+                        yield line
 
                 else: # chrom is not on the list
-                    fh_out.write(line + '\n')
+                    yield line
 
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
+            linenum = linenum + 1
 
-        linenum = linenum + 1
+    for index in indexes.values():
+        closeOverlapIndex(index)
+    counts.update({'log': 'overlap', 'table': table, 
+        'var_count': var_count, 'line_count': line_count})
+    writeCountLog(logcountfile, counts)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
+"""File based version of streamOverlapWithTfbsConsSites
+"""
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
+    tmpextin='.2', tmpextout='.3', sep='\t', engine='mysql'):
+    fh = open(vcf + tmpextin)
+    writeLines(streamOverlapWithTfbsConsSites(fh, vcf + '.count.log',
+        format=format, table=table, sep=sep, engine=engine), vcf + tmpextout)
     fh.close()
-    fh_out.close()
 
 
 """Overlap with GadAll table
 """
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+def streamOverlapWithGadAll(lines, logcountfile=None, counts=None, 
+    format='vcf', table='gadAll', sep='\t', engine='mysql'):
+    if counts is None:
+        counts = {}
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    index = getOverlapIndex(engine, table, chromColumn='chromosome')
+    with u.db_connection(cached=True) as conn:
+        cursor = conn.cursor()
+        linenum = 1
+
+        for line in prefetchOverlaps(lines, index, format=format, sep=sep):
+            line = line.strip()
+            ## not comments
+            if not line.startswith("##"):
+                #header line
+                if (line.startswith('CHROM') or line.startswith('#CHROM')):
+                    yield line
+                else:
+                    fields = line.split(sep)
+                    chr = fields[inds[0]].strip()
+                    # For some reason this table has no "chr" preceeding number
+                    if chr.startswith("chr"):
+                        chr = str(chr).replace("chr", "")
+
+                    pos = fields[inds[1]].strip()
+                    isOverlap = False
+
+                    sql = overlapSql(table, chr, pos, chromColumn='chromosome')
+                    rows = fetchOverlapRows(cursor, sql, index, chr, pos)
+                    records = []
+
+                    if (len(rows) > 0):
+                        records_count = 1
+                        line_count = line_count + 1
+                        r_tmp = []
+                        for row in rows:
+                            var_count = var_count + 1
+                            if not fu.isOnTheList(r_tmp, str(row[3])):
+                                r_tmp.append(str(row[3]) )
+                                records.append(str(table) + '=' + str(row[3]))
+                                records_count = records_count + 1
+                        if str(fields[7]).endswith(';'):
+                            fields[7] = fields[7] + ';'.join(records)
+                        else:
+                            fields[7] = fields[7] + ';' + ';'.join(records)
+                        yield '\t '.join(fields)
+                    else:
+                        yield line
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
+                linenum = linenum + 1
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+                yield line
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    closeOverlapIndex(index)
+    counts.update({'log': 'overlap', 'table': table, 
+        'var_count': var_count, 'line_count': line_count})
+    writeCountLog(logcountfile, counts)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
+"""File based version of streamOverlapWithGadAll
+"""
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
+    tmpextout='.1', sep='\t', engine='mysql'):
+    fh = open(vcf + tmpextin)
+    writeLines(streamOverlapWithGadAll(fh, vcf + '.count.log', format=format,
+        table=table, sep=sep, engine=engine), vcf + tmpextout)
     fh.close()
-    fh_out.close()
 
 
 """ Overlap with gwasCatalog table """
-def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+def streamOverlapWithGwasCatalog(lines, logcountfile=None, counts=None, 
+    format='vcf', table='gwasCatalog', sep='\t'):
+    if counts is None:
+        counts = {}
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    with u.db_connection(cached=True) as conn:
+        cursor = conn.cursor()
+        linenum = 1
+
+        for line in lines:
+            line = line.strip()
+            ## not comments
+            if not line.startswith("##"):
+                #header line
+                if (line.startswith('CHROM') or line.startswith('#CHROM')):
+                    yield line
+                else:
+                    fields = line.split(sep)
+                    chr = fields[inds[0]].strip()
+                    if not chr.startswith("chr"):
+                        chr = "chr" + chr
+
+                    pos = fields[inds[1]].strip()
+                    isOverlap = False
+
+                    cursor.execute(gwasSql(table, chr, pos))
+                    rows = cursor.fetchall()
+                    records = []
+
+                    if (len(rows) > 0):
+                        line_count = line_count + 1
+                        records_count = 1
+                        for row in rows:
+                            var_count = var_count + 1
+                            records.append(str(table) + '=' + str('pubMedID') + \
+                                '=' + str(row[5]) + ',trait=' + str(row[10]))
+                            records_count = records_count + 1
+                        if str(fields[7]).endswith(';'):
+                            fields[7] = fields[7] + ';'.join(records)
+                        else:
+                            fields[7] = fields[7] + ';' + ';'.join(records)
+                        yield '\t'.join(fields)
+                    else:
+                        yield line
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
+                linenum = linenum + 1
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
+                yield line
 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+    counts.update({'log': 'overlap', 'table': table, 
+        'var_count': var_count, 'line_count': line_count})
+    writeCountLog(logcountfile, counts)
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
+"""File based version of streamOverlapWithGwasCatalog
+"""
+def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
+    tmpextin='', tmpextout='.1', sep='\t'):
+    fh = open(vcf + tmpextin)
+    writeLines(streamOverlapWithGwasCatalog(fh, vcf + '.count.log',
+        format=format, table=table, sep=sep), vcf + tmpextout)
     fh.close()
-    fh_out.close()
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+def streamOverlapWitHUGOGeneNomenclature(lines, logcountfile=None, 
+    counts=None, format='vcf', table='hugo', sep='\t', engine='mysql'):
+    if counts is None:
+        counts = {}
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
+    index = getOverlapIndex(engine, table)
+    with u.db_connection(cached=True) as conn:
+        cursor = conn.cursor()
+        linenum = 1
+
+        for line in prefetchOverlaps(lines, index, format=format, sep=sep):
+            line = line.strip()
+            ## not comments
+            if not line.startswith("##"):
+                #header line
+                if (line.startswith('CHROM') or line.startswith('#CHROM')):
+                    yield line
+                else:
+                    fields = line.split(sep)
+                    chr = fields[inds[0]].strip()
+                    if not chr.startswith("chr"):
+                        chr = "chr" + chr
+
+                    pos=fields[inds[1]].strip()
+                    isOverlap = False
+
+                    sql = overlapSql(table, chr, pos)
+                    rows = fetchOverlapRows(cursor, sql, index, chr, pos)
+                    records = []
+
+                    if (len(rows) > 0):
+                        line_count = line_count + 1
+                        records_count = 1
+                        r_tmp = []
+                        for row in rows:
+                            var_count = var_count + 1
+                            t = str(str(row[5]) + ',' + str(row[6])).strip()
+                            if not fu.isOnTheList(r_tmp, t):
+                                r_tmp.append(t)
+                                records.append('HGNC_GeneAnnotation' + '=' + t)
+                            records_count = records_count + 1
 
-                    records_str = ','.join(records).replace(';', ',')
+                        records_str = ','.join(records).replace(';', ',')
 
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
+                        if str(fields[7]).endswith(';'):
+                            fields[7] = fields[7] +records_str
+                        else:
+                            fields[7] = fields[7] + ';' + records_str
+                        yield '\t'.join(fields)
                     else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+                        yield line
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+                linenum = linenum + 1
+            else:
+                yield line
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    closeOverlapIndex(index)
+    counts.update({'log': 'overlap', 'table': table, 
+        'var_count': var_count, 'line_count': line_count})
+    writeCountLog(logcountfile, counts)
 
-    conn.close()
+
+"""File based version of streamOverlapWitHUGOGeneNomenclature
+"""
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
+    tmpextin='', tmpextout='.1', sep='\t', engine='mysql'):
+    fh = open(vcf + tmpextin)
+    writeLines(streamOverlapWitHUGOGeneNomenclature(fh, vcf + '.count.log',
+        format=format, table=table, sep=sep, engine=engine), vcf + tmpextout)
     fh.close()
-    fh_out.close()
 
 
 """Overlap with segdup regions genomicSuperDups
 """
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+def streamOverlapWithGenomicSuperDups(lines, logcountfile=None, counts=None,
+    format='vcf', table='genomicSuperDups', sep='\t', engine='mysql'):
+    if counts is None:
+        counts = {}
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
+    index = getOverlapIndex(engine, table)
+    with u.db_connection(cached=True) as conn:
+        cursor = conn.cursor()
+        linenum = 1
+
+        for line in prefetchOverlaps(lines, index, format=format, sep=sep):
+            line = line.strip()
+            ## not comments
+            if not line.startswith("##"):
+                #header line
+                if (line.startswith('CHROM') or line.startswith('#CHROM')):
+                    yield line
+                else:
+                    fields = line.split(sep)
+                    chr = fields[inds[0]].strip()
+                    if not chr.startswith("chr"):
+                        chr = "chr" + chr
+
+                    pos = fields[inds[1]].strip()
+                    isOverlap = False
+                    otherChrom = ''
+                    otherStart = ''
+                    otherEnd = ''
+                    l = str(isOverlap)
+
+                    sql = overlapSql(table, chr, pos)
+                    rows = fetchOverlapRow(cursor, sql, index, chr, pos)
+
+                    if rows is not None:
+                        line_count = line_count + 1
+                        var_count = var_count + 1
+                        isOverlap = True
+                        otherChrom = rows[7]
+                        otherStart = rows[8]
+                        otherEnd = rows[9]
+                        fields[7] = fields[7] + ';' + str(table) + '=' + \
+                            str(isOverlap) + ';' + 'otherChrom=' + \
+                            str(otherChrom) + ';otherStart=' + \
+                            str(otherStart) + ';otherEnd=' + str(otherEnd)
+
+                    yield '\t'.join(fields)
+
+                linenum = linenum + 1
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
+                yield line
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    closeOverlapIndex(index)
+    counts.update({'log': 'overlap', 'table': table, 
+        'var_count': var_count, 'line_count': line_count})
+    writeCountLog(logcountfile, counts)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
+"""File based version of streamOverlapWithGenomicSuperDups
+"""
+def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t', 
+    engine='mysql'):
+    fh = open(vcf + tmpextin)
+    writeLines(streamOverlapWithGenomicSuperDups(fh, vcf + '.count.log',
+        format=format, table=table, sep=sep, engine=engine), vcf + tmpextout)
     fh.close()
-    fh_out.close()
 
 
 """Searches Genes Databases and returns Genes/Cytobands 
@@ -1189,17 +1436,11 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
 
 """Method to find overlap with Cytoband table
 """
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+def streamOverlapWithCytoband(lines, logcountfile=None, counts=None, 
+    format='vcf', table='cytoBand', sep='\t', engine='mysql'):
+    if counts is None:
+        counts = {}
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
     colindex = 12
@@ -1212,192 +1453,195 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
         endName = 'chromEnd'
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    index = getOverlapIndex(engine, table, startColumn=startName, 
+        endColumn=endName)
+    with u.db_connection(cached=True) as conn:
+        cursor = conn.cursor()
+        linenum = 1
+
+        for line in prefetchOverlaps(lines, index, format=format, sep=sep):
+            line = line.strip()
+            ## not comments
+            if not line.startswith("##"):
+                #header line
+                if (line.startswith('CHROM') or line.startswith('#CHROM')):
+                    yield line
+                else:
+                    fields = line.split(sep)
+                    chr = fields[inds[0]].strip()
+                    if not chr.startswith("chr"):
+                        chr = "chr" + chr
+
+                    pos = fields[inds[1]].strip()
+                    isOverlap = False
+
+                    sql = overlapSql(table, chr, pos, startColumn=startName,
+                        endColumn=endName)
+                    overlapsWith = []
+                    rows = fetchOverlapRows(cursor, sql, index, chr, pos)
+
+                    if (len(rows) > 0):
+                        line_count = line_count + 1
+                        for row in rows:
+                            var_count = var_count + 1
+                            overlapsWith.append(str(row[colindex]))
+                        overlapsWith = u.dedup(overlapsWith)
+                        cytoband = ';'.join([str(x) for x in overlapsWith])
+
+                        if str(fields[7]).endswith(";"):
+                            fields[7] = fields[7] + str(table) + '=' + str(cytoband)
+                        else:
+                            fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
+                    yield '\t'.join(fields)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
+                linenum = linenum + 1
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
+                yield line
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    closeOverlapIndex(index)
+    counts.update({'log': 'overlap', 'table': table, 
+        'var_count': var_count, 'line_count': line_count})
+    writeCountLog(logcountfile, counts)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
+"""File based version of streamOverlapWithCytoband
+"""
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
+    tmpextin='', tmpextout='.1', sep='\t', engine='mysql'):
+    fh = open(vcf + tmpextin)
+    writeLines(streamOverlapWithCytoband(fh, vcf + '.count.log',
+        format=format, table=table, sep=sep, engine=engine), vcf + tmpextout)
     fh.close()
-    fh_out.close()
 
 
 """Method to find overlap with CNV tables
 """
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+def streamOverlapWithCnvDatabase(lines, logcountfile=None, counts=None, 
+    format='vcf', table='dgv_Cnv', sep='\t', engine='mysql'):
+    if counts is None:
+        counts = {}
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    index = getOverlapIndex(engine, table)
+    with u.db_connection(cached=True) as conn:
+        cursor = conn.cursor()
+        linenum = 1
+
+        for line in prefetchOverlaps(lines, index, format=format, sep=sep):
+            line = line.strip()
+            ## not comments
+            if not line.startswith("##"):
+                #header line
+                if (line.startswith('CHROM') or line.startswith('#CHROM')):
+                    yield line
+                else:
+                    fields = line.split(sep)
+                    chr = fields[inds[0]].strip()
+                    if not chr.startswith("chr"):
+                        chr = "chr" + chr
+
+                    pos = fields[inds[1]].strip()
+                    isOverlap = False
+                    sql = overlapSql(table, chr, pos)
+                    rows = fetchOverlapRow(cursor, sql, index, chr, pos)
+
+                    if rows is not None:
+                        line_count = line_count + 1
+                        var_count = var_count + 1
+                        isOverlap = True
+                        if str(fields[7]).endswith(";"):
+                            fields[7] = fields[7] + str(table) + '=' + \
+                            str(isOverlap)
+                        else:
+                            fields[7] = fields[7] + ';' + str(table) + \
+                            '='+str(isOverlap)
+                    yield '\t'.join(fields)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
+                linenum = linenum + 1
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
+                yield line
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    closeOverlapIndex(index)
+    counts.update({'log': 'overlap', 'table': table, 
+        'var_count': var_count, 'line_count': line_count})
+    writeCountLog(logcountfile, counts)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
+"""File based version of streamOverlapWithCnvDatabase
+"""
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
+    tmpextin='', tmpextout='.1', sep='\t', engine='mysql'):
+    fh = open(vcf + tmpextin)
+    writeLines(streamOverlapWithCnvDatabase(fh, vcf + '.count.log',
+        format=format, table=table, sep=sep, engine=engine), vcf + tmpextout)
     fh.close()
-    fh_out.close()
 
 
 """Method to find overlap with targetScanS tables
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+def streamOverlapWithMiRNA(lines, logcountfile=None, counts=None, 
+    format='vcf', table='targetScanS', sep='\t', engine='mysql'):
+    if counts is None:
+        counts = {}
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    index = getOverlapIndex(engine, table)
+    with u.db_connection(cached=True) as conn:
+        cursor = conn.cursor()
+        linenum = 1
+
+        for line in prefetchOverlaps(lines, index, format=format, sep=sep):
+            line = line.strip()
+            ## not comments
+            if not line.startswith("##"):
+                #header line
+                if (line.startswith('CHROM') or line.startswith('#CHROM')):
+                    yield line
+                else:
+                    fields = line.split(sep)
+                    chr = fields[inds[0]].strip()
+                    if not chr.startswith("chr"):
+                        chr = "chr" + chr
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+                    pos = fields[inds[1]].strip()
+                    sql = overlapSql(table, chr, pos)
+                    rows = fetchOverlapRow(cursor, sql, index, chr, pos)
 
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+                    if rows is not None:
+                        line_count = line_count + 1
+                        var_count = var_count + 1
+                        t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
+                            str(rows[2]) + '_' + str(rows[3])
+                        t = 'miRNAsites=' + t.strip()
+                        if str(fields[7]).endswith(";"):
+                            fields[7] = fields[7] + t
+                        else:
+                            fields[7] = fields[7] + ';' + t
+                    yield '\t'.join(fields)
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
+                linenum = linenum + 1
+            else:
+                yield line
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    closeOverlapIndex(index)
+    counts.update({'log': 'overlap', 'table': 'miRNAsites', 
+        'var_count': var_count, 'line_count': line_count})
+    writeCountLog(logcountfile, counts)
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
+"""File based version of streamOverlapWithMiRNA
+"""
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
+    tmpextin='', tmpextout='.1', sep='\t', engine='mysql'):
+    fh = open(vcf + tmpextin)
+    writeLines(streamOverlapWithMiRNA(fh, vcf + '.count.log', format=format,
+        table=table, sep=sep, engine=engine), vcf + tmpextout)
     fh.close()
-    fh_out.close()
 
 ### EOF
\ No newline at end of file
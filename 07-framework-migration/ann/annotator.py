@@ -1,10 +1,16 @@
+import asyncio
 import boto3
 from botocore.exceptions import ClientError
 import json
 import os
-import subprocess
 import sys
+import time
 
+import heartbeat as hb
+import job_scheduler as js
+import run
+import s3_transfer
+import worker_pool as wp
 
 # Get configuration
 from configparser import ConfigParser
@@ -14,6 +20,32 @@ config.read('ann_config.ini')
 # Constant variables for reuse
 REGION = config["aws"]["region_name"]
 PATH = config["file_system"]["path"]
+# Whether jobs go through the asyncio consumer (consume) rather than main_function
+ASYNC_CONSUMER = config.getboolean("sqs", "async_consumer")
+
+# Runs at most as many jobs at once as the instance has cores for, and queues
+# a few more, so that a burst of requests is not all launched at once
+scheduler = js.JobScheduler(
+    slots=int(config["scheduler"]["slots"]) or js.defaultSlots(int(config["ann"]["workers"])),
+    queue_size=int(config["scheduler"]["queue_size"]),
+    jobs_dir=PATH,
+    min_free_memory=int(config["scheduler"]["min_free_memory_mb"]) * js.MB,
+    min_free_disk=int(config["scheduler"]["min_free_disk_mb"]) * js.MB)
+
+# Jobs run in warm worker processes forked here, before any AWS client is
+# created, rather than each in a new interpreter. The asyncio consumer
+# publishes the results itself, so its workers only annotate
+if config.getboolean("scheduler", "warm_workers"):
+    workers = wp.WorkerPool(scheduler.slots,
+                            run.annotate_job if ASYNC_CONSUMER else run.run_job, warm=run.warm_up,
+                            max_jobs=int(config["scheduler"]["worker_max_jobs"]))
+    scheduler.launch = workers.launch
+
+# Keeps the message of each job hidden in SQS until the job has finished; it
+# is only deleted then, so a job this instance does not finish is run again
+heartbeat = hb.Heartbeat(timeout=int(config["sqs"]["visibility_timeout"]),
+                         interval=int(config["sqs"]["heartbeat_interval"]))
+
 
 def main_function(queue_name):
     '''
@@ -23,6 +55,7 @@ def main_function(queue_name):
     # Referred to "3. Get an existing queue by name"
     # https://aws.plainenglish.io/sqs-with-aws-sdk-for-python-boto3-on-ec2-85d343ba0a49
     sqs = boto3.resource('sqs', region_name=REGION)
+    heartbeat.start()
     # https://stackoverflow.com/questions/8884188/how-to-read-and-write-ini-file-with-python3
     while True:
         try:
@@ -35,20 +68,226 @@ def main_function(queue_name):
                 sys.exit()
             else:
                 print("Failure to retrieve the queue. ", e.response['Error']['Message'])
+        # Start the jobs waiting for a slot and those left by a stopped annotator
+        scheduler.dispatch()
+        resume_jobs()
         process_queue(queue)
 
 
+def make_job(job_id, input_file_name, user_id, on_start=None, on_exit=None):
+    '''
+    The scheduler job that runs the annotator on a job's input file in a
+    background process (run.py, or run.run_job in a warm worker). on_start
+    and on_exit replace start_job and finish_job.
+    '''
+    # Referred to 0:40' - 1:44', https://www.youtube.com/watch?v=VlfLqG_qjx0
+    cmd = f'python run.py {PATH}{job_id}/{input_file_name} {job_id} {input_file_name} {user_id}'
+    if ASYNC_CONSUMER:
+        cmd = cmd + ' annotate'
+    return js.Job(job_id, cmd,
+                  onStart=on_start or (lambda job: start_job(job_id)),
+                  onExit=on_exit or finish_job,
+                  args=(f'{PATH}{job_id}/{input_file_name}', job_id, input_file_name, user_id))
+
+
+def start_job(job_id):
+    '''
+    Called by the scheduler once a job's process is launched: persists the
+    “RUNNING” status. The message of the request stays in the queue, hidden
+    by the heartbeat, until the job has finished.
+    '''
+    # Update the “job_status” key in the annotations table to “RUNNING”
+    # A job already RUNNING was interrupted and is now resumed from its checkpoint
+    # https://stackoverflow.com/questions/34447304/example-of-update-item-in-dynamodb-boto3
+    # https://iamvickyav.medium.com/aws-dynamodb-with-python-boto3-part-4-update-attribute-delete-item-from-dynamodb-97caf4770ba
+    client = run.get_client('dynamodb')
+    try:
+        # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/LegacyConditionalParameters.KeyConditions.html
+        table = client.Table(config["dynamodb"]["table_name"])
+        response = table.update_item(Key={"job_id": job_id},
+                                    ConditionExpression= "job_status IN (:current_status, :job_st)",
+                                    UpdateExpression="SET job_status= :job_st",
+                                    ExpressionAttributeValues={':job_st': 'RUNNING', ':current_status': 'PENDING'})
+    except ClientError as e:
+        print("Failure to update the database.", e.response['Error']['Message'])
+
+
+def finish_job(job, returncode):
+    '''
+    Called by the scheduler once a job's process has exited (returncode is
+    None if it failed to launch). The message of the job is deleted from the
+    queue; a job that failed is marked “FAILED” and is not resumed. A job
+    whose results could not be uploaded is handed back to SQS to run again.
+    '''
+    if returncode == run.RETRY_EXIT_CODE:
+        retry_job(job.job_id)
+        return
+    heartbeat.delete(job.job_id)
+    # Error Handling when annotator job fails: if the return code is different
+    # from 0, there was an error
+    # Referred to 1:28'- 1:48, https://www.youtube.com/watch?v=VlfLqG_qjx0
+    if returncode == 0:
+        return
+    print(f"Annotator job {job.job_id} failed with return code {returncode}")
+    drop_job_record(job.job_id)
+    client = run.get_client('dynamodb')
+    try:
+        table = client.Table(config["dynamodb"]["table_name"])
+        response = table.update_item(Key={"job_id": job.job_id},
+                                    UpdateExpression="SET job_status= :job_st",
+                                    ExpressionAttributeValues={':job_st': 'FAILED'})
+    except ClientError as e:
+        print("Unable to update job status to 'FAILED' in the database.", e.response['Error']['Message'])
+
+
+def drop_job_record(job_id):
+    '''
+    Removes a job's job.json, so that resume_jobs does not run it again.
+    '''
+    if os.path.exists(PATH + f"{job_id}/job.json"):
+        os.remove(PATH + f"{job_id}/job.json")
+
+
+def retry_job(job_id):
+    '''
+    Gives up a job whose results could not be published: its message is made
+    visible again, so that the job is run again from it, here or elsewhere.
+    '''
+    print(f"Annotator job {job_id} could not publish its results, returning it to the queue")
+    drop_job_record(job_id)
+    heartbeat.release(job_id)
+
+
+def release_message(message):
+    '''
+    Hands a message the scheduler cannot take back to SQS, visible at once
+    to the other annotator instances.
+    '''
+    try:
+        message.change_visibility(VisibilityTimeout=0)
+    except ClientError as e:
+        print("Failure to return message to the queue", e.response['Error']['Message'])
+
+
+def read_job(job_id):
+    '''
+    The parameters and process id run.py records in a job's directory
+    (job.json) while it runs, or None if the job is not in progress here.
+    '''
+    try:
+        with open(PATH + f"{job_id}/job.json") as job_file:
+            return json.load(job_file)
+    except (OSError, ValueError):
+        return None
+
+
+def job_alive(job):
+    '''
+    Whether the run.py process of a job is still running: a process with its
+    pid that started at the same time in the same boot. After a reboot the
+    pid may belong to an unrelated process.
+    '''
+    (boot_id, start_time) = run.process_identity(job["pid"])
+    return (start_time is not None and boot_id == job.get("boot_id")
+            and start_time == job.get("start_time"))
+
+
+def resume_jobs(start=None, in_progress=()):
+    '''
+    Relaunches the jobs left in the jobs directory by an annotator that
+    stopped (crash, reboot) before they finished; run.py continues each
+    one from its checkpoint. Jobs whose process is still alive are left
+    alone, and jobs the scheduler cannot take yet are tried again later.
+    start(job_id, input_file_name, user_id, orphan=job) takes a job in
+    place of the scheduler, given its job.json; in_progress are the ids of
+    jobs it already has, e.g. ones annotated and waiting to publish their
+    results.
+    '''
+    if not os.path.exists(PATH):
+        return
+    for job_id in os.listdir(PATH):
+        if job_id in in_progress or scheduler.isRunning(job_id):
+            continue
+        job = read_job(job_id)
+        if job is None or job_alive(job):
+            continue
+        if not os.path.exists(PATH + f"{job_id}/{job['input_file_name']}"):
+            continue
+        if scheduler.capacity() == 0:
+            return
+        print(f"Resuming job {job_id}")
+        if start is not None:
+            start(job["job_id"], job["input_file_name"], job["user_id"], orphan=job)
+        else:
+            scheduler.submit(make_job(job["job_id"], job["input_file_name"], job["user_id"]))
+
+
+def download_input(message, job_id, input_file_name, s3_inputs_bucket, s3_key_input_file):
+    '''
+    Copies a job's input file from S3 to its directory. Returns False if it
+    could not; a job whose input does not exist is marked “FAILED” and its
+    message deleted.
+    '''
+    # (2) Create a parent directory to store directories that will contain job_id's
+    if not os.path.exists(PATH):
+        os.mkdir(PATH)
+
+    # (3) If it does not exist, create a directory to store job_id locally and run the subprocess
+    # https://www.geeksforgeeks.org/create-a-directory-in-python/#
+    if not os.path.exists(PATH + job_id):
+        os.mkdir(PATH + job_id)
+
+    # Get the input file S3 object and copy it to a local file
+    input_file_path = PATH + f"{job_id}/{input_file_name}"
+    try: 
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-example-download-file.html
+        # Large inputs are fetched in parallel ranged GETs (see s3_transfer.py)
+        s3_transfer.download(s3_inputs_bucket, s3_key_input_file, input_file_path)
+    except ClientError as e:
+        error_code = e.response['ResponseMetadata']['HTTPStatusCode']
+        # If input file does not exist(ie. resource not found), then update job status to 'FAILED' in the
+        # database and delete message from queue
+        if error_code == 404: 
+            client = run.get_client('dynamodb')
+            try:
+                # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/LegacyConditionalParameters.KeyConditions.html
+                table = client.Table(config["dynamodb"]["table_name"])
+                response = table.update_item(Key={"job_id": job_id},
+                                            UpdateExpression="SET job_status= :job_st",
+                                            ExpressionAttributeValues={':job_st': 'FAILED'})
+            except ClientError as e:
+                print("Unable to update job status to 'FAILED' in the database.", e.response['Error']['Message'])
+                return False
+            # If job status updated to "FAILED" is successful, delete message from queue
+            try:
+                message.delete()
+                print("Input file does not exist, message deleted from queue")
+                return False
+            except ClientError as e:
+                print("Failure to delete message from the queue", e.response['Error']['Message'])
+                return False
+        else:
+            print("Failure to download input file from S3.", )
+            return False
+    return True
+
+
 def process_queue(queue_object):
     '''
     Uses long polling to read messages from SQS queue, extracts job parameters
-    and launches the annotator. Persists job status to the database, and, if 
-    successful, deletes the processed message from the queue.
+    and submits the annotator to the scheduler. Reads no more messages than
+    the scheduler can take; the others stay in SQS for other instances.
     '''
     # (1) Attempt to read a message from the queue with long polling
     # https://github.com/boto/boto3/issues/324
-    print("Asking SQS for up to 10 messages.")
-    wait_time = int(config["sqs"]["wait_time"])
-    max_messages = int(config["sqs"]["max_messages"])
+    capacity = scheduler.capacity()
+    if capacity == 0:
+        time.sleep(1)
+        return
+    max_messages = min(int(config["sqs"]["max_messages"]), capacity)
+    # Poll briefly while jobs wait for a slot, so they start as soon as one is free
+    wait_time = int(config["sqs"]["wait_time"]) if len(scheduler.queue) == 0 else 1
+    print(f"Asking SQS for up to {max_messages} messages.")
     try:
         messages = queue_object.receive_messages(WaitTimeSeconds=wait_time,
                                                 MaxNumberOfMessages= max_messages)
@@ -66,80 +305,185 @@ def process_queue(queue_object):
             s3_inputs_bucket = msg_body["s3_inputs_bucket"]
             s3_key_input_file = msg_body["s3_key_input_file"]
   
-            # (2) Create a parent directory to store directories that will contain job_id's
-            if not os.path.exists(PATH):
-                os.mkdir(PATH)
-
-            # (3) If it does not exist, create a directory to store job_id locally and run the subprocess
-            # https://www.geeksforgeeks.org/create-a-directory-in-python/#
-            if not os.path.exists(PATH + job_id):
-                os.mkdir(PATH + job_id)
-
-            # Get the input file S3 object and copy it to a local file
-            input_file_path = PATH + f"{job_id}/{input_file_name}"
-            try: 
-                # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-example-download-file.html
-                s3 = boto3.client('s3', region_name=REGION)
-                s3.download_file(s3_inputs_bucket, s3_key_input_file, input_file_path)
-            except ClientError as e:
-                error_code = e.response['ResponseMetadata']['HTTPStatusCode']
-                # If input file does not exist(ie. resource not found), then update job status to 'FAILED' in the
-                # database and delete message from queue
-                if error_code == 404: 
-                    client = boto3.resource('dynamodb', region_name=REGION)
-                    try:
-                        # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/LegacyConditionalParameters.KeyConditions.html
-                        table = client.Table(config["dynamodb"]["table_name"])
-                        response = table.update_item(Key={"job_id": job_id},
-                                                    UpdateExpression="SET job_status= :job_st",
-                                                    ExpressionAttributeValues={':job_st': 'FAILED'})
-                    except ClientError as e:
-                        print("Unable to update job status to 'FAILED' in the database.", e.response['Error']['Message'])
-                        return
-                    # If job status updated to "FAILED" is successful, delete message from queue
-                    try:
-                        message.delete()
-                        print("Input file does not exist, message deleted from queue")
-                        return
-                    except ClientError as e:
-                        print("Failure to delete message from the queue", e.response['Error']['Message'])
-                        return
-                else:
-                    print("Failure to download input file from S3.", )
-                    return
+            # A message delivered again for a job in progress here needs no new run;
+            # it replaces the message the heartbeat keeps hidden
+            if heartbeat.isTracked(job_id) or scheduler.isRunning(job_id):
+                print(f"Job {job_id} is already running")
+                heartbeat.track(job_id, message)
+                continue
+            # A job left running by an annotator that stopped publishes its own results
+            job = read_job(job_id)
+            if job is not None and job_alive(job):
+                print(f"Job {job_id} is already running")
+                try:
+                    message.delete()
+                except ClientError as e:
+                    print("Failure to delete message from the queue", e.response['Error']['Message'])
+                continue
 
-            # (4) Launch annotation job as a background process
-            # Referred to 0:40' - 1:44', https://www.youtube.com/watch?v=VlfLqG_qjx0
-            cmd = f'python run.py {PATH}{job_id}/{input_file_name} {job_id} {input_file_name} {user_id}'
-            ann_process = subprocess.Popen(cmd, shell=True)   
-            # Error Handling when annotator job fails to launch: if the return code is different 
-            # from 0 or None, there was an error
-            # Referred to 1:28'- 1:48, https://www.youtube.com/watch?v=VlfLqG_qjx0
-            if ann_process.returncode is not None and ann_process.returncode !=0:
-                print("Annotator job failed to launch")
-                return
+            # Leave the message to other instances if this one is now full
+            if scheduler.capacity() == 0:
+                release_message(message)
+                continue
 
-            # (5) Update the “job_status” key in the annotations table to “RUNNING”
-            # https://stackoverflow.com/questions/34447304/example-of-update-item-in-dynamodb-boto3
-            # https://iamvickyav.medium.com/aws-dynamodb-with-python-boto3-part-4-update-attribute-delete-item-from-dynamodb-97caf4770ba
-            client = boto3.resource('dynamodb', region_name=REGION)
-            try:
-                # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/LegacyConditionalParameters.KeyConditions.html
-                table = client.Table(config["dynamodb"]["table_name"])
-                response = table.update_item(Key={"job_id": job_id},
-                                            ConditionExpression= "job_status = :current_status",
-                                            UpdateExpression="SET job_status= :job_st",
-                                            ExpressionAttributeValues={':job_st': 'RUNNING', ':current_status': 'PENDING'})
-            except ClientError as e:
-                print("Failure to update the database.", e.response['Error']['Message'])
+            # (2) - (3) Copy the input file to the job's directory
+            heartbeat.track(job_id, message)
+            if not download_input(message, job_id, input_file_name, s3_inputs_bucket, s3_key_input_file):
+                heartbeat.forget(job_id)
                 return
 
-            # (6) Delete message from queue, if job was successfully submitted
-            try:
-                message.delete()
-            except ClientError as e:
-                print("Failure to delete message from the queue", e.response['Error']['Message'])
+            # (4) Submit annotation job to the scheduler; it is launched as a background
+            # process when a slot is free, which updates the “job_status” key in the
+            # annotations table to “RUNNING”. The message is deleted when it has finished
+            job = make_job(job_id, input_file_name, user_id)
+            if not scheduler.submit(job):
+                heartbeat.release(job_id)
+                continue
+
+
+async def consume(queue_name):
+    '''
+    Asyncio version of main_function: one long-poll loop keeps reading
+    messages while the jobs of earlier ones download their input, annotate
+    and publish their results, so that the instance stays busy annotating
+    while the network transfers of other jobs are in flight.
+    '''
+    loop = asyncio.get_running_loop()
+    sqs = boto3.resource('sqs', region_name=REGION)
+    try:
+        queue = await loop.run_in_executor(None, lambda: sqs.get_queue_by_name(QueueName=queue_name))
+    except ClientError as e:
+        print("Failure to retrieve the queue. ", e.response['Error']['Message'])
+        sys.exit()
+    heartbeat.start()
+
+    downloads = asyncio.Semaphore(int(config["sqs"]["download_concurrency"]))
+    uploads = asyncio.Semaphore(int(config["sqs"]["upload_concurrency"]))
+    # Jobs downloading their input, or waiting for the process of an
+    # annotator that stopped to finish them, not yet in the scheduler
+    pending = set()
+    # Jobs anywhere in the pipeline, until their results are published
+    active = set()
+    tasks = set()
+
+    def start(job_id, input_file_name, user_id, message=None, s3_input=None, orphan=None):
+        pending.add(job_id)
+        active.add(job_id)
+        task = asyncio.create_task(run_pipeline(job_id, input_file_name, user_id, message, s3_input,
+                                                pending, downloads, uploads, orphan))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        task.add_done_callback(lambda task: active.discard(job_id))
+
+    reaper = asyncio.create_task(reap_jobs())
+    while True:
+        resume_jobs(start, active)
+        capacity = scheduler.capacity() - len(pending)
+        if capacity <= 0:
+            await asyncio.sleep(1)
+            continue
+        max_messages = min(int(config["sqs"]["max_messages"]), capacity)
+        wait_time = int(config["sqs"]["wait_time"])
+        print(f"Asking SQS for up to {max_messages} messages.")
+        try:
+            messages = await loop.run_in_executor(None, lambda: queue.receive_messages(
+                WaitTimeSeconds=wait_time, MaxNumberOfMessages=max_messages))
+        except ClientError as e:
+            print("Failure to retrieve messages from queue. ", e.response['Error']['Message'])
+            await asyncio.sleep(1)
+            continue
+
+        for message in messages:
+            msg_body = json.loads(json.loads(message.body)["Message"])
+            job_id = msg_body["job_id"]
+
+            # A message delivered again for a job in progress here needs no new run;
+            # it replaces the message the heartbeat keeps hidden
+            if job_id in active or heartbeat.isTracked(job_id) or scheduler.isRunning(job_id):
+                print(f"Job {job_id} is already running")
+                heartbeat.track(job_id, message)
+                continue
+            # A job left annotating by a consumer that stopped only annotates
+            # ('run.py ... annotate'); it is adopted, and its results published
+            # here once its process has exited
+            job = read_job(job_id)
+            heartbeat.track(job_id, message)
+            if job is not None and job_alive(job):
+                print(f"Job {job_id} is still annotating, adopting it")
+                start(job_id, job["input_file_name"], job["user_id"], message, orphan=job)
+                continue
+
+            start(job_id, msg_body["input_file_name"], msg_body["user_id"], message,
+                  (msg_body["s3_inputs_bucket"], msg_body["s3_key_input_file"]))
+
+
+async def run_pipeline(job_id, input_file_name, user_id, message, s3_input, pending, downloads, uploads,
+                       orphan=None):
+    '''
+    Takes one job of the asyncio consumer through its stages: downloads its
+    input (s3_input, a bucket and key; None for a resumed job) under the
+    downloads semaphore, annotates it in a scheduler slot, then uploads the
+    results and persists the “COMPLETED” status under the uploads semaphore,
+    after the slot has gone to the next job. orphan is the job.json of a job
+    left by an annotator that stopped: its process, if still alive, is
+    waited for, and a job it finished annotating goes straight to upload.
+    '''
+    loop = asyncio.get_running_loop()
+    annotated = False
+    try:
+        try:
+            if orphan is not None:
+                while job_alive(orphan):
+                    await asyncio.sleep(1)
+                job = read_job(job_id)
+                annotated = job is not None and job.get("annotated", False)
+
+            if s3_input is not None:
+                async with downloads:
+                    downloaded = await loop.run_in_executor(None, download_input, message, job_id,
+                                                            input_file_name, s3_input[0], s3_input[1])
+                if not downloaded:
+                    heartbeat.forget(job_id)
+                    return
+
+            if not annotated:
+                # Status writes and message deletes run on threads, off the loop
+                exited = loop.create_future()
+                job = make_job(job_id, input_file_name, user_id,
+                               on_start=lambda job: loop.run_in_executor(None, start_job, job_id),
+                               on_exit=lambda job, returncode: exited.set_result(returncode))
+                if not scheduler.submit(job):
+                    await loop.run_in_executor(None, heartbeat.release, job_id)
+                    return
+        finally:
+            pending.discard(job_id)
+
+        if not annotated:
+            returncode = await exited
+            if returncode != 0:
+                await loop.run_in_executor(None, finish_job, job, returncode)
                 return
+        async with uploads:
+            await loop.run_in_executor(None, run.publish_results, job_id, input_file_name, user_id)
+        # Only now is the job done with and its message deleted
+        await loop.run_in_executor(None, heartbeat.delete, job_id)
+    except Exception as e:
+        print(f"Job {job_id} failed: {e}")
+        # Another instance (or this one) runs it again from the message
+        retry_job(job_id)
+
+
+async def reap_jobs():
+    '''
+    Starts the jobs waiting for a slot once one is free and collects those
+    that have exited, for the asyncio consumer.
+    '''
+    while True:
+        scheduler.dispatch()
+        await asyncio.sleep(0.5)
 
 # Call main function
-main_function(config["sqs"]["queue_name"])
\ No newline at end of file
+if ASYNC_CONSUMER:
+    asyncio.run(consume(config["sqs"]["queue_name"]))
+else:
+    main_function(config["sqs"]["queue_name"])
\ No newline at end of file
@@ -0,0 +1,243 @@
+# async_lookups.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Asyncio client for the reference database lookups of AnnTools
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import annotate as ann
+import gene_models as gm
+import utils as u
+import vcf_chunks as vcf
+
+"""Chromosomes that have a tfbsConsSites table
+"""
+TFBS_CHROMS = [str(i) for i in range(1, 23)] + ['X', 'Y']
+
+
+"""Sends lookups to the reference database without waiting for each
+   answer: at most in_flight statements are outstanding at once, over a
+   pool of at most 'connections' connections borrowed from utils.pool.
+   The blocking driver runs in one thread per connection, so the event
+   loop only ever waits on the network. Answers go through the lookup
+   cache, and a statement already in flight is not sent twice
+"""
+class AsyncLookupClient(object):
+    def __init__(self, connections=u.DB_POOL_SIZE, in_flight=64):
+        self.connections = connections
+        self.slots = asyncio.Semaphore(in_flight)
+        self.idle = asyncio.Queue()
+        self.opened = 0
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=connections)
+
+    async def acquire(self):
+        if (self.idle.empty() and self.opened < self.connections):
+            self.opened = self.opened + 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(
+                    self.executor, u.pool.acquire)
+            except Exception as e:
+                self.opened = self.opened - 1
+                raise e
+        return await self.idle.get()
+
+    def execute(self, conn, sql):
+        cursor = u.CountingCursor(conn.cursor())
+        cursor.execute(sql)
+        rows = list(cursor.fetchall())
+        cursor.close()
+        return rows
+
+    async def send(self, sql):
+        async with self.slots:
+            conn = await self.acquire()
+            try:
+                rows = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.execute, conn, sql)
+            except Exception as e:
+                self.opened = self.opened - 1
+                u.pool.discard(conn)
+                raise e
+            self.idle.put_nowait(conn)
+        return rows
+
+    """Rows of one lookup statement
+    """
+    async def query(self, sql):
+        cache = u.lookup_cache
+        if cache is not None:
+            rows = cache.get(sql)
+            if rows is not None:
+                return rows
+        if sql in self.pending:
+            return await self.pending[sql]
+
+        self.pending[sql] = asyncio.ensure_future(self.send(sql))
+        try:
+            rows = await self.pending[sql]
+        finally:
+            del self.pending[sql]
+        if cache is not None:
+            cache.put(sql, rows)
+        return rows
+
+    """Hands the connections back to utils.pool
+    """
+    def close(self):
+        while not self.idle.empty():
+            u.pool.release(self.idle.get_nowait())
+        self.opened = 0
+        self.executor.shutdown()
+
+
+def stripChr(chr):
+    return chr.replace('chr', '') if chr.startswith('chr') else chr
+
+
+def addChr(chr):
+    return chr if chr.startswith('chr') else 'chr' + chr
+
+
+"""Whether streamGenes looks up a CpG island for pos in transcript
+"""
+def inPromoter(transcript, pos, promoter_offset):
+    if (transcript.cdsStart == transcript.cdsEnd or
+        u.isBetween(pos, transcript.cdsStart, transcript.cdsEnd)):
+        return False
+    if (u.isBetween(pos, transcript.txStart - int(promoter_offset),
+        transcript.txStart) and transcript.strand == '+'):
+        return True
+    return (u.isBetween(pos, transcript.txEnd,
+        transcript.txEnd + int(promoter_offset)) and transcript.strand == '-')
+
+
+"""Async lookups of each stage for one record (chr, pos, ref, alt). They
+   send the statements the stage would, so the stage then finds them in
+   the lookup cache; lookups the stage answers from an index are skipped
+"""
+async def lookupSnpsFromDbSnp(client, record, varclass='SNV', batch_size=0,
+    **kwargs):
+    # Batched dbSNP lookups are one set-based query per chromosome already
+    if (batch_size > 0):
+        return
+    (chr, pos, ref, alt) = record
+    await client.query(ann.dbSnpSql(stripChr(chr), pos, ref, varclass))
+
+
+async def lookupBigRefGene(client, record, **kwargs):
+    (chr, pos, ref, alt) = record
+    for sql in ann.bigRefGeneSqls(stripChr(chr), pos, ref, alt):
+        if (len(await client.query(sql)) > 0):
+            break
+
+
+async def lookupGenes(client, record, table='refGene', promoter_offset=500,
+    engine='mysql', **kwargs):
+    if (engine != 'mysql'):
+        return
+    (chr, pos, ref, alt) = record
+    chr = addChr(chr)
+    rows = await client.query(ann.genesSql(table, chr, pos, promoter_offset))
+    for row in rows:
+        if inPromoter(gm.Transcript(row), int(pos), promoter_offset):
+            await client.query(ann.cpgIslandSql(chr, int(pos)))
+            break
+
+
+async def lookupCytoband(client, record, table='cytoBand', engine='mysql',
+    **kwargs):
+    if (engine != 'mysql'):
+        return
+    (chr, pos, ref, alt) = record
+    if (table == 'cytoBand'):
+        sql = ann.overlapSql(table, addChr(chr), pos)
+    else:
+        sql = ann.overlapSql(table, addChr(chr), pos, startColumn='txStart',
+            endColumn='txEnd')
+    await client.query(sql)
+
+
+async def lookupGadAll(client, record, table='gadAll', engine='mysql',
+    **kwargs):
+    if (engine != 'mysql'):
+        return
+    (chr, pos, ref, alt) = record
+    await client.query(ann.overlapSql(table, stripChr(chr), pos,
+        chromColumn='chromosome'))
+
+
+async def lookupGwasCatalog(client, record, table='gwasCatalog', **kwargs):
+    (chr, pos, ref, alt) = record
+    await client.query(ann.gwasSql(table, addChr(chr), pos))
+
+
+async def lookupOverlap(client, record, table, engine='mysql', **kwargs):
+    if (engine != 'mysql'):
+        return
+    (chr, pos, ref, alt) = record
+    await client.query(ann.overlapSql(table, addChr(chr), pos))
+
+
+async def lookupTfbsConsSites(client, record, engine='mysql', **kwargs):
+    if (engine != 'mysql'):
+        return
+    (chr, pos, ref, alt) = record
+    chrIndex = addChr(chr).replace('chr', '')
+    if (chrIndex in TFBS_CHROMS):
+        await client.query(ann.tfbsSql(chrIndex, pos))
+
+
+"""Async lookup function of every stage
+"""
+LOOKUPS = {
+    ann.streamSnpsFromDbSnp: lookupSnpsFromDbSnp,
+    ann.streamBigRefGene: lookupBigRefGene,
+    ann.streamGenes: lookupGenes,
+    ann.streamOverlapWithCytoband: lookupCytoband,
+    ann.streamOverlapWithGadAll: lookupGadAll,
+    ann.streamOverlapWithGwasCatalog: lookupGwasCatalog,
+    ann.streamOverlapWithMiRNA: lookupOverlap,
+    ann.streamOverlapWitHUGOGeneNomenclature: lookupOverlap,
+    ann.streamOverlapWithCnvDatabase: lookupOverlap,
+    ann.streamOverlapWithGenomicSuperDups: lookupOverlap,
+    ann.streamOverlapWithTfbsConsSites: lookupTfbsConsSites}
+
+
+"""(chr, pos, ref, alt) of every record of a chunk, cleaned as the stages
+   clean them
+"""
+def chunkRecords(chunk, format='vcf'):
+    inds = ann.getFormatSpecificIndices(format=format)
+    names = chunk.chromNames()
+    records = []
+    for i in range(0, len(chunk)):
+        records.append((names[i], chunk.field(i, inds[1]).decode('utf-8'),
+            ann.clean_mysql_chars(chunk.field(i, inds[2]).decode('utf-8')).strip(),
+            ann.clean_mysql_chars(chunk.field(i, inds[3]).decode('utf-8')).strip()))
+    return records
+
+
+"""Makes the lookups of every stage for a chunk of lines at once
+"""
+async def lookupChunk(client, stages, lines):
+    try:
+        chunk = vcf.fromLines(lines)
+    except ValueError:
+        # Not plain records; the stages look them up themselves
+        return
+    lookups = []
+    for (stage, kwargs, message) in stages:
+        if stage in LOOKUPS:
+            records = chunkRecords(chunk, kwargs.get('format', 'vcf'))
+            for record in dict.fromkeys(records):
+                lookups.append(LOOKUPS[stage](client, record, **kwargs))
+    await asyncio.gather(*lookups)
+
+### EOF
@@ -0,0 +1,245 @@
+# benchmark.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Benchmark of AnnTools against a local reference stand-in
+#
+# Runs driver.run end to end on synthetic inputs of several sizes, under
+# named configurations of the annotator, and reports wall and CPU time,
+# throughput and the per-stage metrics of every run as JSON and a table.
+# Inputs and the stand-in are generated from fixed seeds, so reports of
+# different commits compare like for like:
+#   python benchmark.py run /tmp/bench 1000,10000 baseline,index
+#   python benchmark.py compare before.json after.json
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+from contextlib import redirect_stdout
+
+import driver
+import profiling as prof
+import reference_standin as ref
+import snapshot
+import synthetic_vcf as synth
+
+"""Input sizes run by default
+"""
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+"""Annotator configurations: driver.run options by name. 'baseline' is
+   the original pipeline: one stage at a time, one query per variant
+"""
+CONFIGS = {
+    'baseline': {'engine': 'mysql', 'dedup': False},
+    'batched': {'engine': 'mysql', 'dbsnp_batch_size': 5000},
+    'fused': {'engine': 'mysql', 'dbsnp_batch_size': 5000, 'fused': True},
+    'index': {'engine': 'index', 'dbsnp_batch_size': 5000, 'fused': True},
+    'sweep': {'engine': 'sweep', 'dbsnp_batch_size': 5000, 'fused': True},
+    'store': {'engine': 'store', 'dbsnp_batch_size': 5000, 'fused': True},
+    'concurrent': {'engine': 'mysql', 'dbsnp_batch_size': 5000,
+        'concurrent_chunk_size': 1000},
+    'async': {'engine': 'mysql', 'concurrent_chunk_size': 1000,
+        'async_in_flight': 64},
+    'parallel': {'engine': 'index', 'dbsnp_batch_size': 5000, 'workers': 0}}
+
+DEFAULT_CONFIGS = ['baseline', 'index']
+
+"""Snapshot version exported from the stand-in for the 'store' engine
+"""
+SNAPSHOT_VERSION = 'standin'
+
+
+"""Exports and unpacks a snapshot of the stand-in under workdir, for the
+   'store' engine; returns the snapshot path
+"""
+def prepareSnapshot(workdir):
+    path = os.path.join(workdir, 'snapshots', 'local')
+    snapshot.config['snapshot']['export_dir'] = \
+        os.path.join(workdir, 'snapshots', 'export')
+    snapshot.config['snapshot']['path'] = path
+    snapshot.config['snapshot']['bucket'] = ''
+    with redirect_stdout(io.StringIO()):
+        if not os.path.exists(os.path.join(workdir, 'snapshots', 'export',
+            SNAPSHOT_VERSION, 'manifest.json')):
+            snapshot.export(SNAPSHOT_VERSION)
+        snapshot.sync(SNAPSHOT_VERSION)
+    return path
+
+
+"""Synthetic input of 'size' records under workdir, generated once
+"""
+def prepareInput(workdir, size, order, reference):
+    path = os.path.join(workdir, 'inputs', f'{order}-{size}.vcf')
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        synth.generate(path + '.tmp', size, order=order, reference=reference)
+        os.rename(path + '.tmp', path)
+    return path
+
+
+"""Annotates a copy of source with configuration 'name' and returns the
+   metrics of the run
+"""
+def runCase(workdir, source, size, name, options):
+    casedir = os.path.join(workdir, 'runs', f'{name}-{size}')
+    if os.path.exists(casedir):
+        shutil.rmtree(casedir)
+    os.makedirs(casedir)
+    infile = os.path.join(casedir, 'input.vcf')
+    shutil.copyfile(source, infile)
+
+    start = prof.snapshot()
+    with redirect_stdout(io.StringIO()):
+        driver.run(infile, 'vcf', **options)
+    end = prof.snapshot()
+
+    fh = open(infile + '.profile.json')
+    profile = json.load(fh)
+    fh.close()
+    shutil.rmtree(casedir)
+
+    # Lookups made outside the stages (concurrent mode) only show in the
+    # process counters, those of worker processes only in the stages
+    wall = end[0] - start[0]
+    return {'config': name, 'records': size, 'wall_time': wall,
+        'cpu_time': end[1] - start[1],
+        'records_per_second': size / wall if (wall > 0) else 0,
+        'sql_queries': max(end[2] - start[2],
+            sum([s['sql_queries'] for s in profile['stages']])),
+        'rows_fetched': max(end[3] - start[3],
+            sum([s['rows_fetched'] for s in profile['stages']])),
+        'mode': profile['mode'], 'engine': profile['engine'],
+        'stages': [{'stage': s['stage'], 'wall_time': s['wall_time'],
+            'cpu_time': s['cpu_time'], 'sql_queries': s['sql_queries']}
+            for s in profile['stages']]}
+
+
+"""Runs every configuration on an input of every size; the stand-in, the
+   inputs and the report (benchmark-<time>.json) are kept in workdir.
+   repeat > 1 runs each case that many times and keeps the fastest
+"""
+def run(workdir, sizes=DEFAULT_SIZES, configs=DEFAULT_CONFIGS,
+    order='sorted', scale=ref.SCALE, repeat=1):
+    for name in configs:
+        if (name not in CONFIGS):
+            raise ValueError(f"Unknown configuration {name}")
+    os.makedirs(workdir, exist_ok=True)
+    reference = os.path.join(workdir, f'reference-{scale}.db')
+    if not os.path.exists(reference):
+        print(f"Building reference stand-in {reference} . . .")
+        ref.build(reference + '.tmp', scale=scale)
+        os.rename(reference + '.tmp', reference)
+    ref.use(reference)
+    snapshotPath = prepareSnapshot(workdir) if ('store' in configs) else None
+
+    results = []
+    for size in sizes:
+        source = prepareInput(workdir, size, order, reference)
+        for name in configs:
+            options = dict(CONFIGS[name])
+            if (options['engine'] == 'store'):
+                options['snapshot_path'] = snapshotPath
+            runs = [runCase(workdir, source, size, name, options)
+                for i in range(0, repeat)]
+            result = min(runs, key=lambda r: r['wall_time'])
+            result['runs'] = [r['wall_time'] for r in runs]
+            results.append(result)
+            print(f"{name} - {size} records in {result['wall_time']:.2f}s")
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'host': platform.node(), 'python': platform.python_version(),
+        'cpus': os.cpu_count(), 'scale': scale, 'order': order,
+        'sizes': sizes, 'configs': dict([(name, CONFIGS[name])
+            for name in configs]), 'results': results}
+    outfile = os.path.join(workdir,
+        'benchmark-' + time.strftime('%Y%m%d-%H%M%S') + '.json')
+    fh = open(outfile, 'w')
+    json.dump(report, fh, indent=2)
+    fh.write('\n')
+    fh.close()
+
+    print(formatTable(report))
+    print(f"Report written to {outfile}")
+    return report
+
+
+"""Summary of a report, one row per configuration and size, and the wall
+   time of every stage for the largest size
+"""
+def formatTable(report):
+    lines = [f"{'config':<12}{'records':>10}{'wall s':>10}{'cpu s':>10}" + \
+        f"{'rec/s':>11}{'queries':>11}  slowest stage"]
+    for r in report['results']:
+        slowest = max(r['stages'], key=lambda s: s['wall_time']) \
+            if (len(r['stages']) > 0) else {'stage': '-', 'wall_time': 0}
+        lines.append(f"{r['config']:<12}{r['records']:>10}" + \
+            f"{r['wall_time']:>10.2f}{r['cpu_time']:>10.2f}" + \
+            f"{r['records_per_second']:>11.0f}{r['sql_queries']:>11}  " + \
+            f"{slowest['stage']} ({slowest['wall_time']:.2f}s)")
+
+    largest = [r for r in report['results']
+        if (r['records'] == max(report['sizes']))]
+    if (len(largest) > 0):
+        lines.append('')
+        lines.append(f"Stage wall time (s) at {max(report['sizes'])} records")
+        lines.append(f"{'stage':<50}" + \
+            ''.join([f"{r['config']:>12}" for r in largest]))
+        for i in range(0, len(largest[0]['stages'])):
+            lines.append(f"{largest[0]['stages'][i]['stage']:<50}" + \
+                ''.join([f"{r['stages'][i]['wall_time']:>12.2f}"
+                for r in largest]))
+    return '\n'.join(lines)
+
+
+"""Speedup of every configuration and size of report 'after' over the
+   same case in report 'before'
+"""
+def formatComparison(before, after):
+    earlier = dict([((r['config'], r['records']), r)
+        for r in before['results']])
+    lines = [f"{'config':<12}{'records':>10}{'before s':>11}" + \
+        f"{'after s':>11}{'speedup':>10}"]
+    for r in after['results']:
+        b = earlier.get((r['config'], r['records']))
+        if b is None:
+            continue
+        lines.append(f"{r['config']:<12}{r['records']:>10}" + \
+            f"{b['wall_time']:>11.2f}{r['wall_time']:>11.2f}" + \
+            f"{b['wall_time'] / max(r['wall_time'], 1e-9):>9.2f}x")
+    return '\n'.join(lines)
+
+
+def loadReport(path):
+    fh = open(path)
+    report = json.load(fh)
+    fh.close()
+    return report
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 2 and sys.argv[1] == 'run'):
+        run(sys.argv[2],
+            sizes=[int(s) for s in sys.argv[3].split(',')]
+                if (len(sys.argv) > 3) else DEFAULT_SIZES,
+            configs=sys.argv[4].split(',')
+                if (len(sys.argv) > 4) else DEFAULT_CONFIGS,
+            order=sys.argv[5] if (len(sys.argv) > 5) else 'sorted')
+    elif (len(sys.argv) > 3 and sys.argv[1] == 'compare'):
+        print(formatComparison(loadReport(sys.argv[2]),
+            loadReport(sys.argv[3])))
+    else:
+        print("Usage: python benchmark.py run <workdir> [<sizes>] " + \
+            "[<configs>] [sorted|shuffled]")
+        print("       python benchmark.py compare <before.json> <after.json>")
+        print("Configurations: " + ', '.join(CONFIGS))
+
+### EOF
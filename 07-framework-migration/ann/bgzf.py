@@ -0,0 +1,155 @@
+# bgzf.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Compressed VCF input and BGZF (bgzip) output for AnnTools
+#
+# BGZF is gzip made of independent members of at most 64KB of data, each
+# recording its compressed size, so a reader can seek to any member. Any
+# gzip reader decompresses it as a whole.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import gzip
+import zlib
+import struct
+
+"""Uncompressed bytes per BGZF block, as bgzip writes them
+"""
+BLOCK_SIZE = 0xff00
+
+"""Empty block that marks the end of a BGZF file
+"""
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+"""True if path is gzip-compressed (plain gzip or bgzip), by its magic
+   bytes rather than its name
+"""
+def isCompressed(path):
+    fh = open(path, 'rb')
+    magic = fh.read(2)
+    fh.close()
+    return (magic == GZIP_MAGIC)
+
+
+"""Opens a possibly compressed file for streaming binary reads
+"""
+def openBinary(path):
+    if isCompressed(path):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+"""Opens a possibly compressed file for streaming text reads
+"""
+def openText(path):
+    if isCompressed(path):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+
+"""Name of path without a .gz extension
+"""
+def stripGz(path):
+    return path[:-len('.gz')] if path.endswith('.gz') else path
+
+
+"""One BGZF block holding data
+"""
+def compressBlock(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+        ord('B'), ord('C'), 2, len(deflated) + 25)
+    return header + deflated + struct.pack('<II', zlib.crc32(data),
+        len(data))
+
+
+"""Writes a BGZF file. tell() returns the virtual offset of the next byte
+   written: the file offset of its block shifted left 16 bits plus its
+   offset within the uncompressed block
+"""
+class BgzfWriter(object):
+    def __init__(self, path, level=6):
+        self.fh = open(path, 'wb')
+        self.level = level
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.buffer.extend(data)
+        while (len(self.buffer) >= BLOCK_SIZE):
+            self.flushBlock(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+
+    def flushBlock(self, data):
+        block = compressBlock(data, self.level)
+        self.fh.write(block)
+        self.offset = self.offset + len(block)
+
+    def tell(self):
+        return (self.offset << 16) | len(self.buffer)
+
+    """Ends the current block even if it is not full, so the next byte
+       written starts a block
+    """
+    def flush(self):
+        if (len(self.buffer) > 0):
+            self.flushBlock(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        self.fh.write(EOF_BLOCK)
+        self.fh.close()
+
+
+"""Offset and uncompressed data of every BGZF block read from fh, whose
+   first block is at file offset start
+"""
+def iterBlocks(fh, start=0):
+    offset = start
+    while True:
+        header = fh.read(18)
+        if (len(header) == 0):
+            return
+        if (len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04' or
+            header[12:14] != b'BC'):
+            raise ValueError(f"Not a BGZF block at offset {offset}")
+        bsize = struct.unpack('<H', header[16:18])[0] + 1
+        rest = fh.read(bsize - 18)
+        if (len(rest) < bsize - 18):
+            raise ValueError(f"Truncated BGZF block at offset {offset}")
+        yield offset, zlib.decompress(rest[:-8], -15)
+        offset = offset + bsize
+
+
+"""Opens outfile for text output, BGZF-compressed if it ends in .gz
+"""
+def openOutput(outfile):
+    if outfile.endswith('.gz'):
+        return BgzfWriter(outfile)
+    return open(outfile, 'w')
+
+
+"""Compresses src into the BGZF file dst
+"""
+def compressFile(src, dst):
+    fh = open(src, 'rb')
+    writer = BgzfWriter(dst)
+    while True:
+        data = fh.read(BLOCK_SIZE * 16)
+        if (len(data) == 0):
+            break
+        writer.write(data)
+    writer.close()
+    fh.close()
+
+### EOF
@@ -0,0 +1,112 @@
+# checkpoint.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Checkpoints of AnnTools jobs, so that a job interrupted by a crash or a
+# reboot of its instance continues from its last completed stage, chunk or
+# shard. Checkpoints are kept next to the job's input on the instance's own
+# disk: a job taken over by another instance (after this one is scaled in
+# or terminated) starts over there
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+import hashlib
+
+"""Input lines annotated between checkpoints of fused and concurrent runs
+"""
+CHUNK_LINES = 100000
+
+"""Bytes hashed at each end of the input to recognize it
+"""
+FINGERPRINT_BYTES = 1 << 20
+
+
+"""Size and hash of the start and end of a file: the same after the
+   input is downloaded again, unlike its modification time
+"""
+def fingerprint(path):
+    size = os.path.getsize(path)
+    digest = hashlib.sha256()
+    fh = open(path, 'rb')
+    digest.update(fh.read(FINGERPRINT_BYTES))
+    if (size > FINGERPRINT_BYTES):
+        fh.seek(max(size - FINGERPRINT_BYTES, FINGERPRINT_BYTES))
+        digest.update(fh.read(FINGERPRINT_BYTES))
+    fh.close()
+    return str(size) + ':' + digest.hexdigest()
+
+
+"""Makes sure data written to fh survives a crash of the instance
+"""
+def sync(fh):
+    fh.flush()
+    os.fsync(fh.fileno())
+
+
+"""Makes sure the file at path survives a crash of the instance
+"""
+def syncFile(path):
+    if os.path.exists(path):
+        fh = open(path, 'rb')
+        os.fsync(fh.fileno())
+        fh.close()
+
+
+"""Cuts path back to size bytes, the length it had at a checkpoint
+"""
+def truncate(path, size):
+    if not os.path.exists(path):
+        return
+    fh = open(path, 'r+b')
+    fh.truncate(size)
+    fh.close()
+
+
+def fileSize(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+"""Progress of one job, saved as JSON at path. key describes the job
+   (input, mode, stages and options); progress saved under another key,
+   e.g. before the settings changed, is ignored
+"""
+class Checkpoint(object):
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+
+    """Progress of the last checkpoint, or None if there is none for this
+       job
+    """
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        try:
+            fh = open(self.path)
+            manifest = json.load(fh)
+            fh.close()
+        except ValueError:
+            return None
+        if (manifest.get('key') != self.key):
+            return None
+        return manifest['progress']
+
+    """Replaces the checkpoint with progress, atomically
+    """
+    def save(self, progress):
+        fh = open(self.path + '.tmp', 'w')
+        json.dump({'key': self.key, 'progress': progress}, fh)
+        sync(fh)
+        fh.close()
+        os.replace(self.path + '.tmp', self.path)
+
+    def clear(self):
+        for path in [self.path, self.path + '.tmp']:
+            if os.path.exists(path):
+                os.remove(path)
+
+### EOF
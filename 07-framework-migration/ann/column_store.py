@@ -0,0 +1,211 @@
+# column_store.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Memory-mapped reference store over an unpacked snapshot
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+
+import numpy as np
+
+"""Where snapshot.py sync unpacks snapshots; CURRENT names the version
+"""
+SNAPSHOT_PATH = os.environ.get('ANNTOOLS_SNAPSHOT_PATH',
+    '/home/ubuntu/gas/ann/snapshots/')
+
+"""Partition name of tables without a chromosome column
+"""
+ALL = '_all'
+
+"""Stores opened so far in this process, keyed by snapshot directory
+"""
+stores = {}
+
+EMPTY = np.zeros(0, dtype=np.int64)
+
+
+"""One table partition. Every array is memory-mapped, so processes on the
+   same instance share the pages; rows are decoded on first use
+"""
+class StorePartition(object):
+    def __init__(self, directory, columns, count=None):
+        self.directory = directory
+        self.columns = columns
+        self.starts = self.load('_starts')
+        self.ends = self.load('_ends')
+        self.maxends = self.load('_maxends')
+        self.order = self.load('_order')
+        # Rows without an interval are not in _order
+        self.count = len(self.order) if (count is None) else count
+        self.arrays = {}
+        self.decoded = {}
+
+    def load(self, name):
+        return np.load(os.path.join(self.directory, name + '.npy'),
+            mmap_mode='r')
+
+    def column(self, i):
+        if i not in self.arrays:
+            prefix = 'c' + str(i) + '.'
+            nulls = None
+            if os.path.exists(os.path.join(self.directory,
+                prefix + 'nulls.npy')):
+                nulls = self.load(prefix + 'nulls')
+            if (self.columns[i]['kind'] == 'int'):
+                self.arrays[i] = (self.load(prefix + 'values'), None, nulls)
+            else:
+                self.arrays[i] = (self.load(prefix + 'offsets'),
+                    self.load(prefix + 'heap'), nulls)
+        return self.arrays[i]
+
+    def value(self, i, r):
+        (values, heap, nulls) = self.column(i)
+        if (nulls is not None and nulls[r]):
+            return None
+        if heap is None:
+            return int(values[r])
+        data = heap[values[r]:values[r + 1]].tobytes()
+        return data if (self.columns[i]['kind'] == 'bytes') \
+            else data.decode('utf-8')
+
+    """Row r (in table order) as the database returns it
+    """
+    def row(self, r):
+        r = int(r)
+        if r not in self.decoded:
+            self.decoded[r] = tuple([self.value(i, r)
+                for i in range(0, len(self.columns))])
+        return self.decoded[r]
+
+    def rows(self):
+        return [self.row(r) for r in range(0, self.count)]
+
+    """For each position, the rows whose interval contains it (in table
+       order). The whole chunk is resolved with one pair of searchsorted
+       calls and vectorized filtering of the candidates
+    """
+    def overlapChunk(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        hi = np.searchsorted(self.starts, positions, side='right')
+        lo = np.searchsorted(self.maxends, positions, side='left')
+        counts = np.maximum(hi - lo, 0)
+        total = int(counts.sum())
+        if (total == 0):
+            return [EMPTY] * len(positions)
+
+        owner = np.repeat(np.arange(len(positions)), counts)
+        candidates = np.repeat(lo, counts) + np.arange(total) - \
+            np.repeat(np.cumsum(counts) - counts, counts)
+        keep = self.ends[candidates] >= positions[owner]
+        owner = owner[keep]
+        rowids = self.order[candidates[keep]]
+
+        ordered = np.lexsort((rowids, owner))
+        owner = owner[ordered]
+        rowids = rowids[ordered]
+        bounds = np.searchsorted(owner, np.arange(len(positions) + 1))
+        return [rowids[bounds[k]:bounds[k + 1]]
+            for k in range(0, len(positions))]
+
+
+"""An unpacked snapshot: its manifest and lazily opened partitions
+"""
+class ColumnStore(object):
+    def __init__(self, root):
+        self.root = root
+        fh = open(os.path.join(root, 'manifest.json'))
+        self.manifest = json.load(fh)
+        fh.close()
+        self.partitions = {}
+
+    def columnNames(self, table):
+        for entry in self.manifest['tables'][table]['partitions'].values():
+            return [c['name'] for c in entry['columns']]
+        return []
+
+    """Partition of table for chrom, or None if the table has no rows there
+    """
+    def partition(self, table, chrom):
+        spec = self.manifest['tables'][table]
+        if (spec['chromColumn'] is None):
+            chrom = ALL
+        if (chrom not in spec['partitions']):
+            return None
+        if ((table, chrom) not in self.partitions):
+            self.partitions[(table, chrom)] = StorePartition(
+                os.path.join(self.root, table, chrom),
+                spec['partitions'][chrom]['columns'],
+                spec['partitions'][chrom].get('rows'))
+        return self.partitions[(table, chrom)]
+
+
+"""Returns the store of the current snapshot under path
+"""
+def getStore(path=None):
+    path = path or SNAPSHOT_PATH
+    fh = open(os.path.join(path, 'CURRENT'))
+    root = os.path.join(path, fh.read().strip())
+    fh.close()
+    if root not in stores:
+        stores[root] = ColumnStore(root)
+    return stores[root]
+
+
+"""Answers 'start <= pos AND pos <= end' lookups for a table from the
+   store, like interval_index.IntervalIndex. prefetch() resolves a chunk
+   of (chrom, pos) keys in one vectorized call per partition; query()
+   then serves them from that chunk
+"""
+class StoreIndex(object):
+    def __init__(self, store, table, columns='*'):
+        self.store = store
+        self.table = table
+        self.select = None
+        if (columns != '*'):
+            names = store.columnNames(table)
+            self.select = [names.index(c.strip()) for c in columns.split(',')]
+        self.prefetched = {}
+
+    def rows(self, partition, rowids):
+        rows = [partition.row(r) for r in rowids]
+        if self.select is not None:
+            rows = [tuple([row[i] for i in self.select]) for row in rows]
+        return rows
+
+    """Resolves the records of a vcf_chunks.VcfChunk, one vectorized call
+       per partition and chromosome. Chromosome names are tried as given
+       and with and without the 'chr' prefix, since stages differ in how
+       they spell them
+    """
+    def prefetch(self, chunk):
+        self.prefetched = {}
+        for code in range(0, len(chunk.chroms)):
+            chrom = chunk.chroms[code].strip()
+            positions = np.unique(chunk.pos[chunk.chrom == code])
+            bare = chrom[3:] if chrom.startswith('chr') else chrom
+            for name in set([chrom, bare, 'chr' + bare]):
+                partition = self.store.partition(self.table, name)
+                if partition is None:
+                    continue
+                hits = partition.overlapChunk(positions)
+                for k in range(0, len(positions)):
+                    self.prefetched[(name, int(positions[k]))] = \
+                        self.rows(partition, hits[k])
+
+    """Rows containing pos, same as the per-variant SQL query
+    """
+    def query(self, chrom, pos):
+        pos = int(pos)
+        partition = self.store.partition(self.table, chrom)
+        if partition is None:
+            return []
+        if ((chrom, pos) in self.prefetched):
+            return self.prefetched[(chrom, pos)]
+        return self.rows(partition, partition.overlapChunk([pos])[0])
+
+### EOF
@@ -12,110 +12,679 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import asyncio
+import itertools
+from array import array
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    as_completed
+
+import numpy as np
+
 import file_utils as fu
 import annotate as ann
+import async_lookups as al
+import bgzf
+import checkpoint as ck
+import column_store as cs
+import lookup_cache as lc
+import profiling as prof
+import tabix
+import utils as u
+import vcf_chunks as vcf
 
-def run(infile, format):
+"""Annotation stages in the order they are applied: the stream function,
+   its keyword arguments and the message printed when it is done
+"""
+def getStages(format='vcf', dbsnp_batch_size=0, engine='mysql'):
+    return [
+        (ann.streamSnpsFromDbSnp, 
+            {'format': format, 'batch_size': dbsnp_batch_size}, 
+            "dbSNP - done."),
+        (ann.streamBigRefGene, {'format': format}, "BigRefGene - done."),
+        (ann.streamGenes, 
+            {'format': format, 'table': 'refGene', 'promoter_offset': 500,
+            'engine': engine},
+            "BigRefGene - done."),
+        (ann.streamOverlapWithCytoband, 
+            {'format': format, 'table': 'cytoBand', 'engine': engine},
+            "Cytoband - done."),
+        (ann.streamOverlapWithGadAll, 
+            {'format': format, 'table': 'gadAll', 'engine': engine},
+            "gadAll - done."),
+        (ann.streamOverlapWithGwasCatalog, 
+            {'format': format, 'table': 'gwasCatalog'},
+            "GwasCatalog - done."),
+        (ann.streamOverlapWithMiRNA, 
+            {'format': format, 'table': 'targetScanS', 'engine': engine},
+            "miRNA - done."),
+        (ann.streamOverlapWitHUGOGeneNomenclature, 
+            {'format': format, 'table': 'hugo', 'engine': engine},
+            "HUGO Gene Nomenclature Committee - done."),
+        (ann.streamOverlapWithCnvDatabase, 
+            {'format': format, 'table': 'dgv_Cnv', 'engine': engine},
+            "dgv_Cnv - done."),
+        (ann.streamOverlapWithCnvDatabase, 
+            {'format': format, 'table': 'abParts_IG_T_CelReceptors', 
+            'engine': engine},
+            "abParts_IG_T_CelReceptors - done."),
+        (ann.streamOverlapWithCnvDatabase, 
+            {'format': format, 'table': 'mcCarroll_Cnv', 'engine': engine},
+            "mcCarroll_Cnv - done."),
+        (ann.streamOverlapWithCnvDatabase, 
+            {'format': format, 'table': 'conrad_Cnv', 'engine': engine},
+            "conrad_Cnv - done."),
+        (ann.streamOverlapWithGenomicSuperDups, 
+            {'format': format, 'table': 'genomicSuperDups', 'engine': engine},
+            "genomicSuperDups - done."),
+        (ann.streamOverlapWithTfbsConsSites, 
+            {'table': 'tfbsConsSites', 'engine': engine},
+            "addOverlapWithTfbsConsSites - done.")]
 
-    print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+"""Runs one stage at a time, each reading the previous stage's temporary
+   file (.1 ... .14) and writing the next one. With a checkpoint, the
+   stages done are recorded after each one, and a job that has them
+   starts from the file of the last one. Returns the metrics of every 
+   stage
+"""
+def runStaged(infile, stages, checkpoint=None):
+    base = bgzf.stripGz(infile)
+    logcountfile = base + '.count.log'
+    tmpextin = ''
+    reports = []
+    done = 0
+    progress = checkpoint.load() if checkpoint is not None else None
+    if (progress is not None and progress['stages'] > 0 and
+        ck.fileSize(base + '.' + str(progress['stages'])) == progress['size']
+        and ck.fileSize(logcountfile) >= progress['log_size']):
+        done = progress['stages']
+        reports = progress['reports']
+        ck.truncate(logcountfile, progress['log_size'])
+        tmpextin = '.' + str(done)
+        print(f"Resuming after stage {done} of {len(stages)}")
+
+    for i in range(done, len(stages)):
+        (stage, kwargs, message) = stages[i]
+        fh = bgzf.openText(infile) if (i == 0) else open(base + tmpextin)
+        source = prof.StageProfile('input')
+        profile = prof.StageProfile(prof.stageName(stage, kwargs))
+        ann.writeLines(prof.profiled(stage(prof.profiled(fh, source), 
+            logcountfile, **kwargs), profile), base + '.' + str(i + 1))
+        fh.close()
+        reports.append(profile.report(source))
+        print(message)
+        tmpextin = '.' + str(i + 1)
+        if checkpoint is not None:
+            ck.syncFile(base + tmpextin)
+            ck.syncFile(logcountfile)
+            checkpoint.save({'stages': i + 1, 
+                'size': ck.fileSize(base + tmpextin), 
+                'log_size': ck.fileSize(logcountfile), 'reports': reports})
 
     ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + '.' + str(i))
+    for i in range(1, len(stages)):
+        fu.delete(base + '.' + str(i))
+
+    os.rename(base + tmpextin, base + '.annot')
+    return reports
+
+
+"""Passes lines through and prints message once they are exhausted
+"""
+def announce(lines, message):
+    for line in lines:
+        yield line
+    print(message)
+
+
+"""Chains all stages over lines so that each record is passed through
+   every stage in order, and writes the results to fh_out. Returns the
+   counters and the metrics of every stage
+"""
+def fuseLines(lines, stages, fh_out, logcountfile=None, verbose=True):
+    profiles = [prof.StageProfile('input')]
+    lines = prof.profiled(lines, profiles[0])
+    allcounts = []
+    for (stage, kwargs, message) in stages:
+        counts = {}
+        profiles.append(prof.StageProfile(prof.stageName(stage, kwargs)))
+        lines = prof.profiled(stage(lines, logcountfile, counts=counts, 
+            **kwargs), profiles[-1])
+        if verbose:
+            lines = announce(lines, message)
+        allcounts.append(counts)
+
+    for line in lines:
+        fh_out.write(line + '\n')
+    reports = [profiles[i].report(profiles[i - 1]) 
+        for i in range(1, len(profiles))]
+    return allcounts, reports
+
+
+"""Chains all stages so that each record is read once, passed through 
+   every stage in order and written once; chunk_size > 0 makes the
+   lookups of every chunk of that many records concurrently first (see
+   runConcurrent). infile may be gzip-compressed and outfile is written
+   with BGZF if it ends in .gz. With a checkpoint, the records are passed
+   through the stages in chunks, so that progress can be recorded between
+   them. Returns the counters and the metrics of every stage
+"""
+def runFused(infile, stages, outfile, logcountfile=None, verbose=True,
+    chunk_size=0, in_flight=0, checkpoint=None):
+    if (chunk_size > 0 or checkpoint is not None):
+        return runConcurrent(infile, stages, outfile, logcountfile, verbose,
+            chunk_size=chunk_size or ck.CHUNK_LINES, in_flight=in_flight,
+            prefetch=(chunk_size > 0), checkpoint=checkpoint)
+    fh = bgzf.openText(infile)
+    fh_out = bgzf.openOutput(outfile)
+    allcounts, reports = fuseLines(fh, stages, fh_out, logcountfile, verbose)
+    fh_out.close()
+    fh.close()
+    return allcounts, reports
+
+
+"""Runs a stage over a chunk only for the lookups it makes, which end up
+   in the chunk's lookup cache
+"""
+def lookupStage(stage, kwargs, chunk):
+    for line in stage(chunk, None, counts={}, **kwargs):
+        pass
+
+
+"""Annotates infile in chunks of chunk_size records. The stages make the
+   lookups of a chunk all at once, each in its own thread with its own
+   database connection, into an in-memory cache; the chunk is then run
+   through the fused stages in order, which find every lookup already
+   made. A chunk takes about as long as its slowest stage instead of all
+   of them added up. With in_flight > 0 the lookups are instead sent by
+   the asyncio client of async_lookups, up to in_flight at a time across
+   all stages and records; prefetch=False skips the lookups and only
+   runs the chunks through the stages. With a checkpoint, the lines done,
+   the output size and the counters so far are recorded about every
+   checkpoint.CHUNK_LINES lines, and a job that has them skips those
+   lines and appends to its output. Returns the counters and the metrics
+   of every stage
+"""
+def runConcurrent(infile, stages, outfile, logcountfile=None, verbose=True,
+    chunk_size=1000, in_flight=0, prefetch=True, checkpoint=None):
+    backing = u.lookup_cache
+    threads = ThreadPoolExecutor(max_workers=len(stages))
+    if (prefetch and in_flight > 0):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        client = al.AsyncLookupClient(in_flight=in_flight)
+    allcounts = None
+    reports = None
+    lines = 0
+    fh = bgzf.openText(infile)
+    progress = checkpoint.load() if checkpoint is not None else None
+    if (progress is not None and ck.fileSize(outfile) >= progress['size']):
+        ck.truncate(outfile, progress['size'])
+        (lines, allcounts, reports) = (progress['lines'], progress['counts'],
+            progress['reports'])
+        for line in itertools.islice(fh, lines):
+            pass
+        fh_out = open(outfile, 'a')
+        print(f"Resuming after {lines} lines")
+    else:
+        fh_out = bgzf.openOutput(outfile)
+    saved = lines
+    try:
+        for chunk in ann.readLineChunks(fh, chunk_size):
+            u.lookup_cache = lc.MemoryLookups(backing)
+            if (prefetch and in_flight > 0):
+                loop.run_until_complete(al.lookupChunk(client, stages, chunk))
+            elif prefetch:
+                futures = [threads.submit(lookupStage, stage, kwargs, chunk) 
+                    for (stage, kwargs, message) in stages]
+                for future in futures:
+                    future.result()
+            counts, chunkReports = fuseLines(chunk, stages, fh_out, 
+                verbose=False)
+            if allcounts is None:
+                (allcounts, reports) = (counts, chunkReports)
+            else:
+                allcounts = [ann.mergeCounts([allcounts[i], counts[i]])
+                    for i in range(0, len(stages))]
+                reports = prof.mergeReports([reports, chunkReports])
+            lines = lines + len(chunk)
+            if (checkpoint is not None and lines - saved >= ck.CHUNK_LINES):
+                ck.sync(fh_out)
+                checkpoint.save({'lines': lines, 'size': ck.fileSize(outfile),
+                    'counts': allcounts, 'reports': reports})
+                saved = lines
+        if allcounts is None:
+            allcounts, reports = fuseLines([], stages, fh_out, 
+                verbose=False)
+    finally:
+        u.lookup_cache = backing
+        threads.shutdown()
+        if (prefetch and in_flight > 0):
+            client.close()
+            loop.close()
+            asyncio.set_event_loop(None)
+        fh_out.close()
+        fh.close()
+
+    for i in range(0, len(stages)):
+        ann.writeCountLog(logcountfile, allcounts[i])
+        if verbose:
+            print(stages[i][2])
+    return allcounts, reports
+
+
+"""Splits the records of infile into shard files by chromosome, starting
+   a new shard whenever one reaches shard_size records (0 = no limit). 
+   Returns the header lines, the shard of every record in input order 
+   and the shard file names
+"""
+def splitShards(infile, shard_size=0, sep='\t'):
+    headers = []
+    order = array('I')
+    shardfiles = []
+    current = {}
+    handles = []
+    sizes = []
+    inHeader = True
+
+    fh = bgzf.openText(infile)
+    for line in fh:
+        if inHeader and (line.startswith('##') or line.startswith('#CHROM')):
+            headers.append(line.strip())
+            continue
+        inHeader = False
+
+        chr = line.split(sep)[0].strip().replace('chr', '')
+        if (chr not in current) or \
+            (shard_size > 0 and sizes[current[chr]] >= shard_size):
+            if (chr in current):
+                handles[current[chr]].close()
+            current[chr] = len(shardfiles)
+            shardfiles.append(bgzf.stripGz(infile) + '.shard' + 
+                str(len(shardfiles)))
+            handles.append(open(shardfiles[-1], 'w'))
+            sizes.append(0)
+
+        shard = current[chr]
+        handles[shard].write(line if line.endswith('\n') else line + '\n')
+        sizes[shard] = sizes[shard] + 1
+        order.append(shard)
+    fh.close()
+
+    for handle in handles:
+        handle.close()
+    return headers, order, shardfiles
+
+
+"""True when every chromosome of infile is one contiguous block of records
+   with non-decreasing positions, i.e. it can be annotated by sweeping
+"""
+def isSorted(infile, format='vcf', sep='\t'):
+    reader = vcf.VcfReader(infile)
+    seen = set()
+    chr = None
+    pos = 0
+
+    for chunk in reader:
+        if (len(chunk) == 0):
+            continue
+        names = np.array([c.strip().replace('chr', '') for c in chunk.chroms],
+            dtype=object)[chunk.chrom]
+        # Records where the chromosome changes within the chunk
+        changes = np.flatnonzero(names[1:] != names[:-1]) + 1
+        if (names[0] == chr and chunk.pos[0] < pos):
+            reader.close()
+            return False
+        for thisChr in [names[0]] + list(names[changes]):
+            if (thisChr == chr):
+                continue
+            if (thisChr in seen):
+                reader.close()
+                return False
+            seen.add(thisChr)
+            chr = thisChr
+        steps = np.diff(chunk.pos)
+        steps[changes - 1] = 0
+        if (steps < 0).any():
+            reader.close()
+            return False
+        pos = chunk.pos[-1]
+    reader.close()
+    return True
+
+
+"""Records of infile and how many distinct (chr, pos, ref, alt) they have
+"""
+def countVariants(infile, format='vcf'):
+    inds = ann.getFormatSpecificIndices(format=format)
+    reader = vcf.VcfReader(infile)
+    variants = set()
+    records = 0
+    for chunk in reader:
+        names = [c.replace('chr', '') for c in chunk.chroms]
+        for i in range(0, len(chunk)):
+            variants.add((names[chunk.chrom[i]], chunk.pos[i],
+                chunk.field(i, inds[2]), chunk.field(i, inds[3])))
+        records = records + len(chunk)
+    reader.close()
+    return records, len(variants)
+
+
+"""Answers the repeated lookups of a job from memory: up to entries
+   lookups are kept in front of the persistent lookup cache, least
+   recently used out first. Every record still goes through every stage,
+   so the output and the counts are unchanged (entries = 0 does nothing)
+"""
+@contextmanager
+def jobLookups(entries=0):
+    backing = u.lookup_cache
+    if (entries > 0):
+        u.lookup_cache = lc.MemoryLookups(backing, max_entries=entries)
+    try:
+        yield u.lookup_cache
+    finally:
+        u.lookup_cache = backing
+
+
+"""Hits of the in-memory lookups of a job, if it has them
+"""
+def dedupStats(lookups):
+    if isinstance(lookups, lc.MemoryLookups):
+        return {'dedup_hits': lookups.hits}
+    return {}
+
+
+"""Sets up the persistent lookup cache of this process from its settings
+   (path, max_bytes, version) and returns it; None disables caching
+"""
+def openLookupCache(cache=None):
+    if cache is None:
+        u.set_lookup_cache(None)
+    elif (u.lookup_cache is None or u.lookup_cache.path != cache['path']):
+        u.set_lookup_cache(lc.LookupCache(**cache))
+    return u.lookup_cache
+
+
+"""Hits and misses of the lookup cache, since 'before' if given
+"""
+def lookupStats(cache, before=None):
+    if cache is None:
+        return {'hits': 0, 'misses': 0}
+    stats = cache.stats()
+    if before is not None:
+        stats = {key: stats[key] - before[key] for key in stats}
+    return stats
+
+
+"""Annotates one shard in a worker process with its own DB connections
+   Returns the stage counters and metrics and the lookup cache hits and
+   misses
+"""
+def annotateShard(shardfile, format, options, cache=None, 
+    snapshot_path=None, chunk_size=0, in_flight=0, dedup_entries=0):
+    if snapshot_path:
+        cs.SNAPSHOT_PATH = snapshot_path
+    lookups = openLookupCache(cache)
+    before = lookupStats(lookups)
+    stages = getStages(format=format, **options)
+    with jobLookups(dedup_entries) as memory:
+        counts, reports = runFused(shardfile, stages, shardfile + '.annot', 
+            verbose=False, chunk_size=chunk_size, in_flight=in_flight)
+    stats = lookupStats(lookups, before)
+    stats.update(dedupStats(memory))
+    return counts, reports, stats
+
+
+"""Annotates the shards of infile in a pool of worker processes, merges
+   the annotated shards back in the original record order and writes the
+   count log from the merged counters of every stage. With a checkpoint,
+   the shards and the results of every shard done are recorded, and a
+   job that has them only annotates the other shards. Returns the stage
+   metrics and the lookup cache hits and misses added up over all workers
+"""
+def runParallel(infile, format, workers=0, shard_size=0, cache=None, 
+    snapshot_path=None, chunk_size=0, in_flight=0, dedup_entries=0, 
+    checkpoint=None, **options):
+    base = bgzf.stripGz(infile)
+    orderfile = base + '.order'
+    stages = getStages(format=format, **options)
+    progress = checkpoint.load() if checkpoint is not None else None
+    if (progress is not None and 'shards' in progress and 
+        os.path.exists(orderfile) and all([os.path.exists(shardfile + 
+        ('.annot' if (str(i) in progress['done']) else ''))
+        for (i, shardfile) in enumerate(progress['shards'])])):
+        (headers, shardfiles, done) = (progress['headers'], 
+            progress['shards'], progress['done'])
+        order = array('I')
+        fh = open(orderfile, 'rb')
+        order.frombytes(fh.read())
+        fh.close()
+        print(f"Resuming with {len(done)} of {len(shardfiles)} shards done")
+    else:
+        headers, order, shardfiles = splitShards(infile, shard_size=shard_size)
+        done = {}
+        if (checkpoint is not None and len(shardfiles) > 1):
+            fh = open(orderfile, 'wb')
+            order.tofile(fh)
+            ck.sync(fh)
+            fh.close()
+            for shardfile in shardfiles:
+                ck.syncFile(shardfile)
+            checkpoint.save({'headers': headers, 'shards': shardfiles, 
+                'done': done})
+
+    if (len(shardfiles) <= 1):
+        for shardfile in shardfiles:
+            fu.delete(shardfile)
+        lookups = openLookupCache(cache)
+        before = lookupStats(lookups)
+        with jobLookups(dedup_entries) as memory:
+            counts, reports = runFused(infile, stages, base + '.annot', 
+                base + '.count.log', chunk_size=chunk_size, 
+                in_flight=in_flight, checkpoint=checkpoint)
+        stats = lookupStats(lookups, before)
+        stats.update(dedupStats(memory))
+        return reports, stats
+
+    pool = ProcessPoolExecutor(max_workers=(workers or os.cpu_count()))
+    futures = {}
+    for (i, shardfile) in enumerate(shardfiles):
+        if (str(i) not in done):
+            futures[pool.submit(annotateShard, shardfile, format, options, 
+                cache, snapshot_path, chunk_size, in_flight, 
+                dedup_entries)] = i
+    for future in as_completed(futures):
+        i = futures[future]
+        done[str(i)] = future.result()
+        if checkpoint is not None:
+            ck.syncFile(shardfiles[i] + '.annot')
+            checkpoint.save({'headers': headers, 'shards': shardfiles, 
+                'done': done})
+    pool.shutdown()
+    results = [done[str(i)][0] for i in range(0, len(shardfiles))]
+    reports = prof.mergeReports([done[str(i)][1] 
+        for i in range(0, len(shardfiles))])
+    lookups = ann.mergeCounts([done[str(i)][2] 
+        for i in range(0, len(shardfiles))])
+
+    fh_out = open(base + '.annot', 'w')
+    for line in headers:
+        fh_out.write(line + '\n')
+    shards = [open(shardfile + '.annot') for shardfile in shardfiles]
+    for shard in order:
+        fh_out.write(shards[shard].readline())
+    fh_out.close()
+
+    for i in range(0, len(shardfiles)):
+        shards[i].close()
+        fu.delete(shardfiles[i])
+        fu.delete(shardfiles[i] + '.annot')
+    fu.delete(orderfile)
+
+    for i in range(0, len(stages)):
+        ann.writeCountLog(base + '.count.log', 
+            ann.mergeCounts([counts[i] for counts in results]))
+        print(stages[i][2])
+    return reports, lookups
+
+
+"""Runs all annotation stages on infile
+   dbsnp_batch_size > 0 resolves dbSNP in chunks of that many lines
+   engine='index' answers the region overlap stages from in-memory
+   interval indexes, and the gene structure stage from cached gene models
+   and CpG islands, instead of one MySQL query per variant
+   engine='sweep' merge-joins position-sorted input against each region
+   table read in start order, one pass per chromosome; presorted=None
+   checks the input first and falls back to 'index' if it is not sorted,
+   presorted=True declares it sorted and skips the check
+   engine='store' answers the region overlap, CpG island and gene model
+   lookups from the memory-mapped snapshot synced under snapshot_path
+   cache_path names a persistent lookup cache (at most cache_size bytes)
+   shared by jobs on this instance, keyed by reference_version; variants 
+   looked up before skip the database. It is only used with the 'mysql'
+   engine, the others answer most lookups from memory
+   fused=True streams every record through all stages in a single pass
+   instead of writing a temporary file per stage
+   concurrent_chunk_size > 0 runs fused in chunks of that many records,
+   the stages making the lookups of each chunk at the same time, one
+   thread and connection per stage ('sweep' becomes 'index'), or with
+   async_in_flight > 0 through an asyncio client that keeps up to that
+   many lookups of all stages and records in flight
+   dedup=True answers repeated lookups of the job (the same variant
+   several times, as in multi-sample or concatenated files) from memory,
+   keeping up to dedup_entries of them; dedup=None counts the distinct
+   variants first and only does so if some repeat
+   workers != 1 splits the records by chromosome (at most shard_size per
+   shard) and annotates the shards in that many processes (0 = one per
+   core); the shards are always annotated fused
+   infile may be gzip- or bgzip-compressed (<name>.vcf.gz); it is read
+   as a stream and the outputs are named after <name>.vcf
+   compress_output=True writes <name>.annot.vcf.gz with BGZF (bgzip)
+   compression, directly when fused and after the last stage otherwise;
+   index_output=True then also writes its positional index (tabix .tbi)
+   when the records are sorted, for region reads of the result
+   checkpoint=True records the progress of the job next to infile (in
+   <name>.vcf.checkpoint.json) after every stage (staged), every
+   checkpoint.CHUNK_LINES lines (fused, concurrent) or every shard
+   (parallel), and keeps the files it needs; the same job run again with
+   the same settings, e.g. after the instance crashed, continues from
+   there. The output is then compressed after the last stage, and a
+   fused run uses 'index' rather than 'sweep'
+   Wall and CPU time, records, SQL statements, rows fetched and bytes in
+   and out of every stage are written to <name>.vcf.profile.json
+"""
+def run(infile, format, dbsnp_batch_size=0, engine='mysql', fused=False,
+    workers=1, shard_size=0, presorted=None, cache_path=None, 
+    cache_size=1 << 30, reference_version='', snapshot_path=None,
+    concurrent_chunk_size=0, async_in_flight=0, dedup=None, 
+    dedup_entries=500000, compress_output=False, index_output=False,
+    checkpoint=False):
+
+    print("Running . . .")
+    start = prof.snapshot()
+    base = bgzf.stripGz(infile)
+    annotfile = base + '.annot'
+
+    if (engine == 'sweep' and concurrent_chunk_size > 0):
+        print("Concurrent lookups restart a sweep every chunk, " + \
+            "using the index engine")
+        engine = 'index'
+
+    if (engine == 'sweep' and checkpoint and fused and workers == 1):
+        print("Checkpoints restart a sweep every chunk, " + \
+            "using the index engine")
+        engine = 'index'
+
+    if (engine == 'sweep' and not presorted):
+        if (presorted is not None or not isSorted(infile, format=format)):
+            print("Input is not position-sorted, using the index engine")
+            engine = 'index'
+
+    if (cache_path and engine != 'mysql'):
+        print("The lookup cache is for the mysql engine only, not using it")
+        cache_path = None
+
+    if snapshot_path:
+        cs.SNAPSHOT_PATH = snapshot_path
+
+    cache = None
+    if cache_path:
+        cache = {'path': cache_path, 'max_bytes': cache_size, 
+            'version': reference_version}
+    lookups = openLookupCache(cache)
+    before = lookupStats(lookups)
+
+    if (dedup is None and dedup_entries > 0):
+        records, variants = countVariants(infile, format=format)
+        print(f"Dedup - {records} records, {variants} distinct variants.")
+        dedup = (variants < records)
+    if not dedup:
+        dedup_entries = 0
+
+    options = {'dbsnp_batch_size': dbsnp_batch_size, 'engine': engine}
+    progress = None
+    if checkpoint:
+        progress = ck.Checkpoint(base + '.checkpoint.json', 
+            {'input': ck.fingerprint(infile), 'format': format, 
+            'options': options, 'fused': fused, 'workers': workers, 
+            'shard_size': shard_size, 'chunk_size': concurrent_chunk_size,
+            'in_flight': async_in_flight, 'chunk_lines': ck.CHUNK_LINES})
+
+    if (workers != 1):
+        mode = 'parallel'
+        reports, stats = runParallel(infile, format, workers=workers, 
+            shard_size=shard_size, cache=cache, snapshot_path=snapshot_path,
+            chunk_size=concurrent_chunk_size, in_flight=async_in_flight, 
+            dedup_entries=dedup_entries, checkpoint=progress, **options)
+    elif (fused or concurrent_chunk_size > 0):
+        mode = 'concurrent' if (concurrent_chunk_size > 0) else 'fused'
+        if (compress_output and not checkpoint):
+            annotfile = annotfile + '.gz'
+        with jobLookups(dedup_entries) as memory:
+            counts, reports = runFused(infile, 
+                getStages(format=format, **options), annotfile, 
+                base + '.count.log', chunk_size=concurrent_chunk_size, 
+                in_flight=async_in_flight, checkpoint=progress)
+        stats = lookupStats(lookups, before)
+        stats.update(dedupStats(memory))
+    else:
+        mode = 'staged'
+        with jobLookups(dedup_entries) as memory:
+            reports = runStaged(infile, getStages(format=format, **options),
+                checkpoint=progress)
+        stats = lookupStats(lookups, before)
+        stats.update(dedupStats(memory))
+
+    if lookups is not None:
+        print(f"Lookup cache - {stats['hits']} hits, {stats['misses']} misses.")
+    if ('dedup_hits' in stats):
+        print(f"Dedup - {stats['dedup_hits']} repeated lookups answered " + \
+            "from memory.")
+
+    end = prof.snapshot()
+    prof.writeProfile(base + '.profile.json', reports, 
+        input=os.path.basename(infile), mode=mode, engine=engine, 
+        workers=(workers or os.cpu_count()), wall_time=end[0] - start[0], 
+        cpu_time=end[1] - start[1], lookup_cache=stats)
+
+    if (compress_output and not annotfile.endswith('.gz')):
+        bgzf.compressFile(annotfile, annotfile + '.gz')
+        fu.delete(annotfile)
+        annotfile = annotfile + '.gz'
+
+    finalout=(base + '.annot').replace('.vcf.annot', '.annot.vcf')
+    if compress_output:
+        finalout = finalout + '.gz'
+    os.rename(annotfile, finalout)
+    if progress is not None:
+        progress.clear()
 
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    if (compress_output and index_output):
+        try:
+            tabix.buildIndex(finalout)
+            print("Index - " + os.path.basename(finalout) + '.tbi')
+        except ValueError as e:
+            print("No index - " + str(e))
 
-### EOF
\ No newline at end of file
+### EOF
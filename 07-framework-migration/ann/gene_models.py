@@ -0,0 +1,96 @@
+# gene_models.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Cached gene models (refGene transcripts) for AnnTools
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import numpy as np
+
+import interval_index as ii
+import utils as u
+
+"""Gene model caches built so far in this process, keyed by table
+"""
+caches = {}
+
+
+"""One transcript row of refGene with its exon boundaries decoded once
+"""
+class Transcript(object):
+    def __init__(self, row):
+        self.row = row
+        self.strand = str(row[3])
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        exonsSt = str(row[9].decode("utf-8")).split(',')
+        exonsEn = str(row[10].decode("utf-8")).split(',')
+        self.exonStarts = np.array([int(x) for x in exonsSt[0:self.exonCount]],
+            dtype=np.int64)
+        self.exonEnds = np.array([int(x) for x in exonsEn[0:self.exonCount]],
+            dtype=np.int64)
+        self.sortedExons = bool(np.all(np.diff(self.exonStarts) >= 0) and
+            np.all(np.diff(self.exonEnds) >= 0))
+
+    """Zero based indices of the exons containing pos, in ascending order
+    """
+    def exonsAt(self, pos):
+        if self.sortedExons:
+            lo = int(np.searchsorted(self.exonEnds, pos, side='left'))
+            hi = int(np.searchsorted(self.exonStarts, pos, side='right'))
+            return range(lo, max(lo, hi))
+        hits = (self.exonStarts <= pos) & (pos <= self.exonEnds)
+        return [int(e) for e in np.nonzero(hits)[0]]
+
+
+"""Transcripts of a gene table, loaded one chromosome at a time (from the
+   database, or from a column store if one is given) into interval
+   partitions over [txStart, txEnd]
+"""
+class GeneModels(object):
+    def __init__(self, table='refGene', store=None):
+        self.table = table
+        self.store = store
+        self.partitions = {}
+
+    def load(self, chrom):
+        if self.store is not None:
+            partition = self.store.partition(self.table, chrom)
+            rows = partition.rows() if (partition is not None) else []
+        else:
+            sql = 'select * from ' + self.table + ' where chrom="' + \
+                str(chrom) + '";'
+            with u.db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(sql)
+                rows = cursor.fetchall()
+
+        transcripts = [Transcript(row) for row in rows]
+        return ii.Partition(starts=[t.txStart for t in transcripts],
+            ends=[t.txEnd for t in transcripts], rows=transcripts)
+
+    """Transcripts for which (txStart - offset) <= pos <= (txEnd + offset),
+       in the order the table returned them
+    """
+    def around(self, chrom, pos, offset=0):
+        if chrom not in self.partitions:
+            self.partitions[chrom] = self.load(chrom)
+        return self.partitions[chrom].overlap(int(pos) - int(offset),
+            int(pos) + int(offset))
+
+
+"""Returns the process-wide gene model cache for a table (and store)
+"""
+def getGeneModels(table='refGene', store=None):
+    key = (table, None if (store is None) else store.root)
+    if key not in caches:
+        caches[key] = GeneModels(table, store=store)
+    return caches[key]
+
+### EOF
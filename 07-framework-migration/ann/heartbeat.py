@@ -0,0 +1,102 @@
+# heartbeat.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Visibility heartbeat of the SQS messages of annotation jobs
+#
+# The message of a job stays in the queue until the job has finished, and
+# is kept hidden from other instances while the job is in progress here by
+# extending its visibility timeout every 'interval' seconds. If the
+# instance dies (or is scaled in), the extensions stop and the message is
+# delivered again once its timeout runs out, so a job is neither lost nor
+# run by two instances at the same time.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import threading
+from botocore.exceptions import ClientError
+
+
+"""Extends the visibility timeout of the messages of jobs in progress
+   from a background thread, until they are deleted or released
+"""
+class Heartbeat(object):
+    def __init__(self, timeout=300, interval=60):
+        self.timeout = timeout
+        self.interval = interval
+        self.messages = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = False
+        self.thread = None
+
+    """Keeps the message of job_id hidden; a message of the job delivered
+       again replaces the one before
+    """
+    def track(self, job_id, message):
+        with self.lock:
+            self.messages[job_id] = message
+        self.wake.set()
+
+    def isTracked(self, job_id):
+        with self.lock:
+            return job_id in self.messages
+
+    """Stops extending the message of job_id, which becomes visible again
+       when its timeout runs out; returns the message
+    """
+    def forget(self, job_id):
+        with self.lock:
+            return self.messages.pop(job_id, None)
+
+    """Deletes the message of a job that has finished
+    """
+    def delete(self, job_id):
+        message = self.forget(job_id)
+        if message is None:
+            return
+        try:
+            message.delete()
+        except ClientError as e:
+            print("Failure to delete message from the queue", e.response['Error']['Message'])
+
+    """Makes the message of a job given up here visible again at once
+    """
+    def release(self, job_id):
+        message = self.forget(job_id)
+        if message is None:
+            return
+        try:
+            message.change_visibility(VisibilityTimeout=0)
+        except ClientError as e:
+            print("Failure to return message to the queue", e.response['Error']['Message'])
+
+    """Extends the visibility timeout of every tracked message
+    """
+    def beat(self):
+        with self.lock:
+            messages = list(self.messages.items())
+        for (job_id, message) in messages:
+            try:
+                message.change_visibility(VisibilityTimeout=self.timeout)
+            except ClientError as e:
+                print(f"Failure to extend message visibility of job {job_id}", e.response['Error']['Message'])
+
+    def run(self):
+        while not self.stopped:
+            self.wake.clear()
+            self.beat()
+            self.wake.wait(self.interval)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wake.set()
+
+### EOF
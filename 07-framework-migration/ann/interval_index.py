@@ -0,0 +1,208 @@
+# interval_index.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# In-memory interval index over AnnTools reference tables
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import heapq
+from collections import deque
+
+import numpy as np
+import pymysql
+
+import utils as u
+
+"""Rows pulled from the server per round trip while sweeping a chromosome
+"""
+SWEEP_FETCH_SIZE = 10000
+
+"""Indexes built so far in this process, keyed by table and columns
+"""
+indexes = {}
+
+
+"""Intervals of one chromosome sorted by start, with the running maximum
+   of the ends so that all intervals containing a point lie in one slice
+"""
+class Partition(object):
+    def __init__(self, starts, ends, rows):
+        order = np.argsort(np.asarray(starts, dtype=np.int64), kind='stable')
+        self.starts = np.asarray(starts, dtype=np.int64)[order]
+        self.ends = np.asarray(ends, dtype=np.int64)[order]
+        self.maxends = np.maximum.accumulate(self.ends) if len(order) > 0 \
+            else self.ends
+        self.order = order
+        self.rows = rows
+
+    """Rows overlapping [start, end], in the order they were loaded
+    """
+    def overlap(self, start, end):
+        hi = int(np.searchsorted(self.starts, end, side='right'))
+        lo = int(np.searchsorted(self.maxends[:hi], start, side='left'))
+        if (lo >= hi):
+            return []
+        hits = self.order[lo:hi][self.ends[lo:hi] >= start]
+        return [self.rows[i] for i in np.sort(hits)]
+
+
+"""Answers 'startColumn <= pos AND pos <= endColumn' lookups for a table
+   from memory. Each chromosome is loaded with a single query the first
+   time it is asked for; chromColumn=None loads the whole table as one
+   partition (e.g. the per-chromosome tfbsConsSites tables)
+"""
+class IntervalIndex(object):
+    def __init__(self, table, chromColumn='chrom', startColumn='chromStart',
+        endColumn='chromEnd', columns='*'):
+        self.table = table
+        self.chromColumn = chromColumn
+        self.startColumn = startColumn
+        self.endColumn = endColumn
+        self.columns = columns
+        self.partitions = {}
+
+    def load(self, chrom):
+        cols = 't.*' if (self.columns == '*') else self.columns
+        sql = 'select ' + self.startColumn + ', ' + self.endColumn + ', ' + \
+            cols + ' from ' + self.table + ' t'
+        if (self.chromColumn is not None):
+            sql = sql + ' where ' + self.chromColumn + '="' + str(chrom) + '"'
+
+        with u.db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql + ';')
+            rows = cursor.fetchall()
+
+        return Partition(starts=[int(r[0]) for r in rows],
+            ends=[int(r[1]) for r in rows], rows=[r[2:] for r in rows])
+
+    def partition(self, chrom):
+        if (self.chromColumn is None):
+            chrom = None
+        if chrom not in self.partitions:
+            self.partitions[chrom] = self.load(chrom)
+        return self.partitions[chrom]
+
+    """Rows containing pos, same as the per-variant SQL query
+    """
+    def query(self, chrom, pos):
+        pos = int(pos)
+        return self.partition(chrom).overlap(pos, pos)
+
+    """Rows overlapping the region [start, end]
+    """
+    def overlap(self, chrom, start, end):
+        return self.partition(chrom).overlap(int(start), int(end))
+
+
+"""Merge-joins a position-sorted variant stream against a table streamed
+   in start order: intervals enter an active heap (keyed by end) once the
+   sweep reaches their start and leave it once it passes their end, so each
+   chromosome is read in one pass. Positions must not decrease between
+   queries on the same chromosome; if they do, or the chromosome changes,
+   the scan restarts. Each row carries its position in an unordered scan
+   of the chromosome, so that matches come back in table scan order, as
+   the index engine returns them (row_number() needs MySQL 8 or SQLite
+   3.25). Neither that order nor the one the mysql engine's per-variant
+   queries return rows in (that of the plan MySQL picks, e.g. an index)
+   is guaranteed, and the reference tables have no key to order by: where
+   several rows overlap a variant, the stages that keep the first one
+   (CNV, genomicSuperDups, miRNA) may report a different row than the
+   mysql engine does
+"""
+class SweepIndex(object):
+    def __init__(self, table, chromColumn='chrom', startColumn='chromStart',
+        endColumn='chromEnd', columns='*', fetch_size=SWEEP_FETCH_SIZE):
+        self.table = table
+        self.chromColumn = chromColumn
+        self.startColumn = startColumn
+        self.endColumn = endColumn
+        self.columns = columns
+        self.fetch_size = fetch_size
+        self.scanning = False
+        self.conn = None
+        self.cursor = None
+
+    def open(self, chrom):
+        self.close()
+        cols = 't.*' if (self.columns == '*') else self.columns
+        sql = 'select ' + self.startColumn + ' as sweep_start, ' + \
+            self.endColumn + ' as sweep_end, row_number() over () ' + \
+            'as sweep_row, ' + cols + ' from ' + self.table + ' t'
+        if (self.chromColumn is not None):
+            sql = sql + ' where ' + self.chromColumn + '="' + str(chrom) + '"'
+        sql = 'select * from (' + sql + ') s order by sweep_start;'
+
+        self.conn = u.pool.acquire()
+        self.cursor = u.CountingCursor(
+            self.conn.cursor(pymysql.cursors.SSCursor))
+        self.cursor.execute(sql)
+        self.scanning = True
+        self.chrom = chrom
+        self.pos = None
+        self.pending = deque()
+        self.active = []
+
+    """Gives the connection back once the scan has been read to the end;
+       a half-read unbuffered result cannot be reused, so it is dropped
+    """
+    def finish(self, exhausted):
+        if (self.conn is not None):
+            if exhausted:
+                self.cursor.close()
+                u.pool.release(self.conn)
+            else:
+                u.pool.discard(self.conn)
+        self.conn = None
+        self.cursor = None
+
+    def close(self):
+        self.finish(exhausted=False)
+        self.scanning = False
+
+    def advance(self, pos):
+        while True:
+            if (len(self.pending) == 0):
+                if (self.cursor is None):
+                    break
+                rows = self.cursor.fetchmany(self.fetch_size)
+                if (len(rows) == 0):
+                    self.finish(exhausted=True)
+                    break
+                self.pending.extend(rows)
+                continue
+            if (int(self.pending[0][0]) > pos):
+                break
+            r = self.pending.popleft()
+            heapq.heappush(self.active, (int(r[1]), int(r[2]), r[3:]))
+
+        while (len(self.active) > 0 and self.active[0][0] < pos):
+            heapq.heappop(self.active)
+
+    """Rows containing pos, same as the per-variant SQL query
+    """
+    def query(self, chrom, pos):
+        pos = int(pos)
+        if (self.chromColumn is None):
+            chrom = None
+        if (not self.scanning or chrom != self.chrom or pos < self.pos):
+            self.open(chrom)
+        self.pos = pos
+        self.advance(pos)
+        return [a[2] for a in sorted(self.active, key=lambda a: a[1])]
+
+
+"""Returns the process-wide index for a table, building it on first use
+"""
+def getIndex(table, chromColumn='chrom', startColumn='chromStart',
+    endColumn='chromEnd', columns='*'):
+    key = (table, chromColumn, startColumn, endColumn, columns)
+    if key not in indexes:
+        indexes[key] = IntervalIndex(table, chromColumn=chromColumn,
+            startColumn=startColumn, endColumn=endColumn, columns=columns)
+    return indexes[key]
+
+### EOF
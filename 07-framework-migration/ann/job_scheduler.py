@@ -0,0 +1,163 @@
+# job_scheduler.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Local scheduler of annotation jobs on an annotator instance
+#
+# At most 'slots' jobs run at once, each a child process; up to
+# queue_size more wait in memory for a slot. A waiting job only starts if
+# the instance has the free memory and disk it needs, so a burst of
+# requests is taken at the rate the instance can annotate instead of all
+# at once. Jobs the scheduler cannot take are left to the caller to hand
+# back (e.g. to SQS).
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import shutil
+import subprocess
+from collections import deque
+
+"""Bytes in a MB, for the settings
+"""
+MB = 1 << 20
+
+
+"""Memory available to new processes, in bytes
+"""
+def freeMemory():
+    try:
+        fh = open('/proc/meminfo')
+        for line in fh:
+            if line.startswith('MemAvailable:'):
+                fh.close()
+                return int(line.split()[1]) * 1024
+        fh.close()
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+"""Free disk space under path (its nearest existing parent), in bytes
+"""
+def freeDisk(path):
+    while not os.path.exists(path):
+        path = os.path.dirname(os.path.normpath(path))
+    return shutil.disk_usage(path).free
+
+
+"""Slots for jobs that each run 'workers' processes (0 = one per core):
+   as many as keep every core busy without oversubscribing them
+"""
+def defaultSlots(workers=1):
+    cores = os.cpu_count() or 1
+    return max(cores // (workers or cores), 1)
+
+
+"""Runs the command line of job in a child process
+"""
+def launchProcess(job):
+    return subprocess.Popen(job.command, shell=True)
+
+
+"""A job to run: its command line (or arguments, for launchers that run
+   it in-process), and functions called with the process when it starts
+   and with its return code when it has exited
+"""
+class Job(object):
+    def __init__(self, job_id, command, onStart=None, onExit=None, args=()):
+        self.job_id = job_id
+        self.command = command
+        self.args = args
+        self.onStart = onStart
+        self.onExit = onExit
+        self.process = None
+
+
+"""launch: function that starts a job and returns its process, or an
+   object polled the same way (e.g. worker_pool.WorkerPool.launch)
+"""
+class JobScheduler(object):
+    def __init__(self, slots=0, queue_size=0, jobs_dir='.',
+        min_free_memory=0, min_free_disk=0, launch=launchProcess):
+        self.slots = slots or defaultSlots()
+        self.launch = launch
+        self.queue_size = queue_size
+        self.jobs_dir = jobs_dir
+        self.min_free_memory = min_free_memory
+        self.min_free_disk = min_free_disk
+        self.queue = deque()
+        self.running = {}
+
+    """Jobs that can be submitted now: free slots plus free queue places
+    """
+    def capacity(self):
+        self.reap()
+        return max(self.slots - len(self.running), 0) + \
+            max(self.queue_size - len(self.queue), 0)
+
+    """Whether the instance has the memory and disk for another job
+    """
+    def admits(self):
+        return (freeMemory() >= self.min_free_memory and
+            freeDisk(self.jobs_dir) >= self.min_free_disk)
+
+    """Takes a job: starts it if a slot is free and the instance admits it,
+       else queues it. Returns False, without taking it, if the queue is
+       full
+    """
+    def submit(self, job):
+        self.reap()
+        if (len(self.queue) >= self.queue_size and
+            (len(self.queue) > 0 or len(self.running) >= self.slots or
+            not self.admits())):
+            return False
+        self.queue.append(job)
+        self.dispatch()
+        return True
+
+    """Starts queued jobs while slots are free and the instance admits
+       them
+    """
+    def dispatch(self):
+        self.reap()
+        while (len(self.queue) > 0 and len(self.running) < self.slots and
+            self.admits()):
+            job = self.queue.popleft()
+            try:
+                job.process = self.launch(job)
+            except OSError as e:
+                print(f"Job {job.job_id} failed to launch: {e}")
+                if job.onExit is not None:
+                    job.onExit(job, None)
+                continue
+            self.running[job.job_id] = job
+            if job.onStart is not None:
+                job.onStart(job)
+
+    """Collects the jobs that have exited
+    """
+    def reap(self):
+        for job_id in list(self.running):
+            job = self.running[job_id]
+            returncode = job.process.poll()
+            if returncode is not None:
+                del self.running[job_id]
+                if job.onExit is not None:
+                    job.onExit(job, returncode)
+
+    def isRunning(self, job_id):
+        self.reap()
+        return (job_id in self.running or
+            any([job.job_id == job_id for job in self.queue]))
+
+    """Jobs that have not started yet, taken off the queue
+    """
+    def drain(self):
+        jobs = list(self.queue)
+        self.queue.clear()
+        return jobs
+
+### EOF
@@ -0,0 +1,239 @@
+# lookup_cache.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Persistent cache of reference database lookups shared by AnnTools jobs
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import time
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+
+"""Hits whose last use is written to the cache file in one statement
+"""
+TOUCH_BATCH = 1000
+
+"""Rows cached for one lookup are keyed by the reference version and the
+   lookup itself (the SQL statement, which names the table and the variant,
+   or a synthetic key such as dbSNP|chr|pos|ref|class). Entries live in a
+   SQLite file on the instance, so later jobs (and the worker processes of
+   one job) reuse them; the least recently used are evicted once the
+   cached rows exceed max_bytes. The last use of entries read is kept in
+   memory and written TOUCH_BATCH at a time (and before an eviction), not
+   on every hit. The threads of a process share one SQLite connection,
+   one statement at a time
+"""
+class LookupCache(object):
+    def __init__(self, path, max_bytes=1 << 30, version=''):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.written = 0
+        self.touched = {}
+        self.db = None
+        self.pid = None
+        self.lock = threading.RLock()
+
+    def connect(self):
+        if (self.db is None or self.pid != os.getpid()):
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.db = sqlite3.connect(self.path, timeout=60,
+                isolation_level=None, check_same_thread=False)
+            self.db.execute('pragma journal_mode=wal;')
+            self.db.execute('pragma synchronous=normal;')
+            self.db.execute('create table if not exists lookups (key text ' + \
+                'primary key, rows blob, size integer, used real);')
+            self.db.execute('create index if not exists lookups_used ' + \
+                'on lookups (used);')
+            self.pid = os.getpid()
+        return self.db
+
+    """Cached rows for key, or None if the lookup has not been seen
+    """
+    def get(self, key):
+        with self.lock:
+            db = self.connect()
+            key = self.version + '|' + key
+            row = db.execute('select rows from lookups where key=?;',
+                (key,)).fetchone()
+            if row is None:
+                self.misses = self.misses + 1
+                return None
+            self.hits = self.hits + 1
+            self.touched[key] = time.time()
+            if (len(self.touched) >= TOUCH_BATCH):
+                self.touch()
+        return pickle.loads(row[0])
+
+    """Writes the last use of the entries read since the previous call
+    """
+    def touch(self):
+        with self.lock:
+            if (len(self.touched) == 0):
+                return
+            touched = [(used, key) for (key, used) in self.touched.items()]
+            self.touched = {}
+            self.connect().executemany(
+                'update lookups set used=? where key=?;', touched)
+
+    def put(self, key, rows):
+        blob = pickle.dumps([tuple(row) for row in rows])
+        with self.lock:
+            db = self.connect()
+            db.execute('insert or replace into lookups values (?, ?, ?, ?);',
+                (self.version + '|' + key, blob, len(blob), time.time()))
+            self.written = self.written + len(blob)
+            if (self.written >= self.max_bytes // 20):
+                self.evict()
+
+    """Drops the least recently used entries until the cache is back
+       under 90% of max_bytes
+    """
+    def evict(self):
+        with self.lock:
+            self.touch()
+            db = self.connect()
+            self.written = 0
+            total = db.execute('select coalesce(sum(size), 0) from lookups;')\
+                .fetchone()[0]
+            if (total <= self.max_bytes):
+                return
+            excess = total - int(self.max_bytes * 0.9)
+            freed = 0
+            cutoff = None
+            for (size, used) in db.execute(
+                'select size, used from lookups order by used;'):
+                freed = freed + size
+                cutoff = used
+                if (freed >= excess):
+                    break
+            db.execute('delete from lookups where used <= ?;', (cutoff,))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self.lock:
+            if (self.db is not None and self.pid == os.getpid()):
+                self.touch()
+                self.db.close()
+            self.db = None
+
+
+"""Lookups kept in memory in front of the persistent cache, if there is
+   one: those of one chunk, shared by the threads annotating it, or the
+   repeated lookups of a whole job. With max_entries > 0 the least
+   recently used are dropped beyond that many
+"""
+class MemoryLookups(object):
+    def __init__(self, cache=None, max_entries=0):
+        self.cache = cache
+        self.max_entries = max_entries
+        self.rows = OrderedDict()
+        self.hits = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            rows = self.rows.get(key)
+            if rows is not None:
+                self.hits = self.hits + 1
+                if (self.max_entries > 0):
+                    self.rows.move_to_end(key)
+                return rows
+        if self.cache is not None:
+            rows = self.cache.get(key)
+            if rows is not None:
+                self.store(key, rows)
+        return rows
+
+    def store(self, key, rows):
+        with self.lock:
+            self.rows[key] = rows
+            if (self.max_entries > 0 and len(self.rows) > self.max_entries):
+                self.rows.popitem(last=False)
+
+    def put(self, key, rows):
+        self.store(key, [tuple(row) for row in rows])
+        if self.cache is not None:
+            self.cache.put(key, rows)
+
+
+"""Cursor that answers a repeated statement from the lookup cache and
+   only sends new ones to the database. The uncached cursor, opened on
+   first use, is raw for statements not worth caching
+"""
+class CachingCursor(object):
+    def __init__(self, conn, cache, args=()):
+        self.conn = conn
+        self.cache = cache
+        self.args = args
+        self.cursor = None
+        self.rows = []
+        self.next = 0
+
+    @property
+    def raw(self):
+        if self.cursor is None:
+            self.cursor = self.conn.connection().cursor(*self.args)
+        return self.cursor
+
+    def execute(self, sql, args=None):
+        key = sql if (args is None) else sql + repr(args)
+        rows = self.cache.get(key)
+        if rows is None:
+            if args is None:
+                self.raw.execute(sql)
+            else:
+                self.raw.execute(sql, args)
+            rows = list(self.raw.fetchall())
+            self.cache.put(key, rows)
+        self.rows = rows
+        self.next = 0
+        return len(rows)
+
+    def fetchone(self):
+        if (self.next >= len(self.rows)):
+            return None
+        self.next = self.next + 1
+        return self.rows[self.next - 1]
+
+    def fetchall(self):
+        rows = self.rows[self.next:]
+        self.next = len(self.rows)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+"""Connection whose cursors go through the lookup cache. The database
+   connection is only opened, by calling connect, for the first statement
+   the cache cannot answer
+"""
+class CachingConnection(object):
+    def __init__(self, connect, cache):
+        self.connect = connect
+        self.cache = cache
+        self.conn = None
+
+    def connection(self):
+        if self.conn is None:
+            self.conn = self.connect()
+        return self.conn
+
+    def cursor(self, *args):
+        return CachingCursor(self, self.cache, args)
+
+    def __getattr__(self, name):
+        return getattr(self.connection(), name)
+
+### EOF
@@ -0,0 +1,105 @@
+# profiling.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Per-stage metrics for AnnTools runs
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import time
+
+import utils as u
+
+"""Meters read before and after every record a stage produces
+"""
+METERS = ['wall_time', 'cpu_time', 'sql_queries', 'rows_fetched']
+
+
+def snapshot():
+    with u.stats_lock:
+        return (time.perf_counter(), time.process_time(),
+            u.db_stats['queries'], u.db_stats['rows'])
+
+
+"""Metrics of one stage (or of the input file). The meters are inclusive:
+   they also cover the time the stage spent pulling records from the
+   stage before it, which report() takes out again
+"""
+class StageProfile(object):
+    def __init__(self, name):
+        self.name = name
+        self.totals = [0] * len(METERS)
+        self.records = 0
+        self.bytes_out = 0
+
+    def add(self, start):
+        end = snapshot()
+        for i in range(0, len(METERS)):
+            self.totals[i] = self.totals[i] + (end[i] - start[i])
+
+    """Exclusive metrics given the profile of the stage's input
+    """
+    def report(self, upstream):
+        report = {'stage': self.name}
+        for i in range(0, len(METERS)):
+            report[METERS[i]] = self.totals[i] - upstream.totals[i]
+        report['records'] = self.records
+        report['bytes_read'] = upstream.bytes_out
+        report['bytes_written'] = self.bytes_out
+        return report
+
+
+"""Passes lines through, metering each record into profile
+"""
+def profiled(lines, profile):
+    lines = iter(lines)
+    while True:
+        start = snapshot()
+        try:
+            line = next(lines)
+        except StopIteration:
+            profile.add(start)
+            return
+        profile.add(start)
+        profile.bytes_out = profile.bytes_out + len(line) + \
+            (0 if line.endswith('\n') else 1)
+        if not line.startswith('#'):
+            profile.records = profile.records + 1
+        yield line
+
+
+"""Name of a stage in reports: its function, and its table if it has one
+"""
+def stageName(stage, kwargs):
+    name = stage.__name__.replace('stream', '', 1)
+    if ('table' in kwargs):
+        name = name + ':' + kwargs['table']
+    return name
+
+
+"""Adds up the reports of the same stages over several shards
+"""
+def mergeReports(reportsList):
+    merged = [dict(report) for report in reportsList[0]]
+    for reports in reportsList[1:]:
+        for i in range(0, len(reports)):
+            for key in reports[i]:
+                if (key != 'stage'):
+                    merged[i][key] = merged[i][key] + reports[i][key]
+    return merged
+
+
+"""Writes the job metrics and the per-stage reports as JSON
+"""
+def writeProfile(outfile, reports, **job):
+    profile = dict(job)
+    profile['stages'] = reports
+    fh = open(outfile, 'w')
+    json.dump(profile, fh, indent=2)
+    fh.write('\n')
+    fh.close()
+
+### EOF
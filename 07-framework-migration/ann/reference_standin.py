@@ -0,0 +1,276 @@
+# reference_standin.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Local SQLite stand-in of the annotator reference database, for
+# benchmarks and development without the RDS instance
+#
+# The tables have the names and columns the annotation stages query, and
+# synthetic rows at a fixed density per kilobase over the hg19
+# chromosomes shrunk by 'scale' (1000: chr1 is 249kb), so every stage
+# does work proportional to the input without a multi-GB database.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import random
+import sqlite3
+
+import utils as u
+
+"""hg19 chromosome lengths
+"""
+HG19 = [('1', 249250621), ('2', 243199373), ('3', 198022430),
+    ('4', 191154276), ('5', 180915260), ('6', 171115067), ('7', 159138663),
+    ('8', 146364022), ('9', 141213431), ('10', 135534747),
+    ('11', 135006516), ('12', 133851895), ('13', 115169878),
+    ('14', 107349540), ('15', 102531392), ('16', 90354753), ('17', 81195210),
+    ('18', 78077248), ('19', 59128983), ('20', 63025520), ('21', 48129895),
+    ('22', 51304566), ('X', 155270560), ('Y', 59373566)]
+
+"""Times the chromosomes are shrunk by default
+"""
+SCALE = 1000
+
+"""Rows per kilobase of (shrunk) chromosome of each table, and the longest
+   interval of the region tables
+"""
+DENSITY = {'dbSNP': 20.0, 'bigRefGene': 7.5, 'refGene': 1.5,
+    'cpgIslandExt': 2.0, 'gadAll': 2.0, 'gwasCatalog': 7.5,
+    'targetScanS': 4.0, 'hugo': 2.0, 'cnv': 1.0, 'genomicSuperDups': 1.5,
+    'tfbsConsSites': 1.5}
+SPAN = {'cpgIslandExt': 3000, 'gadAll': 4000, 'targetScanS': 30,
+    'hugo': 6000, 'cnv': 5000, 'genomicSuperDups': 5000,
+    'tfbsConsSites': 20}
+
+BASES = 'ACGT'
+
+BIG_REF_GENE_COLUMNS = ['chr', 'start', 'end', 'haplotypeReference',
+    'haplotypeAlternate', 'name', 'name2', 'transcriptStrand',
+    'positionType', 'frame', 'mrnaCoord', 'codonCoord', 'spliceDist',
+    'referenceCodon', 'referenceAA', 'variantCodon', 'variantAA',
+    'changesAA', 'functionalClass', 'codingCoordStr', 'proteinCoordStr',
+    'inCodingRegion', 'spliceInfo', 'uorfChange']
+
+CNV_TABLES = ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+    'conrad_Cnv']
+
+
+"""(name, length) of every chromosome shrunk by scale
+"""
+def chromLengths(scale=SCALE):
+    return [(chr, max(length // scale, 1000)) for (chr, length) in HG19]
+
+
+"""Number of rows of a table for a chromosome of length bases
+"""
+def rowCount(table, length, density=1.0):
+    return max(int(DENSITY[table] * density * length / 1000), 1)
+
+
+"""Random intervals of a table on one chromosome: (start, end, i)
+"""
+def intervals(rng, table, length, density=1.0):
+    return [(s, s + rng.randint(0, SPAN[table]), i)
+        for (i, s) in enumerate([rng.randint(1, length)
+            for i in range(0, rowCount(table, length, density))])]
+
+
+"""Creates the stand-in database at path (replacing any previous one)
+"""
+def build(path, scale=SCALE, density=1.0, seed=7):
+    if os.path.exists(path):
+        os.remove(path)
+    rng = random.Random(seed)
+    chroms = chromLengths(scale)
+    db = sqlite3.connect(path)
+
+    # dbSNP: bare chromosome names, REF compared case-insensitively
+    db.execute('create table dbSNP (CHR text collate nocase, POS int, ' + \
+        'x text, RSID text, REF text collate nocase, ALT text, y text, ' + \
+        'MAF text, INFO text)')
+    for (chr, length) in chroms:
+        rows = []
+        for i in range(0, rowCount('dbSNP', length, density)):
+            ref = rng.choice(BASES)
+            rows.append((chr, rng.randint(1, length), 'x',
+                'rs' + str(rng.randint(1, 10 ** 8)), ref, rng.choice(BASES),
+                'y', rng.choice(['.', '0.01', '0.2']),
+                rng.choice(['SNV', 'SNV', 'SNV', 'DIV'])))
+        db.executemany('insert into dbSNP values (?,?,?,?,?,?,?,?,?)', rows)
+
+    # Precomputed consequences of every base change (bigRefGene)
+    columns = ', '.join(['id int'] + [('CHR' if c == 'chr' else c) + \
+        (' int' if c in ('start', 'end') else ' text collate nocase')
+        for c in BIG_REF_GENE_COLUMNS])
+    for table in ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+        'chrom_pos_unequal']:
+        db.execute('create table ' + table + ' (' + columns + ')')
+        for (chr, length) in chroms:
+            rows = []
+            for i in range(0, rowCount('bigRefGene', length, density)):
+                start = rng.randint(1, length)
+                end = start if (table != 'chrom_pos_unequal') else \
+                    start + rng.randint(0, 300)
+                rows.append([i, chr, start, end, rng.choice(BASES),
+                    rng.choice(BASES), 'NM_' + str(i), 'G' + str(i),
+                    rng.choice('+-'), rng.choice(['CDS', 'intron', 'utr5',
+                    'utr3', 'non_coding_exon', 'non_coding_intron']),
+                    rng.choice(['0', '1', '2']), str(i), str(i), '0', 'AAA',
+                    'K', 'AAG', 'K', rng.choice(['0', '1']), 'missense',
+                    'c.1', 'p.1', 'true', '', '0'])
+            db.executemany('insert into ' + table + ' values (' + \
+                ','.join('?' * 25) + ')', rows)
+
+    db.execute('create table refGene (bin int, name text, chrom text, ' + \
+        'strand text, txStart int, txEnd int, cdsStart int, cdsEnd int, ' + \
+        'exonCount int, exonStarts blob, exonEnds blob, score int, ' + \
+        'name2 text, cdsStartStat text, cdsEndStat text, exonFrames text)')
+    for (chr, length) in chroms:
+        rows = []
+        for i in range(0, rowCount('refGene', length, density)):
+            start = rng.randint(1, max(length - 5000, 1))
+            exons = rng.randint(1, 8)
+            points = sorted(rng.sample(range(start, start + 5000), 2 * exons))
+            starts = points[0::2]
+            ends = points[1::2]
+            if (rng.random() < 0.2):
+                # Non-coding
+                cdsStart = cdsEnd = ends[-1]
+            else:
+                cdsStart = rng.randint(starts[0], ends[-1])
+                cdsEnd = rng.randint(cdsStart, ends[-1])
+            rows.append((0, 'NM_' + str(i), 'chr' + chr, rng.choice('+-'),
+                starts[0], ends[-1], cdsStart, cdsEnd, exons,
+                (','.join(map(str, starts)) + ',').encode(),
+                (','.join(map(str, ends)) + ',').encode(), 0,
+                'GENE' + str(i), 'cmpl', 'cmpl', ''))
+        db.executemany('insert into refGene values (' + \
+            ','.join('?' * 16) + ')', rows)
+
+    db.execute('create table cytoBand (chrom text, chromStart int, ' + \
+        'chromEnd int, name text, gieStain text)')
+    for (chr, length) in chroms:
+        rows = []
+        start = 0
+        while (start < length):
+            end = start + rng.randint(5000, 20000)
+            rows.append(('chr' + chr, start, end, 'p' + str(len(rows)),
+                'gneg'))
+            start = end
+        db.executemany('insert into cytoBand values (?,?,?,?,?)', rows)
+
+    db.execute('create table cpgIslandExt (bin int, chrom text, ' + \
+        'chromStart int, chromEnd int, name text, length int)')
+    db.execute('create table gadAll (id int, chromosome text, ' + \
+        'chromStart int, geneSymbol text, chromEnd int)')
+    db.execute('create table gwasCatalog (bin int, chrom text, ' + \
+        'chromStart int, chromEnd int, name text, pubMedID int, a text, ' + \
+        'b text, c text, d text, trait text)')
+    db.execute('create table targetScanS (bin int, chrom text, ' + \
+        'chromStart int, chromEnd int, name text, score int, strand text)')
+    db.execute('create table hugo (bin int, chrom text, chromStart int, ' + \
+        'chromEnd int, x text, symbol text, fullname text)')
+    for table in CNV_TABLES:
+        db.execute('create table ' + table + ' (bin int, chrom text, ' + \
+            'chromStart int, chromEnd int, name text)')
+    db.execute('create table genomicSuperDups (bin int, chrom text, ' + \
+        'chromStart int, chromEnd int, name text, score int, strand text, ' + \
+        'otherChrom text, otherStart int, otherEnd int)')
+    for (chr, length) in HG19:
+        db.execute('create table tfbsConsSites' + chr + ' (bin int, ' + \
+            'chrom text, chromStart int, chromEnd int, name text, score int)')
+
+    for (chr, length) in chroms:
+        db.executemany('insert into cpgIslandExt values (?,?,?,?,?,?)',
+            [(0, 'chr' + chr, s, e, 'CpG: ' + str(i), e - s)
+            for (s, e, i) in intervals(rng, 'cpgIslandExt', length, density)])
+        db.executemany('insert into gadAll values (?,?,?,?,?)',
+            [(i, chr, s, 'GAD' + str(i % 50), e)
+            for (s, e, i) in intervals(rng, 'gadAll', length, density)])
+        db.executemany('insert into gwasCatalog values (?,?,?,?,?,?,?,?,?,?,?)',
+            [(0, 'chr' + chr, pos - 1, pos, 'rs' + str(i), 1000 + i, '', '',
+            '', '', 'trait ' + str(i)) for pos in [rng.randint(1, length)
+            for i in range(0, rowCount('gwasCatalog', length, density))]])
+        db.executemany('insert into targetScanS values (?,?,?,?,?,?,?)',
+            [(0, 'chr' + chr, s, e, 'miR-' + str(i), 90, '+')
+            for (s, e, i) in intervals(rng, 'targetScanS', length, density)])
+        db.executemany('insert into hugo values (?,?,?,?,?,?,?)',
+            [(0, 'chr' + chr, s, e, '', 'SYM' + str(i % 80),
+            'name; ' + str(i % 80))
+            for (s, e, i) in intervals(rng, 'hugo', length, density)])
+        for table in CNV_TABLES:
+            db.executemany('insert into ' + table + ' values (?,?,?,?,?)',
+                [(0, 'chr' + chr, s, e, table + str(i))
+                for (s, e, i) in intervals(rng, 'cnv', length, density)])
+        db.executemany('insert into genomicSuperDups values ' + \
+            '(?,?,?,?,?,?,?,?,?,?)', [(0, 'chr' + chr, s, e, 'sd' + str(i),
+            0, '+', 'chr2', s + 7, e + 7)
+            for (s, e, i) in intervals(rng, 'genomicSuperDups', length,
+            density)])
+        db.executemany('insert into tfbsConsSites' + chr + \
+            ' values (?,?,?,?,?,?)', [(0, 'chr' + chr, s, e,
+            'V$TF' + str(i), 800)
+            for (s, e, i) in intervals(rng, 'tfbsConsSites', length,
+            density)])
+
+    # Indexes on the columns the stages search by, as in the reference
+    # database
+    indexes = [('dbSNP', 'CHR, POS'), ('refGene', 'chrom, txStart'),
+        ('cytoBand', 'chrom, chromStart'), ('cpgIslandExt', 'chrom, chromStart'),
+        ('gadAll', 'chromosome, chromStart'), ('gwasCatalog', 'chrom, chromEnd'),
+        ('targetScanS', 'chrom, chromStart'), ('hugo', 'chrom, chromStart'),
+        ('genomicSuperDups', 'chrom, chromStart')] + \
+        [(table, 'CHR, start') for table in ['chrom_pos_equal_base',
+        'chrom_pos_equal_nobase', 'chrom_pos_unequal']] + \
+        [(table, 'chrom, chromStart') for table in CNV_TABLES] + \
+        [('tfbsConsSites' + chr, 'chromStart') for (chr, length) in HG19]
+    for (table, columns) in indexes:
+        db.execute('create index ix_' + table + ' on ' + table + \
+            ' (' + columns + ')')
+    db.commit()
+    db.close()
+    return path
+
+
+"""Connection to the stand-in with the parts of the pymysql connection
+   interface the annotator uses
+"""
+class StandInConnection(object):
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+
+    # Cursor classes (e.g. pymysql's SSCursor) do not apply
+    def cursor(self, *args):
+        return self.db.cursor()
+
+    def ping(self, reconnect=True):
+        pass
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+"""Makes the annotator connect to the stand-in at path instead of RDS
+"""
+def use(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No reference stand-in at {path}")
+    u.set_connection_factory(lambda: StandInConnection(path))
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1):
+        build(sys.argv[1], scale=int(sys.argv[2]) if (len(sys.argv) > 2)
+            else SCALE)
+        print(f"Reference stand-in written to {sys.argv[1]}")
+    else:
+        print("Usage: python reference_standin.py <database> [<scale>]")
+
+### EOF
@@ -11,9 +11,13 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import sys
 import time
 import driver
+import utils
+import s3_transfer
 import boto3
 from botocore.exceptions import ClientError
 import os
+import json
+import threading
 
 # Get configuration
 from configparser import ConfigParser
@@ -24,6 +28,35 @@ config.read('ann_config.ini')
 REGION = config["aws"]["region_name"]
 PATH = config["file_system"]["path"]
 
+"""Exit code of a job whose results could not be published: it is handed
+   back to SQS to be run again rather than marked FAILED (see annotator.py)
+"""
+RETRY_EXIT_CODE = 75
+
+
+"""Raised when results of a job could not be uploaded; its files are kept
+"""
+class PublishError(Exception):
+    pass
+
+
+"""Identity of a running process, (boot id, start time in clock ticks
+   since boot), or (None, None) if there is no process with that pid.
+   Unlike the pid alone it is not taken by another process after a reboot
+"""
+def process_identity(pid):
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as boot_file:
+            boot_id = boot_file.read().strip()
+        with open(f"/proc/{pid}/stat") as stat_file:
+            stat = stat_file.read()
+        # Fields after the command name, which may hold spaces; the start
+        # time is field 22 of the whole line
+        return (boot_id, int(stat[stat.rindex(")") + 2:].split()[19]))
+    except (OSError, ValueError, IndexError):
+        return (None, None)
+
+
 """A rudimentary timer for coarse-grained profiling
 """
 class Timer(object):
@@ -40,68 +73,170 @@ class Timer(object):
         if self.verbose:
             print(f"Approximate runtime: {self.secs:.2f} seconds")
 
+"""AWS clients, created once per process and thread (boto3 sessions and
+   resources must not be shared between threads) and reused by every job
+"""
+clients = threading.local()
+
+
+def get_client(service):
+    if not hasattr(clients, service):
+        if not hasattr(clients, 'session'):
+            clients.session = boto3.session.Session()
+        if service == 'dynamodb':
+            setattr(clients, service, clients.session.resource('dynamodb', region_name=REGION))
+        else:
+            setattr(clients, service, clients.session.client(service, region_name=REGION))
+    return getattr(clients, service)
+
+
+"""Opens the AWS clients and a reference database connection ahead of the
+   first job of a long-lived worker (see worker_pool.py)
+"""
+def warm_up():
+    s3_transfer.client()
+    get_client('dynamodb')
+    utils.pool.release(utils.pool.acquire())
+
+
+"""Call the AnnTools pipeline on input_file_path
+"""
+def annotate(input_file_path):
+    with Timer():
+        driver.run(input_file_path, 'vcf', 
+            dbsnp_batch_size=int(config["ann"]["dbsnp_batch_size"]),
+            engine=config["ann"]["engine"],
+            fused=config.getboolean("ann", "fused"),
+            workers=int(config["ann"]["workers"]),
+            shard_size=int(config["ann"]["shard_size"]),
+            presorted=(None if config["ann"]["presorted"] == "auto"
+                else config.getboolean("ann", "presorted")),
+            cache_path=config["ann"]["lookup_cache"],
+            cache_size=int(config["ann"]["lookup_cache_size_mb"]) << 20,
+            reference_version=config["ann"]["reference_version"],
+            snapshot_path=config["snapshot"]["path"],
+            concurrent_chunk_size=int(config["ann"]["concurrent_chunk_size"]),
+            async_in_flight=int(config["ann"]["async_in_flight"]),
+            dedup=(None if config["ann"]["dedup"] == "auto"
+                else config.getboolean("ann", "dedup")),
+            dedup_entries=int(config["ann"]["dedup_entries"]),
+            compress_output=config.getboolean("ann", "compress_output"),
+            index_output=config.getboolean("ann", "index_output"),
+            checkpoint=config.getboolean("ann", "checkpoint"))
+
+
+"""Runs an annotation job: annotates the input, uploads the results and
+   log files, and marks the job COMPLETED. Called in-process by the
+   workers of worker_pool.py, or through the command line below
+"""
+def run_job(input_file_path, job_id, input_file, user_id):
+    annotate_job(input_file_path, job_id, input_file, user_id)
+    try:
+        publish_results(job_id, input_file, user_id)
+    except PublishError as e:
+        print(e)
+        sys.exit(RETRY_EXIT_CODE)
+
+
+"""The annotation of a job, without publishing its results
+"""
+def annotate_job(input_file_path, job_id, input_file, user_id):
+    # Record the job while it runs, so that an annotator restarted after
+    # a crash or reboot can resume it from its checkpoint, or publish its
+    # results once it is annotated (see annotator.py); the pid is recorded
+    # with the boot and start time of its process
+    (boot_id, start_time) = process_identity(os.getpid())
+    job = {"job_id": job_id, "input_file_name": input_file,
+        "user_id": user_id, "pid": os.getpid(), "boot_id": boot_id,
+        "start_time": start_time, "annotated": False}
+    write_job_record(input_file_path, job)
+    annotate(input_file_path)
+    job["annotated"] = True
+    write_job_record(input_file_path, job)
+
+
+"""Replaces the job.json next to input_file_path, atomically
+"""
+def write_job_record(input_file_path, job):
+    path = os.path.join(os.path.dirname(input_file_path), "job.json")
+    with open(path + ".tmp", 'w') as job_file:
+        json.dump(job, job_file)
+    os.replace(path + ".tmp", path)
+
+
+"""Uploads the results and log files of an annotated job and marks it
+   COMPLETED. Raises PublishError, leaving the job's files and status as
+   they are, if a file could not be uploaded
+"""
+def publish_results(job_id, input_file, user_id):
+    input_file_name = input_file.split(".")[0] # Remove .vcf extension
+    # Results are named .annot.vcf.gz when compressed
+    results_ext = ".annot.vcf.gz" \
+        if config.getboolean("ann", "compress_output") else ".annot.vcf"
+
+    # (1) Upload the results and log files to S3 results bucket
+    # Referred to upload_file(Filename, Bucket, Key, ExtraArgs, Config)
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.upload_file
+    if os.path.exists(PATH + job_id):
+        all_files = os.listdir(PATH + job_id)
+        results = []
+        for file in all_files:
+            if file.endswith("annot.vcf") or file.endswith("annot.vcf.gz") \
+                or file.endswith("annot.vcf.gz.tbi") \
+                or file.endswith("count.log") \
+                or file.endswith("profile.json"):
+                results.append((PATH + job_id + "/" + file,
+                                config["s3"]["key_prefix"] + f'{user_id}/{job_id}~{file}'))
+        # All files at the same time, each large one in parallel parts (see s3_transfer.py)
+        failed = s3_transfer.uploadFiles(results, config["s3"]["results_bucket"],
+                                         acl=config["s3"]["acl"])
+        for (path, error) in failed:
+            print("Failure to upload annotation files to S3. ", error)
+        if len(failed) > 0:
+            raise PublishError(f"{len(failed)} of {len(results)} result files of job {job_id} not uploaded")
+        # Remove results, log and input files from directory
+        for file in all_files:
+            os.remove(PATH + job_id + "/" + file)
+
+    # (2) Update job item in DynamoDB table
+    client = get_client('dynamodb')
+    try:
+        # https://stackoverflow.com/questions/51048477/how-to-update-several-attributes-of-an-item-in-dynamodb-using-boto3
+        table = client.Table(config["dynamodb"]["table_name"]) 
+        table.update_item(
+                        Key={"job_id": job_id},
+                        ConditionExpression= "job_status = :current_status",
+                        UpdateExpression="SET s3_results_bucket= :results_bucket, s3_key_result_file= :results_file, \
+                                        s3_key_log_file= :log_file, complete_time= :compl_time, job_status= :job_st",
+                        ExpressionAttributeValues={
+                                                ':current_status': 'RUNNING',
+                                                ':results_bucket': config["s3"]["results_bucket"], 
+                                                ':results_file': config["s3"]["key_prefix"] + \
+                                                    f'{user_id}/{job_id}~{input_file_name}{results_ext}',
+                                                ':log_file': config["s3"]["key_prefix"] + \
+                                                    f'{user_id}/{job_id}~{input_file_name}.vcf.count.log',
+                                                ':compl_time': int(time.time()),
+                                                ':job_st': 'COMPLETED'
+                                                },
+                        ReturnValues="UPDATED_NEW")
+    except ClientError as e:
+        print("Failure to update the database to COMPLETED.", e.response['Error']['Message'])
+
+    # (3) Remove empty directory
+    # https://wellsr.com/python/python-delete-all-files-in-folder/
+    os.rmdir(PATH + job_id)
+
+
 if __name__ == '__main__':
     # Call the AnnTools pipeline
-    if len(sys.argv) > 1:
-        with Timer():
-            driver.run(sys.argv[1], 'vcf')
+    if len(sys.argv) > 5 and sys.argv[5] == "annotate":
+        # Annotate only; the annotator publishes the results (see annotator.py)
+        annotate_job(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
+    elif len(sys.argv) > 4:
         # Retrieve input_file and job_id from command line arguments (run by the subprocess)
-        job_id = sys.argv[2]
-        input_file = sys.argv[3]
-        user_id = sys.argv[4]
-        input_file_name = input_file.split(".")[0] # Remove .vcf extension
-
-        # (1) Upload the results and log files to S3 results bucket
-        # Referred to put_object(**kwargs)
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.put_object
-        if os.path.exists(PATH + job_id):
-            all_files = os.listdir(PATH + job_id)
-            for file in all_files:
-                if file.endswith("annot.vcf") or file.endswith("count.log"):
-                    try:
-                        # https://www.radishlogic.com/aws/s3/how-to-upload-a-local-file-to-s3-bucket-using-boto3-and-python/
-                        with open(PATH + job_id + "/" + file, 'rb') as data:
-                            client = boto3.client('s3', region_name=REGION)
-                            client.put_object(
-                                            ACL=config["s3"]["acl"],
-                                            Body=data,
-                                            Bucket=config["s3"]["results_bucket"],
-                                            Key= config["s3"]["key_prefix"] + f'{user_id}/{job_id}~{file}')
-                    except ClientError as e:
-                        print("Failure to upload annotation files to S3. ", e.response['Error']['Message'])
-                    # Remove results and log files from directory
-                    os.remove(PATH + job_id + "/" + file)
-                else:
-                    os.remove(PATH + job_id + "/" + file) # Remove input file
-
-        # (2) Update job item in DynamoDB table
-        client = boto3.resource('dynamodb', region_name=REGION)
-        try:
-            # https://stackoverflow.com/questions/51048477/how-to-update-several-attributes-of-an-item-in-dynamodb-using-boto3
-            table = client.Table(config["dynamodb"]["table_name"]) 
-            table.update_item(
-                            Key={"job_id": job_id},
-                            ConditionExpression= "job_status = :current_status",
-                            UpdateExpression="SET s3_results_bucket= :results_bucket, s3_key_result_file= :results_file, \
-                                            s3_key_log_file= :log_file, complete_time= :compl_time, job_status= :job_st",
-                            ExpressionAttributeValues={
-                                                    ':current_status': 'RUNNING',
-                                                    ':results_bucket': config["s3"]["results_bucket"], 
-                                                    ':results_file': config["s3"]["key_prefix"] + \
-                                                        f'{user_id}/{job_id}~{input_file_name}.annot.vcf',
-                                                    ':log_file': config["s3"]["key_prefix"] + \
-                                                        f'{user_id}/{job_id}~{input_file_name}.vcf.count.log',
-                                                    ':compl_time': int(time.time()),
-                                                    ':job_st': 'COMPLETED'
-                                                    },
-                            ReturnValues="UPDATED_NEW")
-        except ClientError as e:
-            print("Failure to update the database to COMPLETED.", e.response['Error']['Message'])
-
-        # (3) Remove empty directory
-        # https://wellsr.com/python/python-delete-all-files-in-folder/
-        os.rmdir(PATH + job_id)
-
-else:
+        run_job(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
+    elif len(sys.argv) > 1:
+        annotate(sys.argv[1])
+    else:
         print("A valid .vcf file must be provided as input to this program.")
 ### EOF
\ No newline at end of file
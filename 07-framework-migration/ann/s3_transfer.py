@@ -0,0 +1,90 @@
+# s3_transfer.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# S3 transfers of annotation inputs, results and reference snapshots
+#
+# One S3 client per process, with a connection pool sized for concurrent
+# transfers, and one TransferConfig: objects above the multipart threshold
+# are uploaded as multipart uploads and downloaded as ranged GETs, several
+# parts at a time, so that multi-GB inputs and results move at the
+# bandwidth of the instance rather than that of a single connection.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+# Get configuration
+config = ConfigParser(os.environ)
+config.read('ann_config.ini')
+
+MB = 1 << 20
+
+"""Files uploadFiles sends at the same time
+"""
+PARALLEL_FILES = 4
+
+"""Parts of one object in flight at the same time
+"""
+MAX_CONCURRENCY = config.getint('s3', 'max_concurrency', fallback=16)
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=config.getint('s3', 'multipart_threshold_mb', fallback=64) * MB,
+    multipart_chunksize=config.getint('s3', 'multipart_chunksize_mb', fallback=64) * MB,
+    max_concurrency=MAX_CONCURRENCY,
+    use_threads=True)
+
+cached = None
+lock = threading.Lock()
+
+
+"""The S3 client of this process, created on first use. Clients are
+   thread-safe, but a forked process creates its own
+"""
+def client():
+    global cached
+    with lock:
+        if cached is None or cached[0] != os.getpid():
+            session = boto3.session.Session()
+            cached = (os.getpid(), session.client('s3',
+                region_name=config.get('aws', 'region_name', fallback='us-east-1'),
+                config=Config(max_pool_connections=MAX_CONCURRENCY * PARALLEL_FILES)))
+        return cached[1]
+
+
+"""Uploads the file at path to bucket/key, in parallel parts if it is
+   above the multipart threshold
+"""
+def upload(path, bucket, key, acl=None):
+    client().upload_file(path, bucket, key,
+        ExtraArgs={'ACL': acl} if acl else None, Config=TRANSFER_CONFIG)
+
+
+"""Uploads files, a list of (path, key), to bucket at the same time;
+   returns the (path, exception) of those that failed
+"""
+def uploadFiles(files, bucket, acl=None):
+    with ThreadPoolExecutor(PARALLEL_FILES) as pool:
+        futures = [(path, pool.submit(upload, path, bucket, key, acl))
+            for (path, key) in files]
+    return [(path, future.exception()) for (path, future) in futures
+        if future.exception() is not None]
+
+
+"""Downloads bucket/key to path, in parallel ranged GETs if it is above
+   the multipart threshold. Raises ClientError (HTTP status 404 if the
+   object does not exist)
+"""
+def download(bucket, key, path):
+    client().download_file(bucket, key, path, Config=TRANSFER_CONFIG)
+
+### EOF
@@ -0,0 +1,471 @@
+# snapshot.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Versioned reference snapshots for offline annotation
+#
+# A snapshot is every reference table the store engine reads, exported per
+# chromosome as columns of .npy arrays (integers as int64, text as a byte
+# heap plus offsets), gzip-compressed, with a manifest listing every file
+# and its SHA-256. Tables are streamed a chunk of rows at a time, so a
+# partition never has to fit in memory. Annotator instances using the
+# store engine sync a snapshot at boot and unpack it into plain .npy files
+# that can be memory-mapped.
+#
+#   python snapshot.py export <version> [<table> ...]
+#   python snapshot.py upload <version>
+#   python snapshot.py sync [<version>]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import hashlib
+from configparser import ConfigParser
+
+import numpy as np
+import pymysql
+
+import file_utils as fu
+import s3_transfer
+import utils as u
+from column_store import ALL
+
+# Get configuration
+config = ConfigParser(os.environ)
+config.read('ann_config.ini')
+
+"""Reference tables in a snapshot: name, chromosome column (None for the
+   per-chromosome tfbsConsSites tables) and the columns the annotator
+   searches positions by. dbSNP is left out: the store engine does not
+   answer dbSNP lookups
+"""
+TABLES = [('refGene', 'chrom', 'txStart', 'txEnd'),
+    ('cpgIslandExt', 'chrom', 'chromStart', 'chromEnd'),
+    ('cytoBand', 'chrom', 'chromStart', 'chromEnd'),
+    ('gadAll', 'chromosome', 'chromStart', 'chromEnd'),
+    ('gwasCatalog', 'chrom', 'chromEnd', 'chromEnd'),
+    ('targetScanS', 'chrom', 'chromStart', 'chromEnd'),
+    ('hugo', 'chrom', 'chromStart', 'chromEnd'),
+    ('dgv_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('abParts_IG_T_CelReceptors', 'chrom', 'chromStart', 'chromEnd'),
+    ('mcCarroll_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('conrad_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('genomicSuperDups', 'chrom', 'chromStart', 'chromEnd'),
+    ('chrom_pos_equal_base', 'CHR', 'start', 'end'),
+    ('chrom_pos_equal_nobase', 'CHR', 'start', 'end'),
+    ('chrom_pos_unequal', 'CHR', 'start', 'end')] + \
+    [('tfbsConsSites' + c, None, 'chromStart', 'chromEnd') for c in
+        [str(i) for i in range(1, 23)] + ['X', 'Y']]
+
+FETCH_SIZE = 50000
+
+
+"""Kind of a column from its non-null values: int, bytes or str
+"""
+def columnKind(values):
+    kinds = set()
+    for v in values:
+        if v is None:
+            continue
+        if isinstance(v, int) and not isinstance(v, bool):
+            kinds.add('int')
+        elif isinstance(v, (bytes, bytearray)):
+            kinds.add('bytes')
+        else:
+            kinds.add('str')
+    if (kinds == set(['int']) or kinds == set()):
+        return 'int'
+    if (kinds == set(['bytes'])):
+        return 'bytes'
+    return 'str'
+
+
+"""Arrays for one column: int64 values, or a uint8 heap with int64
+   offsets for text; plus a null mask if the column has nulls
+"""
+def columnArrays(values, kind):
+    arrays = {}
+    nulls = np.array([v is None for v in values], dtype=bool)
+    if (kind == 'int'):
+        arrays['values'] = np.array([0 if v is None else int(v)
+            for v in values], dtype=np.int64)
+    else:
+        encoded = [b'' if v is None else (bytes(v) if (kind == 'bytes')
+            else str(v).encode('utf-8')) for v in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+        arrays['offsets'] = offsets
+        arrays['heap'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    if nulls.any():
+        arrays['nulls'] = nulls
+    return arrays
+
+
+"""File object that passes writes on to fh and hashes what it writes
+"""
+class HashingWriter(object):
+    def __init__(self, fh):
+        self.fh = fh
+        self.digest = hashlib.sha256()
+        self.bytes = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.bytes = self.bytes + len(data)
+        return self.fh.write(data)
+
+    def flush(self):
+        self.fh.flush()
+
+
+"""Writes a .npy file gzip-compressed to path, streamed: write(fh) writes
+   its header and data to fh. Returns its manifest entry
+"""
+def writeCompressed(path, write):
+    fh = open(path, 'wb')
+    hashing = HashingWriter(fh)
+    gz = gzip.GzipFile(filename='', mode='wb', fileobj=hashing, mtime=0)
+    write(gz)
+    gz.close()
+    fh.close()
+    return {'sha256': hashing.digest.hexdigest(), 'bytes': hashing.bytes}
+
+
+"""Writes one array gzip-compressed; returns its manifest entry
+"""
+def writeArray(path, array):
+    return writeCompressed(path,
+        lambda gz: np.save(gz, array, allow_pickle=False))
+
+
+"""Writes the 'count' values of type dtype in the raw file raw as a
+   gzip-compressed .npy file; returns its manifest entry
+"""
+def writeRaw(path, raw, dtype, count):
+    def write(gz):
+        np.lib.format.write_array_header_1_0(gz, {
+            'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            'fortran_order': False, 'shape': (count,)})
+        raw.seek(0)
+        shutil.copyfileobj(raw, gz, 1 << 20)
+    return writeCompressed(path, write)
+
+
+"""Chunks of FETCH_SIZE rows of one partition, in table order, after the
+   column names. The pooled connection goes back to the pool once the
+   rows have all been read, or is closed if reading them failed
+"""
+def fetchPartition(table, chromColumn, chrom):
+    sql = 'select * from ' + table
+    if (chromColumn is not None):
+        sql = sql + ' where ' + chromColumn + '="' + str(chrom) + '"'
+    conn = u.pool.acquire()
+    try:
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+        cursor.execute(sql + ';')
+        yield [d[0] for d in cursor.description]
+        while True:
+            chunk = cursor.fetchmany(FETCH_SIZE)
+            if (len(chunk) == 0):
+                break
+            yield chunk
+        cursor.close()
+    except BaseException:
+        u.pool.discard(conn)
+        raise
+    u.pool.release(conn)
+
+
+"""One column of a partition being exported: the chunks of rows are
+   appended to raw files in the partition directory, which finish()
+   compresses into the snapshot files of the column
+"""
+class ColumnWriter(object):
+    def __init__(self, directory, table, i, name):
+        self.prefix = os.path.join(directory, 'c' + str(i) + '.')
+        self.table = table
+        self.name = name
+        self.kind = None
+        self.rows = 0
+        self.heapSize = 0
+        self.hasNulls = False
+        self.leadingNulls = 0
+        self.raws = {}
+
+    def raw(self, part):
+        if part not in self.raws:
+            self.raws[part] = open(self.prefix + part + '.raw', 'w+b')
+            if (part == 'offsets'):
+                self.raws[part].write(np.zeros(1, dtype=np.int64).tobytes())
+        return self.raws[part]
+
+    """Appends the values of a chunk of rows. The kind of the column is
+       that of its first non-null values; nulls before them are held back
+       until it is known
+    """
+    def add(self, values):
+        if any([v is not None for v in values]):
+            kind = columnKind(values)
+            if self.kind is None:
+                self.kind = kind
+                self.addNulls()
+            elif (kind != self.kind):
+                raise ValueError(f"Column {self.name} of {self.table} " + \
+                    f"holds both {self.kind} and {kind} values")
+        elif self.kind is None:
+            self.leadingNulls = self.leadingNulls + len(values)
+            return
+        self.write(values)
+
+    def addNulls(self):
+        while (self.leadingNulls > 0):
+            count = min(self.leadingNulls, FETCH_SIZE)
+            self.write([None] * count)
+            self.leadingNulls = self.leadingNulls - count
+
+    def write(self, values):
+        arrays = columnArrays(values, self.kind)
+        if ('nulls' in arrays):
+            self.hasNulls = True
+        nulls = arrays.get('nulls', np.zeros(len(values), dtype=bool))
+        self.raw('nulls').write(nulls.tobytes())
+        if (self.kind == 'int'):
+            self.raw('values').write(arrays['values'].tobytes())
+        else:
+            self.raw('offsets').write(
+                (arrays['offsets'][1:] + self.heapSize).tobytes())
+            self.raw('heap').write(arrays['heap'].tobytes())
+            self.heapSize = self.heapSize + len(arrays['heap'])
+        self.rows = self.rows + len(values)
+
+    """Writes the snapshot files of the column and removes the raw ones;
+       returns the column's manifest entry and files
+    """
+    def finish(self):
+        if self.kind is None:
+            self.kind = 'int'
+            self.addNulls()
+        if (self.kind == 'int'):
+            parts = [('values', np.int64, self.rows)]
+        else:
+            parts = [('offsets', np.int64, self.rows + 1),
+                ('heap', np.uint8, self.heapSize)]
+        if self.hasNulls:
+            parts.append(('nulls', bool, self.rows))
+
+        files = {}
+        for (part, dtype, count) in parts:
+            name = os.path.basename(self.prefix) + part + '.npy.gz'
+            files[name] = writeRaw(self.prefix + part + '.npy.gz',
+                self.raw(part), dtype, count)
+        self.close()
+        return ({'name': self.name, 'kind': self.kind}, files)
+
+    def close(self):
+        for part in self.raws:
+            self.raws[part].close()
+            os.remove(self.prefix + part + '.raw')
+        self.raws = {}
+
+
+"""Exports one partition of a table into directory, a chunk of rows at a
+   time; returns the manifest entry of the partition. Besides the columns
+   (c0, c1, ...) it holds the search intervals sorted by start (_starts,
+   _ends, _maxends) and the row of each (_order). Rows without a start or
+   an end are left out of the intervals: no position query matches them
+"""
+def exportPartition(directory, table, chromColumn, startColumn, endColumn,
+    chrom):
+    fu.mkdirp(directory)
+    chunks = fetchPartition(table, chromColumn, chrom)
+    names = next(chunks)
+    writers = [ColumnWriter(directory, table, i, names[i])
+        for i in range(0, len(names))]
+    (startIndex, endIndex) = (names.index(startColumn),
+        names.index(endColumn))
+
+    (starts, ends, known) = ([], [], [])
+    try:
+        for chunk in chunks:
+            for i in range(0, len(names)):
+                writers[i].add([row[i] for row in chunk])
+            starts.append(np.array([0 if (row[startIndex] is None)
+                else int(row[startIndex]) for row in chunk], dtype=np.int64))
+            ends.append(np.array([0 if (row[endIndex] is None)
+                else int(row[endIndex]) for row in chunk], dtype=np.int64))
+            known.append(np.array([(row[startIndex] is not None and
+                row[endIndex] is not None) for row in chunk], dtype=bool))
+        columns = []
+        files = {}
+        for writer in writers:
+            (column, columnFiles) = writer.finish()
+            columns.append(column)
+            files.update(columnFiles)
+    finally:
+        chunks.close()
+        for writer in writers:
+            writer.close()
+
+    starts = np.concatenate([np.zeros(0, dtype=np.int64)] + starts)
+    ends = np.concatenate([np.zeros(0, dtype=np.int64)] + ends)
+    known = np.flatnonzero(np.concatenate([np.zeros(0, dtype=bool)] + known))
+    order = known[np.argsort(starts[known], kind='stable')]
+    maxends = np.maximum.accumulate(ends[order]) if (len(order) > 0) \
+        else ends[order]
+    for (name, array) in [('_starts', starts[order]), ('_ends', ends[order]),
+        ('_maxends', maxends), ('_order', order.astype(np.int64))]:
+        files[name + '.npy.gz'] = writeArray(
+            os.path.join(directory, name + '.npy.gz'), array)
+
+    return {'rows': len(starts), 'columns': columns, 'files': files}
+
+
+"""Exports the reference tables (all of TABLES by default) as snapshot
+   'version' under the export directory and writes its manifest
+"""
+def export(version, tables=None):
+    root = os.path.join(config['snapshot']['export_dir'], version)
+    manifest = {'version': version, 'created': time.strftime(
+        '%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'tables': {}}
+    fu.mkdirp(root)
+
+    for (table, chromColumn, startColumn, endColumn) in TABLES:
+        if (tables and table not in tables):
+            continue
+        if (chromColumn is None):
+            chroms = [ALL]
+        else:
+            with u.db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('select distinct ' + chromColumn + ' from ' +
+                    table + ';')
+                chroms = sorted([str(row[0]) for row in cursor.fetchall()])
+
+        partitions = {}
+        for chrom in chroms:
+            partitions[chrom] = exportPartition(
+                os.path.join(root, table, chrom), table, chromColumn,
+                startColumn, endColumn, chrom)
+        manifest['tables'][table] = {'chromColumn': chromColumn,
+            'startColumn': startColumn, 'endColumn': endColumn,
+            'partitions': partitions}
+        print(f"{table} - {len(chroms)} partitions exported.")
+
+    fh = open(os.path.join(root, 'manifest.json'), 'w')
+    json.dump(manifest, fh, indent=1)
+    fh.close()
+    return manifest
+
+
+"""Relative paths of every file of a snapshot, manifest last
+"""
+def snapshotFiles(manifest):
+    paths = []
+    for table in manifest['tables']:
+        partitions = manifest['tables'][table]['partitions']
+        for chrom in partitions:
+            for name in partitions[chrom]['files']:
+                paths.append((os.path.join(table, chrom, name),
+                    partitions[chrom]['files'][name]))
+    return paths
+
+
+"""Uploads an exported snapshot to the snapshot bucket
+"""
+def upload(version):
+    root = os.path.join(config['snapshot']['export_dir'], version)
+    prefix = config['snapshot']['key_prefix'] + version + '/'
+    fh = open(os.path.join(root, 'manifest.json'))
+    manifest = json.load(fh)
+    fh.close()
+
+    files = [(os.path.join(root, path), prefix + path)
+        for (path, entry) in snapshotFiles(manifest)]
+    failed = s3_transfer.uploadFiles(files, config['snapshot']['bucket'])
+    if (len(failed) > 0):
+        raise failed[0][1]
+    # The manifest goes last, so that a snapshot is only listed complete
+    s3_transfer.upload(os.path.join(root, 'manifest.json'),
+        config['snapshot']['bucket'], prefix + 'manifest.json')
+    print(f"Snapshot {version} uploaded.")
+
+
+"""Copies one snapshot file to target, from the snapshot bucket or, if
+   no bucket is configured, from the local export directory
+"""
+def fetch(version, path, target):
+    if config['snapshot']['bucket']:
+        s3_transfer.download(config['snapshot']['bucket'],
+            config['snapshot']['key_prefix'] + version + '/' + path, target)
+    else:
+        shutil.copyfile(os.path.join(config['snapshot']['export_dir'],
+            version, path), target)
+
+
+"""Fetches snapshot 'version' (the configured one by default), checks
+   every file against the manifest and unpacks it into plain .npy files
+   under the snapshot path; CURRENT then names it. A snapshot that is
+   already unpacked is not fetched again
+"""
+def sync(version=None):
+    version = version or config['snapshot']['version']
+    path = config['snapshot']['path']
+    root = os.path.join(path, version)
+
+    if not os.path.exists(os.path.join(root, 'manifest.json')):
+        # Unpack next to the snapshot and move it into place when complete
+        staging = root + '.partial'
+        fu.mkdirp(staging)
+        fetch(version, 'manifest.json', os.path.join(staging, 'manifest.json'))
+        fh = open(os.path.join(staging, 'manifest.json'))
+        manifest = json.load(fh)
+        fh.close()
+
+        for (relpath, entry) in snapshotFiles(manifest):
+            download = os.path.join(staging, 'download.gz')
+            fetch(version, relpath, download)
+            fh = open(download, 'rb')
+            data = fh.read()
+            fh.close()
+            if (hashlib.sha256(data).hexdigest() != entry['sha256']):
+                raise ValueError(f"Checksum mismatch for {relpath} in " + \
+                    f"snapshot {version}")
+            target = os.path.join(staging, relpath[:-len('.gz')])
+            fu.mkdirp(os.path.dirname(target))
+            fh = open(target, 'wb')
+            fh.write(gzip.decompress(data))
+            fh.close()
+            os.remove(download)
+
+        if os.path.exists(root):
+            shutil.rmtree(root)
+        os.rename(staging, root)
+
+    fh = open(os.path.join(path, 'CURRENT.tmp'), 'w')
+    fh.write(version + '\n')
+    fh.close()
+    os.replace(os.path.join(path, 'CURRENT.tmp'), os.path.join(path, 'CURRENT'))
+    print(f"Snapshot {version} ready in {root}")
+    return root
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 2 and sys.argv[1] == 'export'):
+        export(sys.argv[2], tables=sys.argv[3:])
+    elif (len(sys.argv) > 2 and sys.argv[1] == 'upload'):
+        upload(sys.argv[2])
+    elif (len(sys.argv) > 1 and sys.argv[1] == 'sync'):
+        sync(sys.argv[2] if (len(sys.argv) > 2) else None)
+    else:
+        print("Usage: python snapshot.py export <version> [<table> ...]")
+        print("       python snapshot.py upload <version>")
+        print("       python snapshot.py sync [<version>]")
+
+### EOF
@@ -0,0 +1,108 @@
+# synthetic_vcf.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Synthetic VCF inputs for AnnTools benchmarks
+#
+# Variants fall on each chromosome in proportion to its length (chrY at a
+# tenth of that, as in real call sets), over the shrunk chromosomes of a
+# reference stand-in, and a share of them are known dbSNP variants of the
+# stand-in so the dbSNP stage finds matches.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import random
+import sqlite3
+
+import bgzf
+import reference_standin as ref
+
+"""Relative variant density of chromosomes (others 1.0)
+"""
+CHROM_DENSITY = {'Y': 0.1}
+
+"""Karyotypic order of the chromosomes, for sorted output
+"""
+ORDER = dict([(chr, i) for (i, (chr, length)) in enumerate(ref.HG19)])
+
+HEADERS = ['##fileformat=VCFv4.1', '##source=AnnTools synthetic_vcf.py',
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE']
+
+
+"""Writes a VCF file of 'records' random variants to outfile (bgzip-
+   compressed if it ends in .gz) and returns outfile
+   order: 'sorted' (karyotypic, by position) or 'shuffled'
+   reference: stand-in database to draw known_fraction of the variants
+   from its dbSNP table (None = all novel)
+   duplicate_fraction: share of records that repeat an earlier variant, as
+   in multi-sample or concatenated files
+   chr_prefix: name chromosomes chr1 ... rather than 1 ...
+"""
+def generate(outfile, records, order='sorted', reference=None,
+    scale=ref.SCALE, known_fraction=0.3, duplicate_fraction=0.0,
+    chr_prefix=True, seed=11):
+    if (order not in ('sorted', 'shuffled')):
+        raise ValueError(f"Unknown order {order}")
+    rng = random.Random(seed)
+    chroms = ref.chromLengths(scale)
+    weights = [length * CHROM_DENSITY.get(chr, 1.0)
+        for (chr, length) in chroms]
+
+    known = []
+    if (reference is not None and known_fraction > 0):
+        db = sqlite3.connect(reference)
+        known = db.execute('select CHR, POS, REF, ALT from dbSNP').fetchall()
+        db.close()
+
+    unique = records - int(records * duplicate_fraction)
+    variants = []
+    picks = rng.choices(range(0, len(chroms)), weights=weights, k=unique)
+    for i in range(0, unique):
+        if (len(known) > 0 and rng.random() < known_fraction):
+            (chr, pos, refBase, alt) = rng.choice(known)
+            refBase = refBase.upper()
+        else:
+            (chr, length) = chroms[picks[i]]
+            pos = rng.randint(1, length)
+            refBase = rng.choice(ref.BASES)
+            alt = rng.choice(ref.BASES.replace(refBase, ''))
+        variants.append((str(chr), int(pos), refBase, alt))
+    for i in range(unique, records):
+        variants.append(variants[rng.randrange(0, unique)])
+
+    if (order == 'sorted'):
+        variants.sort(key=lambda v: (ORDER.get(v[0], len(ORDER)), v[1]))
+    else:
+        rng.shuffle(variants)
+
+    prefix = 'chr' if chr_prefix else ''
+    infos = ['.', 'DP=10', 'DP=3;AF=0.5', 'DP=25;AF=1.0']
+    fh = bgzf.openOutput(outfile)
+    fh.write('\n'.join(HEADERS) + '\n')
+    lines = []
+    for (chr, pos, refBase, alt) in variants:
+        lines.append(prefix + chr + '\t' + str(pos) + '\t.\t' + refBase + \
+            '\t' + alt + '\t50\tPASS\t' + rng.choice(infos) + '\tGT\t' + \
+            rng.choice(['0/1', '1/1']) + '\n')
+        if (len(lines) >= 10000):
+            fh.write(''.join(lines))
+            lines = []
+    fh.write(''.join(lines))
+    fh.close()
+    return outfile
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 2):
+        generate(sys.argv[1], int(sys.argv[2]),
+            order=sys.argv[3] if (len(sys.argv) > 3) else 'sorted',
+            reference=sys.argv[4] if (len(sys.argv) > 4) else None)
+        print(f"{sys.argv[2]} variants written to {sys.argv[1]}")
+    else:
+        print("Usage: python synthetic_vcf.py <output.vcf[.gz]> <records> " + \
+            "[sorted|shuffled] [<reference stand-in>]")
+
+### EOF
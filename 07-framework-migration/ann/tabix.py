@@ -0,0 +1,276 @@
+# tabix.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Positional index (.tbi) over bgzip-compressed annotated VCF files
+#
+# The index has the layout written by htslib's tabix, so samtools/tabix,
+# pysam or bcftools can use it as well: per chromosome, the chunks of
+# virtual file offsets (see bgzf.BgzfWriter.tell) holding the records of
+# every UCSC bin, and a linear index of the first offset of every 16KB
+# window. A region then costs a few byte-range reads of the .vcf.gz.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import gzip
+import struct
+
+import bgzf
+
+TBI_MAGIC = b'TBI\x01'
+
+"""Preset of VCF files: format, CHROM/POS/end columns, comment character
+   and lines to skip
+"""
+TBI_VCF = (2, 1, 2, 0, ord('#'), 0)
+
+"""Bases per linear index window
+"""
+LINEAR_SHIFT = 14
+
+"""Largest BGZF block, i.e. how far past its start a block may end
+"""
+MAX_BLOCK = 1 << 16
+
+
+"""UCSC bin of the 0-based half-open interval [beg, end)
+"""
+def reg2bin(beg, end):
+    end = end - 1
+    for (shift, first) in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if ((beg >> shift) == (end >> shift)):
+            return first + (beg >> shift)
+    return 0
+
+
+"""Bins that can hold intervals overlapping [beg, end)
+"""
+def reg2bins(beg, end):
+    end = end - 1
+    bins = [0]
+    for (shift, first) in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(first + (beg >> shift), first + (end >> shift) + 1))
+    return bins
+
+
+"""Chromosome and 0-based [beg, end) of a VCF data line (bytes); the
+   interval spans the REF allele
+"""
+def recordInterval(line):
+    fields = line.split(b'\t', 4)
+    if (len(fields) < 4):
+        raise ValueError(f"Malformed VCF record: {line[:80]!r}")
+    beg = int(fields[1]) - 1
+    return (fields[0].strip().decode('utf-8'), beg,
+        beg + max(len(fields[3].strip()), 1))
+
+
+"""Per-chromosome bins and linear index of records added in file order
+"""
+class IndexBuilder(object):
+    def __init__(self):
+        self.names = []
+        self.refs = {}
+        self.last = None
+
+    def add(self, chr, beg, end, vbeg, vend):
+        if (self.last is None or chr != self.last[0]):
+            if (chr in self.refs):
+                raise ValueError(f"Records of {chr} are not contiguous")
+            self.names.append(chr)
+            self.refs[chr] = ({}, [])
+        elif (beg < self.last[1]):
+            raise ValueError(f"Records of {chr} are not sorted by position")
+        self.last = (chr, beg)
+
+        bins, linear = self.refs[chr]
+        chunks = bins.setdefault(reg2bin(beg, end), [])
+        if (len(chunks) > 0 and chunks[-1][1] == vbeg):
+            chunks[-1][1] = vend
+        else:
+            chunks.append([vbeg, vend])
+        for window in range(beg >> LINEAR_SHIFT,
+            ((end - 1) >> LINEAR_SHIFT) + 1):
+            if (window >= len(linear)):
+                linear.extend([0] * (window + 1 - len(linear)))
+            if (linear[window] == 0):
+                linear[window] = vbeg
+
+    """The index in the .tbi layout (uncompressed)
+    """
+    def serialize(self):
+        names = b''.join([name.encode('utf-8') + b'\0' for name in self.names])
+        parts = [TBI_MAGIC, struct.pack('<7i', len(self.names), *TBI_VCF),
+            struct.pack('<i', len(names)), names]
+        for name in self.names:
+            bins, linear = self.refs[name]
+            parts.append(struct.pack('<i', len(bins)))
+            for bin in sorted(bins):
+                parts.append(struct.pack('<Ii', bin, len(bins[bin])))
+                for (vbeg, vend) in bins[bin]:
+                    parts.append(struct.pack('<QQ', vbeg, vend))
+            # Windows without records start where the one before starts
+            for i in range(1, len(linear)):
+                if (linear[i] == 0):
+                    linear[i] = linear[i - 1]
+            parts.append(struct.pack('<i', len(linear)))
+            parts.append(struct.pack('<' + str(len(linear)) + 'Q', *linear))
+        parts.append(struct.pack('<Q', 0))
+        return b''.join(parts)
+
+
+"""Writes the index of the bgzip-compressed VCF file path to path.tbi and
+   returns its name. Raises ValueError if the records are not sorted by
+   chromosome and position, which is when no index can be built
+"""
+def buildIndex(path):
+    builder = IndexBuilder()
+    pending = None
+    record = None
+    (offset, data) = (0, b'')
+
+    fh = open(path, 'rb')
+    for (offset, data) in bgzf.iterBlocks(fh):
+        i = 0
+        while (i < len(data)):
+            if pending is None:
+                pending = ((offset << 16) | i, [])
+            j = data.find(b'\n', i)
+            if (j < 0):
+                pending[1].append(data[i:])
+                break
+            pending[1].append(data[i:j])
+            (vbeg, line) = (pending[0], b''.join(pending[1]))
+            pending = None
+            i = j + 1
+            # A record ends where the next line starts
+            if record is not None:
+                builder.add(*record, vbeg)
+                record = None
+            if (len(line.strip()) > 0 and not line.startswith(b'#')):
+                record = recordInterval(line) + (vbeg,)
+    # A last line without a newline
+    if pending is not None:
+        if record is not None:
+            builder.add(*record, pending[0])
+        line = b''.join(pending[1])
+        record = recordInterval(line) + (pending[0],) \
+            if (len(line.strip()) > 0 and not line.startswith(b'#')) else None
+    end = (offset << 16) | len(data)
+    fh.close()
+    if record is not None:
+        builder.add(*record, end)
+
+    out = bgzf.BgzfWriter(path + '.tbi')
+    out.write(builder.serialize())
+    out.close()
+    return path + '.tbi'
+
+
+"""Parses a .tbi index (its compressed bytes) into the chromosome names
+   and, for each chromosome, its bins and linear index
+"""
+def readIndex(data):
+    data = gzip.decompress(data)
+    if (data[:4] != TBI_MAGIC):
+        raise ValueError("Not a tabix index")
+    (n_ref, format, col_seq, col_beg, col_end, meta, skip, l_nm) = \
+        struct.unpack_from('<8i', data, 4)
+    names = data[36:36 + l_nm].split(b'\0')[:n_ref]
+    at = 36 + l_nm
+    index = {}
+    for name in names:
+        bins = {}
+        (n_bin,) = struct.unpack_from('<i', data, at)
+        at = at + 4
+        for b in range(0, n_bin):
+            (bin, n_chunk) = struct.unpack_from('<Ii', data, at)
+            at = at + 8
+            chunks = struct.unpack_from('<' + str(2 * n_chunk) + 'Q', data, at)
+            at = at + 16 * n_chunk
+            bins[bin] = list(zip(chunks[0::2], chunks[1::2]))
+        (n_intv,) = struct.unpack_from('<i', data, at)
+        at = at + 4
+        linear = struct.unpack_from('<' + str(n_intv) + 'Q', data, at)
+        at = at + 8 * n_intv
+        index[name.decode('utf-8')] = (bins, linear)
+    return index
+
+
+"""Virtual offset ranges to read for the records of chr overlapping the
+   1-based region beg..end, merged and in file order
+"""
+def regionChunks(index, chr, beg, end):
+    if (chr not in index):
+        return []
+    bins, linear = index[chr]
+    beg = max(beg - 1, 0)
+    window = beg >> LINEAR_SHIFT
+    minOffset = linear[window] if (window < len(linear)) else \
+        (linear[-1] if (len(linear) > 0) else 0)
+
+    chunks = []
+    for bin in reg2bins(beg, end):
+        for (vbeg, vend) in bins.get(bin, []):
+            if (vend > minOffset):
+                chunks.append([max(vbeg, minOffset), vend])
+    chunks.sort()
+    merged = []
+    for chunk in chunks:
+        if (len(merged) > 0 and chunk[0] <= merged[-1][1]):
+            merged[-1][1] = max(merged[-1][1], chunk[1])
+        else:
+            merged.append(chunk)
+    return merged
+
+
+"""Records (str, without the newline) of chr overlapping the 1-based
+   region beg..end. readRange(offset, length) returns those bytes of the
+   compressed file (at most, near its end), e.g. a local read or an S3
+   ranged GET, so only the blocks holding the region are transferred
+"""
+def fetchRegion(readRange, index, chr, beg, end):
+    for (vbeg, vend) in regionChunks(index, chr, beg, end):
+        first = vbeg >> 16
+        last = vend >> 16
+        data = readRange(first, last - first + MAX_BLOCK)
+        parts = []
+        for (offset, block) in bgzf.iterBlocks(io.BytesIO(data), first):
+            if (offset == last):
+                parts.append(block[:vend & 0xffff])
+                break
+            parts.append(block)
+        text = b''.join(parts)[vbeg & 0xffff:]
+        for line in text.split(b'\n'):
+            if (len(line.strip()) == 0 or line.startswith(b'#')):
+                continue
+            (name, lbeg, lend) = recordInterval(line)
+            if (name == chr and lbeg < end and lend > beg - 1):
+                yield line.decode('utf-8')
+
+
+"""readRange over a local file, for fetchRegion
+"""
+def fileRange(path):
+    def readRange(offset, length):
+        fh = open(path, 'rb')
+        fh.seek(offset)
+        data = fh.read(length)
+        fh.close()
+        return data
+    return readRange
+
+
+"""readRange over an S3 object through ranged GETs, for fetchRegion
+"""
+def s3Range(client, bucket, key):
+    def readRange(offset, length):
+        response = client.get_object(Bucket=bucket, Key=key,
+            Range=f'bytes={offset}-{offset + length - 1}')
+        return response['Body'].read()
+    return readRange
+
+### EOF
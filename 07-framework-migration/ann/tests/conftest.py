@@ -0,0 +1,97 @@
+# conftest.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Test setup: the AnnTools modules are imported from the ann directory,
+# and read ann_config.ini from the working directory, as on the instance
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import os
+import sys
+import gzip
+import shutil
+from contextlib import redirect_stdout
+
+import pytest
+
+ANN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.chdir(ANN_DIR)
+sys.path.insert(0, ANN_DIR)
+
+import driver
+import reference_standin as ref
+import synthetic_vcf as synth
+
+"""Shrink factor of the stand-in used by the tests: small enough to build
+   in well under a second, large enough that every table has rows on
+   every chromosome
+"""
+TEST_SCALE = ref.SCALE * 10
+
+"""driver.run options of the original pipeline: mysql engine, one stage
+   at a time, one query per variant
+"""
+BASELINE = {'engine': 'mysql', 'dedup': False}
+
+
+"""Annotates a copy of source in a directory of its own and returns the
+   annotated records, decompressed
+"""
+def annotate(source, workdir, options):
+    os.makedirs(workdir)
+    infile = os.path.join(workdir, 'input.vcf')
+    shutil.copyfile(source, infile)
+    with redirect_stdout(io.StringIO()):
+        driver.run(infile, 'vcf', **options)
+    outputs = [name for name in os.listdir(workdir)
+        if (name.endswith('.annot.vcf') or name.endswith('.annot.vcf.gz'))]
+    assert len(outputs) == 1
+    path = os.path.join(workdir, outputs[0])
+    fh = gzip.open(path, 'rt') if path.endswith('.gz') else open(path)
+    text = fh.read()
+    fh.close()
+    return text
+
+
+"""A reference stand-in, built once per test session and used as the
+   reference database
+"""
+@pytest.fixture(scope='session')
+def reference(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('reference') / 'reference.db')
+    ref.build(path, scale=TEST_SCALE)
+    ref.use(path)
+    return path
+
+
+"""Position-sorted synthetic input with known and repeated variants
+"""
+@pytest.fixture(scope='session')
+def sorted_vcf(reference, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('inputs') / 'sorted.vcf')
+    synth.generate(path, 600, reference=reference, scale=TEST_SCALE,
+        duplicate_fraction=0.1)
+    return path
+
+
+@pytest.fixture(scope='session')
+def shuffled_vcf(reference, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('inputs') / 'shuffled.vcf')
+    synth.generate(path, 600, order='shuffled', reference=reference,
+        scale=TEST_SCALE, duplicate_fraction=0.1)
+    return path
+
+
+"""Annotated records of sorted_vcf written by the original pipeline
+"""
+@pytest.fixture(scope='session')
+def baseline(sorted_vcf, tmp_path_factory):
+    return annotate(sorted_vcf, str(tmp_path_factory.mktemp('baseline') /
+        'run'), BASELINE)
+
+### EOF
@@ -0,0 +1,70 @@
+# test_bgzf.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# BGZF output of bgzf.py: readable as gzip, and virtual offsets that
+# point at the bytes written
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import gzip
+import random
+
+import bgzf
+
+
+"""Uncompressed data of every block, by the file offset of the block
+"""
+def readBlocks(path):
+    fh = open(path, 'rb')
+    blocks = dict(bgzf.iterBlocks(fh))
+    fh.close()
+    return blocks
+
+
+def test_tell_points_at_next_byte(tmp_path):
+    path = str(tmp_path / 'out.gz')
+    rng = random.Random(1)
+    out = bgzf.BgzfWriter(path)
+    assert out.tell() == 0
+    writes = []
+    for i in range(0, 2000):
+        data = bytes([rng.randrange(32, 127)
+            for k in range(0, rng.choice([1, 10, 100, 1000]))])
+        writes.append((out.tell(), data))
+        out.write(data)
+        if (i % 500 == 499):
+            # A flushed block: the next byte starts a new one
+            out.flush()
+            assert (out.tell() & 0xffff) == 0
+    out.close()
+
+    blocks = readBlocks(path)
+    for (voffset, data) in writes:
+        block = blocks[voffset >> 16]
+        within = voffset & 0xffff
+        assert within < len(block)
+        assert block[within:within + 1] == data[:1]
+    # Virtual offsets only grow
+    offsets = [voffset for (voffset, data) in writes]
+    assert offsets == sorted(offsets)
+
+    fh = gzip.open(path, 'rb')
+    assert fh.read() == b''.join([data for (voffset, data) in writes])
+    fh.close()
+
+
+def test_blocks_are_bounded(tmp_path):
+    path = str(tmp_path / 'out.gz')
+    out = bgzf.BgzfWriter(path)
+    out.write(b'x' * (bgzf.BLOCK_SIZE * 3 + 17))
+    assert out.tell() >> 16 > 0
+    assert (out.tell() & 0xffff) == 17
+    out.close()
+    sizes = [len(data) for data in readBlocks(path).values()]
+    # Three full blocks, the rest and the empty end-of-file block
+    assert sizes == [bgzf.BLOCK_SIZE] * 3 + [17, 0]
+
+### EOF
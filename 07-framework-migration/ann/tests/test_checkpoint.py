@@ -0,0 +1,159 @@
+# test_checkpoint.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Checkpoints of checkpoint.py, and jobs of driver.run that fail part of
+# the way through and are run again
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import os
+import re
+import shutil
+import functools
+from contextlib import redirect_stdout
+
+import pytest
+
+import checkpoint as ck
+import driver
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / 'job.checkpoint.json')
+    checkpoint = ck.Checkpoint(path, {'input': '1:abc', 'fused': True})
+    assert checkpoint.load() is None
+    checkpoint.save({'lines': 100})
+    assert checkpoint.load() == {'lines': 100}
+    assert not os.path.exists(path + '.tmp')
+
+    # Progress of other settings is not resumed
+    assert ck.Checkpoint(path, {'input': '1:abc', 'fused': False}).load() \
+        is None
+
+    # Nor a checkpoint cut short
+    fh = open(path, 'w')
+    fh.write('{"key": ')
+    fh.close()
+    assert checkpoint.load() is None
+
+    checkpoint.clear()
+    assert not os.path.exists(path)
+
+
+def test_fingerprint(tmp_path):
+    path = str(tmp_path / 'input.vcf')
+    fh = open(path, 'wb')
+    fh.write(b'x' * (ck.FINGERPRINT_BYTES * 3))
+    fh.close()
+    before = ck.fingerprint(path)
+    assert ck.fingerprint(path) == before
+    fh = open(path, 'r+b')
+    fh.seek(ck.FINGERPRINT_BYTES * 3 - 1)
+    fh.write(b'y')
+    fh.close()
+    assert ck.fingerprint(path) != before
+
+
+"""Stages of driver.getStages whose stage 'index' raises after 'after'
+   records while failing[0] is set. Fused runs call a stage once per
+   chunk, so the records are counted over all calls
+"""
+def failingStages(index, after, failing):
+    getStages = driver.getStages
+    records = [0]
+
+    def stages(**options):
+        stages = getStages(**options)
+        (stage, kwargs, message) = stages[index]
+
+        @functools.wraps(stage)
+        def failing_stage(lines, *args, **kwargs):
+            for line in stage(lines, *args, **kwargs):
+                if (failing[0] and records[0] >= after):
+                    raise RuntimeError("Instance lost")
+                records[0] = records[0] + 1
+                yield line
+
+        stages[index] = (failing_stage, kwargs, message)
+        return stages
+
+    return stages
+
+
+"""Runs a job that fails in stage 'index', then runs it again; returns
+   what the second run printed and the annotated records
+"""
+def failAndResume(source, workdir, options, index, after, monkeypatch):
+    failing = [True]
+    monkeypatch.setattr(driver, 'getStages',
+        failingStages(index, after, failing))
+    os.makedirs(workdir)
+    infile = os.path.join(workdir, 'input.vcf')
+    shutil.copyfile(source, infile)
+    with redirect_stdout(io.StringIO()):
+        with pytest.raises(RuntimeError):
+            driver.run(infile, 'vcf', **options)
+    assert os.path.exists(infile + '.checkpoint.json')
+
+    failing[0] = False
+    out = io.StringIO()
+    with redirect_stdout(out):
+        driver.run(infile, 'vcf', **options)
+    assert not os.path.exists(infile + '.checkpoint.json')
+    fh = open(os.path.join(workdir, 'input.annot.vcf'))
+    text = fh.read()
+    fh.close()
+    return (out.getvalue(), text)
+
+
+def test_staged_resume(sorted_vcf, baseline, tmp_path, monkeypatch):
+    (printed, output) = failAndResume(sorted_vcf, str(tmp_path / 'run'),
+        {'engine': 'mysql', 'checkpoint': True}, 6, 200, monkeypatch)
+    assert "Resuming after stage 6 of" in printed
+    assert "dbSNP - done." not in printed
+    assert output == baseline
+
+
+@pytest.mark.parametrize('options', [{'engine': 'index', 'fused': True},
+    {'engine': 'mysql', 'concurrent_chunk_size': 50}],
+    ids=['fused', 'concurrent'])
+def test_chunked_resume(options, sorted_vcf, baseline, tmp_path,
+    monkeypatch):
+    monkeypatch.setattr(ck, 'CHUNK_LINES', 100)
+    options = dict(options, checkpoint=True)
+    (printed, output) = failAndResume(sorted_vcf, str(tmp_path / 'run'),
+        options, 3, 350, monkeypatch)
+    resumed = re.search(r'Resuming after (\d+) lines', printed)
+    assert resumed is not None and int(resumed.group(1)) >= 100
+    assert output == baseline
+
+
+def test_changed_settings_start_over(sorted_vcf, baseline, tmp_path,
+    monkeypatch):
+    monkeypatch.setattr(ck, 'CHUNK_LINES', 100)
+    workdir = str(tmp_path / 'run')
+    monkeypatch.setattr(driver, 'getStages',
+        failingStages(3, 350, [True]))
+    os.makedirs(workdir)
+    infile = os.path.join(workdir, 'input.vcf')
+    shutil.copyfile(sorted_vcf, infile)
+    with redirect_stdout(io.StringIO()):
+        with pytest.raises(RuntimeError):
+            driver.run(infile, 'vcf', engine='index', fused=True,
+                checkpoint=True)
+    monkeypatch.undo()
+
+    out = io.StringIO()
+    with redirect_stdout(out):
+        driver.run(infile, 'vcf', engine='mysql', fused=True,
+            checkpoint=True)
+    assert "Resuming" not in out.getvalue()
+    fh = open(os.path.join(workdir, 'input.annot.vcf'))
+    assert fh.read() == baseline
+    fh.close()
+
+### EOF
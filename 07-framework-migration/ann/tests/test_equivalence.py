@@ -0,0 +1,126 @@
+# test_equivalence.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Every engine and mode of driver.run must write the same annotated file
+# as the original pipeline (mysql engine, one stage at a time), here on
+# synthetic inputs against the reference stand-in
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import shutil
+import sqlite3
+
+import pytest
+
+import benchmark
+import gene_models
+import interval_index
+import reference_standin as ref
+import utils as u
+from conftest import BASELINE, annotate
+
+"""driver.run options compared to the baseline: the benchmark
+   configurations and the modes and output options they leave out
+"""
+CONFIGS = dict([(name, options) for (name, options) in
+    benchmark.CONFIGS.items() if (name != 'baseline')])
+CONFIGS.update({
+    'index-staged': {'engine': 'index'},
+    'sweep-staged': {'engine': 'sweep', 'presorted': True},
+    'sweep-parallel': {'engine': 'sweep', 'workers': 2, 'shard_size': 100},
+    'dedup': {'engine': 'mysql', 'fused': True, 'dedup': True},
+    'compressed': {'engine': 'index', 'fused': True,
+        'compress_output': True, 'index_output': True},
+    'compressed-staged': {'engine': 'mysql', 'compress_output': True},
+    'checkpoint-staged': {'engine': 'mysql', 'checkpoint': True},
+    'checkpoint-fused': {'engine': 'sweep', 'fused': True,
+        'checkpoint': True},
+    'checkpoint-parallel': {'engine': 'index', 'workers': 2,
+        'shard_size': 100, 'checkpoint': True},
+    'cache': {'engine': 'mysql', 'fused': True, 'dbsnp_batch_size': 50}})
+
+
+@pytest.fixture(scope='module')
+def snapshot_path(reference, tmp_path_factory):
+    return benchmark.prepareSnapshot(str(tmp_path_factory.mktemp('store')))
+
+
+@pytest.mark.parametrize('name', sorted(CONFIGS))
+def test_matches_baseline(name, sorted_vcf, baseline, snapshot_path,
+    tmp_path):
+    options = dict(CONFIGS[name])
+    if (options['engine'] == 'store'):
+        options['snapshot_path'] = snapshot_path
+    if (name == 'cache'):
+        options['cache_path'] = str(tmp_path / 'cache' / 'lookups.db')
+    output = annotate(sorted_vcf, str(tmp_path / 'run'), options)
+    assert output == baseline
+
+
+"""The persistent cache answers a job run again without connecting to
+   the database
+"""
+def test_cached_rerun(reference, sorted_vcf, baseline, tmp_path):
+    options = {'engine': 'mysql', 'dedup': False,
+        'cache_path': str(tmp_path / 'lookups.db')}
+    assert annotate(sorted_vcf, str(tmp_path / 'first'), options) == baseline
+
+    connections = []
+
+    def connect():
+        connections.append(reference)
+        return ref.StandInConnection(reference)
+
+    u.set_connection_factory(connect)
+    try:
+        output = annotate(sorted_vcf, str(tmp_path / 'second'), options)
+    finally:
+        ref.use(reference)
+    assert output == baseline
+    assert connections == []
+
+
+"""Unsorted input: the sweep falls back to the index engine
+"""
+@pytest.mark.parametrize('options', [{'engine': 'index', 'fused': True},
+    {'engine': 'sweep', 'fused': True}, {'engine': 'index', 'workers': 2}],
+    ids=['index', 'sweep', 'parallel'])
+def test_unsorted_input(options, shuffled_vcf, tmp_path):
+    expected = annotate(shuffled_vcf, str(tmp_path / 'baseline'), BASELINE)
+    assert annotate(shuffled_vcf, str(tmp_path / 'run'), options) == expected
+
+
+"""The sweep returns the rows of an interval in the order the database
+   does, even when a table is not stored in start order and has no index
+"""
+def test_sweep_unordered_tables(reference, sorted_vcf, tmp_path,
+    monkeypatch):
+    path = str(tmp_path / 'unordered.db')
+    shutil.copyfile(reference, path)
+    db = sqlite3.connect(path)
+    tables = [row[0] for row in db.execute(
+        "select name from sqlite_master where type='table';")]
+    for table in tables:
+        db.execute(f'create table shuffled as select * from {table} ' + \
+            'order by random();')
+        db.execute(f'drop table {table};')
+        db.execute(f'alter table shuffled rename to {table};')
+    db.commit()
+    db.close()
+
+    # Indexes and gene models loaded from the other database are not reused
+    monkeypatch.setattr(interval_index, 'indexes', {})
+    monkeypatch.setattr(gene_models, 'caches', {})
+    ref.use(path)
+    try:
+        expected = annotate(sorted_vcf, str(tmp_path / 'baseline'), BASELINE)
+        output = annotate(sorted_vcf, str(tmp_path / 'sweep'),
+            {'engine': 'sweep', 'fused': True})
+    finally:
+        ref.use(reference)
+    assert output == expected
+
+### EOF
@@ -0,0 +1,117 @@
+# test_heartbeat.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Visibility extensions, deletion and release of the SQS messages of
+# heartbeat.Heartbeat, with messages stood in by recording objects
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import time
+
+from botocore.exceptions import ClientError
+
+import heartbeat as hb
+
+
+"""An SQS message that records the calls made on it, and raises
+   ClientError for those named in 'failing'
+"""
+class FakeMessage(object):
+    def __init__(self, failing=()):
+        self.calls = []
+        self.failing = failing
+
+    def call(self, name, *args):
+        self.calls.append((name,) + args)
+        if name in self.failing:
+            raise ClientError({'Error': {'Code': 'ReceiptHandleIsInvalid',
+                'Message': 'The receipt handle has expired'}}, name)
+
+    def delete(self):
+        self.call('delete')
+
+    def change_visibility(self, VisibilityTimeout):
+        self.call('change_visibility', VisibilityTimeout)
+
+
+def test_beat_extends_tracked():
+    heartbeat = hb.Heartbeat(timeout=300, interval=60)
+    (a, b) = (FakeMessage(), FakeMessage())
+    heartbeat.track('a', a)
+    heartbeat.track('b', b)
+    heartbeat.beat()
+    assert a.calls == [('change_visibility', 300)]
+    assert b.calls == [('change_visibility', 300)]
+
+
+def test_delete():
+    heartbeat = hb.Heartbeat()
+    message = FakeMessage()
+    heartbeat.track('a', message)
+    heartbeat.delete('a')
+    assert message.calls == [('delete',)]
+    assert not heartbeat.isTracked('a')
+    # No longer extended, nor deleted twice
+    heartbeat.beat()
+    heartbeat.delete('a')
+    assert message.calls == [('delete',)]
+
+
+def test_release():
+    heartbeat = hb.Heartbeat()
+    message = FakeMessage()
+    heartbeat.track('a', message)
+    heartbeat.release('a')
+    assert message.calls == [('change_visibility', 0)]
+    assert not heartbeat.isTracked('a')
+    heartbeat.beat()
+    heartbeat.release('a')
+    assert message.calls == [('change_visibility', 0)]
+
+
+def test_redelivered_message_replaces():
+    heartbeat = hb.Heartbeat()
+    (first, again) = (FakeMessage(), FakeMessage())
+    heartbeat.track('a', first)
+    heartbeat.track('a', again)
+    heartbeat.delete('a')
+    assert first.calls == []
+    assert again.calls == [('delete',)]
+
+
+def test_client_errors_are_reported(capsys):
+    heartbeat = hb.Heartbeat()
+    failing = FakeMessage(failing=('delete', 'change_visibility'))
+    other = FakeMessage()
+    heartbeat.track('a', failing)
+    heartbeat.track('b', other)
+    # One message failing does not keep the others from being extended
+    heartbeat.beat()
+    assert other.calls == [('change_visibility', 300)]
+    heartbeat.delete('a')
+    assert not heartbeat.isTracked('a')
+    assert "receipt handle has expired" in capsys.readouterr().out
+    heartbeat.track('a', failing)
+    heartbeat.release('a')
+    assert not heartbeat.isTracked('a')
+    assert "receipt handle has expired" in capsys.readouterr().out
+
+
+def test_background_thread():
+    heartbeat = hb.Heartbeat(timeout=30, interval=0.05)
+    message = FakeMessage()
+    heartbeat.track('a', message)
+    heartbeat.start()
+    deadline = time.time() + 5
+    while (len(message.calls) < 3 and time.time() < deadline):
+        time.sleep(0.01)
+    heartbeat.stop()
+    heartbeat.thread.join(5)
+    assert not heartbeat.thread.is_alive()
+    assert len(message.calls) >= 3
+    assert set(message.calls) == set([('change_visibility', 30)])
+
+### EOF
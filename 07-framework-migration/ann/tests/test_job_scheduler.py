@@ -0,0 +1,140 @@
+# test_job_scheduler.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Admission, queueing and reaping of job_scheduler.JobScheduler, with
+# processes stood in by objects polled the same way
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import pytest
+
+import job_scheduler as js
+
+MB = js.MB
+
+
+"""A process that has exited once returncode is set
+"""
+class FakeProcess(object):
+    def __init__(self):
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+
+"""Scheduler whose launches, starts and exits are recorded, on an
+   instance with 'memory' and 'disk' free
+"""
+@pytest.fixture
+def scheduler(monkeypatch):
+    free = {'memory': 8192 * MB, 'disk': 8192 * MB}
+    monkeypatch.setattr(js, 'freeMemory', lambda: free['memory'])
+    monkeypatch.setattr(js, 'freeDisk', lambda path: free['disk'])
+    events = []
+
+    def launch(job):
+        events.append(('launch', job.job_id))
+        return FakeProcess()
+
+    scheduler = js.JobScheduler(slots=2, queue_size=2,
+        min_free_memory=1024 * MB, min_free_disk=2048 * MB, launch=launch)
+    scheduler.free = free
+    scheduler.events = events
+    return scheduler
+
+
+def makeJob(scheduler, job_id):
+    return js.Job(job_id, 'true',
+        onStart=lambda job: scheduler.events.append(('start', job.job_id)),
+        onExit=lambda job, code: scheduler.events.append(
+            ('exit', job.job_id, code)))
+
+
+def test_admits(scheduler):
+    assert scheduler.admits()
+    scheduler.free['memory'] = 1023 * MB
+    assert not scheduler.admits()
+    scheduler.free['memory'] = 1024 * MB
+    assert scheduler.admits()
+    scheduler.free['disk'] = 2047 * MB
+    assert not scheduler.admits()
+
+
+def test_slots_then_queue(scheduler):
+    for job_id in ['a', 'b', 'c', 'd']:
+        assert scheduler.submit(makeJob(scheduler, job_id))
+    assert sorted(scheduler.running) == ['a', 'b']
+    assert [job.job_id for job in scheduler.queue] == ['c', 'd']
+    assert scheduler.capacity() == 0
+    # Full: the job is not taken
+    assert not scheduler.submit(makeJob(scheduler, 'e'))
+    assert not scheduler.isRunning('e')
+    assert scheduler.isRunning('c')
+
+
+def test_queued_until_admitted(scheduler):
+    scheduler.free['memory'] = 0
+    assert scheduler.submit(makeJob(scheduler, 'a'))
+    assert len(scheduler.running) == 0
+    assert [job.job_id for job in scheduler.queue] == ['a']
+    scheduler.free['memory'] = 8192 * MB
+    scheduler.dispatch()
+    assert list(scheduler.running) == ['a']
+
+
+def test_reap(scheduler):
+    for job_id in ['a', 'b', 'c']:
+        scheduler.submit(makeJob(scheduler, job_id))
+    scheduler.reap()
+    assert sorted(scheduler.running) == ['a', 'b']
+    assert not any([event[0] == 'exit' for event in scheduler.events])
+
+    scheduler.running['a'].process.returncode = 75
+    scheduler.reap()
+    assert ('exit', 'a', 75) in scheduler.events
+    assert sorted(scheduler.running) == ['b']
+    assert not scheduler.isRunning('a')
+
+    # The freed slot goes to the queued job
+    scheduler.dispatch()
+    assert sorted(scheduler.running) == ['b', 'c']
+    assert scheduler.events.index(('exit', 'a', 75)) < \
+        scheduler.events.index(('launch', 'c'))
+
+    # Each exit is reported once
+    scheduler.running['b'].process.returncode = 0
+    scheduler.reap()
+    scheduler.reap()
+    assert scheduler.events.count(('exit', 'b', 0)) == 1
+
+
+def test_failed_launch(scheduler):
+    def launch(job):
+        raise OSError("No such file")
+    scheduler.launch = launch
+    assert scheduler.submit(makeJob(scheduler, 'a'))
+    assert scheduler.events == [('exit', 'a', None)]
+    assert len(scheduler.running) == 0
+    assert len(scheduler.queue) == 0
+
+
+def test_drain(scheduler):
+    for job_id in ['a', 'b', 'c', 'd']:
+        scheduler.submit(makeJob(scheduler, job_id))
+    assert [job.job_id for job in scheduler.drain()] == ['c', 'd']
+    assert len(scheduler.queue) == 0
+    assert sorted(scheduler.running) == ['a', 'b']
+
+
+def test_default_slots(monkeypatch):
+    monkeypatch.setattr(js.os, 'cpu_count', lambda: 8)
+    assert js.defaultSlots(1) == 8
+    assert js.defaultSlots(3) == 2
+    assert js.defaultSlots(16) == 1
+    assert js.defaultSlots(0) == 1
+
+### EOF
@@ -0,0 +1,56 @@
+# test_run.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Process identities recorded by run.py in job.json
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import os
+import subprocess
+
+import run
+
+
+def test_process_identity():
+    (boot_id, start_time) = run.process_identity(os.getpid())
+    assert boot_id and start_time > 0
+    assert run.process_identity(os.getpid()) == (boot_id, start_time)
+
+
+def test_other_and_exited_processes():
+    child = subprocess.Popen(['sleep', '5'])
+    try:
+        identity = run.process_identity(child.pid)
+        assert identity[0] == run.process_identity(os.getpid())[0]
+        assert identity[1] >= run.process_identity(os.getpid())[1]
+    finally:
+        child.kill()
+        child.wait()
+    assert run.process_identity(child.pid) == (None, None)
+
+
+"""job.json records the job while it annotates, and then that it is
+   annotated, for an annotator that adopts it to publish its results
+"""
+def test_job_record(tmp_path, monkeypatch):
+    input_file_path = str(tmp_path / 'input.vcf')
+    recorded = []
+
+    def annotate(path):
+        with open(str(tmp_path / 'job.json')) as job_file:
+            recorded.append(json.load(job_file))
+    monkeypatch.setattr(run, 'annotate', annotate)
+    run.annotate_job(input_file_path, 'job', 'input.vcf', 'user')
+    with open(str(tmp_path / 'job.json')) as job_file:
+        job = json.load(job_file)
+    assert recorded[0]['annotated'] is False
+    assert job['annotated'] is True
+    assert (job['boot_id'], job['start_time']) == \
+        run.process_identity(os.getpid())
+    assert os.listdir(str(tmp_path)) == ['job.json']
+
+### EOF
@@ -0,0 +1,114 @@
+# test_snapshot.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Export and sync of reference snapshots (snapshot.py) read back through
+# column_store.py
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import os
+import shutil
+import sqlite3
+from contextlib import redirect_stdout
+
+import numpy as np
+import pytest
+
+import column_store as cs
+import reference_standin as ref
+import snapshot
+import utils as u
+
+
+"""Exports 'tables' of the database in use a few rows at a time and
+   syncs the snapshot under workdir; returns the store
+"""
+def exportAndSync(workdir, tables, monkeypatch):
+    monkeypatch.setattr(snapshot, 'FETCH_SIZE', 7)
+    monkeypatch.setitem(snapshot.config['snapshot'], 'export_dir',
+        os.path.join(workdir, 'export'))
+    monkeypatch.setitem(snapshot.config['snapshot'], 'path',
+        os.path.join(workdir, 'local'))
+    monkeypatch.setitem(snapshot.config['snapshot'], 'bucket', '')
+    with redirect_stdout(io.StringIO()):
+        snapshot.export('test', tables=tables)
+        snapshot.sync('test')
+    return cs.getStore(os.path.join(workdir, 'local'))
+
+
+def test_no_dbsnp():
+    assert 'dbSNP' not in [table[0] for table in snapshot.TABLES]
+
+
+def test_rows_and_intervals(reference, tmp_path, monkeypatch):
+    store = exportAndSync(str(tmp_path), ['refGene', 'gadAll'], monkeypatch)
+    db = sqlite3.connect(reference)
+    for (table, chrom, start, end) in [('refGene', 'chrom', 'txStart',
+        'txEnd'), ('gadAll', 'chromosome', 'chromStart', 'chromEnd')]:
+        for name in store.manifest['tables'][table]['partitions']:
+            rows = db.execute(f'select * from {table} where {chrom}=?;',
+                (name,)).fetchall()
+            partition = store.partition(table, name)
+            assert partition.rows() == rows
+            names = store.columnNames(table)
+            starts = [row[names.index(start)] for row in rows]
+            assert list(partition.starts) == sorted(starts)
+            assert [rows[r][names.index(start)]
+                for r in partition.order] == sorted(starts)
+    db.close()
+    # No raw files are left behind
+    for (root, dirs, files) in os.walk(str(tmp_path / 'export')):
+        assert not any([name.endswith('.raw') for name in files])
+
+
+"""Rows without a start or an end are kept but match no position, as in
+   the database
+"""
+def test_null_intervals(reference, tmp_path, monkeypatch):
+    path = str(tmp_path / 'nulls.db')
+    shutil.copyfile(reference, path)
+    db = sqlite3.connect(path)
+    (chrom, start) = db.execute(
+        'select chromosome, chromStart from gadAll limit 1;').fetchone()
+    db.execute('update gadAll set chromStart=null where chromosome=? and ' + \
+        'chromStart=?;', (chrom, start))
+    db.execute('update gadAll set chromEnd=null where rowid in ' + \
+        '(select rowid from gadAll where chromosome=? limit 3 offset 5);',
+        (chrom,))
+    db.commit()
+    rows = db.execute('select * from gadAll where chromosome=?;',
+        (chrom,)).fetchall()
+    matched = db.execute('select count(*) from gadAll where chromosome=? ' + \
+        'and chromStart is not null and chromEnd is not null;',
+        (chrom,)).fetchone()[0]
+    db.close()
+
+    ref.use(path)
+    try:
+        store = exportAndSync(str(tmp_path), ['gadAll'], monkeypatch)
+    finally:
+        ref.use(reference)
+    partition = store.partition('gadAll', chrom)
+    assert partition.rows() == rows
+    assert len(partition.order) == matched < len(rows)
+    names = store.columnNames('gadAll')
+    for (r, s, e) in zip(partition.order, partition.starts, partition.ends):
+        assert rows[r][names.index('chromStart')] == s
+        assert rows[r][names.index('chromEnd')] == e
+
+
+"""A query that fails does not keep the pooled connection
+"""
+def test_failed_query_discards_connection(reference, tmp_path, monkeypatch):
+    discarded = []
+    monkeypatch.setattr(u.pool, 'discard', lambda conn: discarded.append(conn))
+    with pytest.raises(Exception):
+        snapshot.exportPartition(str(tmp_path), 'noSuchTable', 'chrom',
+            'chromStart', 'chromEnd', 'chr1')
+    assert len(discarded) == 1
+
+### EOF
@@ -0,0 +1,106 @@
+# test_tabix.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Bins, index and region reads of tabix.py
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import random
+
+import pytest
+
+import bgzf
+import tabix
+
+
+def test_reg2bin():
+    # Smallest bins are 16KB, numbered from 4681
+    assert tabix.reg2bin(0, 1) == 4681
+    assert tabix.reg2bin(0, 1 << 14) == 4681
+    assert tabix.reg2bin(1 << 14, (1 << 14) + 1) == 4682
+    # Across a 16KB boundary: the 128KB bin holding both
+    assert tabix.reg2bin((1 << 14) - 1, (1 << 14) + 1) == 585
+    assert tabix.reg2bin(1 << 17, (1 << 17) + 2) == 4681 + 8
+    assert tabix.reg2bin(0, 1 << 26) == 1
+    assert tabix.reg2bin(0, (1 << 26) + 1) == 0
+
+
+def test_reg2bins_hold_reg2bin():
+    rng = random.Random(3)
+    for i in range(0, 1000):
+        beg = rng.randrange(0, 1 << 28)
+        end = beg + rng.randrange(1, 1 << rng.randrange(1, 20))
+        assert tabix.reg2bin(beg, end) in tabix.reg2bins(beg, end)
+
+
+def test_unsorted_records():
+    builder = tabix.IndexBuilder()
+    builder.add('chr1', 100, 101, 0, 10)
+    with pytest.raises(ValueError):
+        builder.add('chr1', 50, 51, 10, 20)
+    builder = tabix.IndexBuilder()
+    builder.add('chr1', 100, 101, 0, 10)
+    builder.add('chr2', 10, 11, 10, 20)
+    with pytest.raises(ValueError):
+        builder.add('chr1', 200, 201, 20, 30)
+
+
+"""A sorted, bgzip-compressed VCF file of a few hundred KB, several
+   blocks, and its records
+"""
+@pytest.fixture(scope='module')
+def indexed(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('tabix') / 'sorted.annot.vcf.gz')
+    rng = random.Random(5)
+    records = []
+    out = bgzf.BgzfWriter(path)
+    out.write('##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\n')
+    for chr in ['chr1', 'chr2', 'chrX']:
+        pos = 1
+        for i in range(0, 3000):
+            pos = pos + rng.randrange(1, 400)
+            ref = ''.join([rng.choice('ACGT')
+                for k in range(0, rng.choice([1, 1, 1, 5, 40]))])
+            info = 'x' * rng.randrange(0, 60)
+            line = f'{chr}\t{pos}\t.\t{ref}\tA\tINFO={info}'
+            records.append((chr, pos, len(ref), line))
+            out.write(line + '\n')
+    out.close()
+    fh = open(tabix.buildIndex(path), 'rb')
+    index = tabix.readIndex(fh.read())
+    fh.close()
+    return (path, index, records)
+
+
+def test_region_chunks(indexed):
+    (path, index, records) = indexed
+    assert sorted(index) == ['chr1', 'chr2', 'chrX']
+    assert tabix.regionChunks(index, 'chr3', 1, 1000) == []
+    chunks = tabix.regionChunks(index, 'chr2', 1, 1 << 29)
+    # Merged, in file order, and not overlapping
+    assert len(chunks) > 0
+    for (vbeg, vend) in chunks:
+        assert vbeg < vend
+    for k in range(1, len(chunks)):
+        assert chunks[k - 1][1] < chunks[k][0]
+
+
+def test_fetch_region(indexed):
+    (path, index, records) = indexed
+    rng = random.Random(7)
+    regions = [('chr1', 1, 1), ('chr2', 1, 1 << 29), ('chrX', 500000, 500100)]
+    for i in range(0, 200):
+        chr = rng.choice(['chr1', 'chr2', 'chrX'])
+        beg = rng.randrange(1, 700000)
+        length = rng.randrange(0, 1 << rng.randrange(1, 17))
+        regions.append((chr, beg, beg + length))
+    for (chr, beg, end) in regions:
+        expected = [line for (name, pos, length, line) in records
+            if (name == chr and pos <= end and pos + length - 1 >= beg)]
+        assert list(tabix.fetchRegion(tabix.fileRange(path), index, chr,
+            beg, end)) == expected
+
+### EOF
@@ -13,39 +13,224 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
+import threading
+from contextlib import contextmanager
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
+import lookup_cache as lc
+
+"""How long RDS credentials are reused before asking Secrets Manager again
+"""
+SECRET_TTL = int(os.environ.get('ANNTOOLS_SECRET_TTL', 900))
+
+"""Idle connections kept open per process for reuse
+"""
+DB_POOL_SIZE = int(os.environ.get('ANNTOOLS_DB_POOL_SIZE', 16))
+
+secret_cache = {}
+secret_lock = threading.Lock()
+
+
+"""Get the RDS secret from AWS Secrets Manager, cached per process
+"""
+def get_rds_secret(secret_id='rds/anntools_database', refresh=False):
+    with secret_lock:
+        cached = secret_cache.get(secret_id)
+        if (cached is not None and not refresh and 
+            (time.time() - cached[0]) < SECRET_TTL):
+            return cached[1]
+
+        AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+            ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+
+        asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+        try:
+            asm_response = asm.get_secret_value(SecretId=secret_id)
+            rds_secret = json.loads(asm_response['SecretString'])
+        except ClientError as e:
+            print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+            raise e
+
+        secret_cache[secret_id] = (time.time(), rds_secret)
+        return rds_secret
+
+
+"""Function returning reference database connections in place of RDS,
+   e.g. a local stand-in (see reference_standin.py); None = RDS
+"""
+connection_factory = None
+
+
+def set_connection_factory(factory):
+    global connection_factory
+    connection_factory = factory
+    pool.clear()
+
+
 """Get connection to reference database
 """
 def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+    if connection_factory is not None:
+        return connection_factory()
+    for refresh in [False, True]:
+        rds_secret = get_rds_secret(refresh=refresh)
+        try:
+            # Return a connection to the database
+            return pymysql.connect(
+                host=rds_secret['host'],
+                port=rds_secret['port'],
+                user=rds_secret['username'],
+                passwd=rds_secret['password'],
+                db='annotator')
+        except pymysql.err.OperationalError as e:
+            # Access denied: the cached secret may have been rotated
+            if (refresh or e.args[0] != 1045):
+                raise e
+
+
+"""A small per-process pool of reference database connections. Idle
+   connections are pinged (and reconnected if needed) before reuse;
+   connections inherited from a parent process are never reused
+"""
+class ConnectionPool(object):
+    def __init__(self, size=DB_POOL_SIZE):
+        self.size = size
+        self.idle = []
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if (self.pid != os.getpid()):
+                self.idle = []
+                self.pid = os.getpid()
+            while (len(self.idle) > 0):
+                conn = self.idle.pop()
+                try:
+                    conn.ping(reconnect=True)
+                    return conn
+                except Exception:
+                    self.discard(conn)
+        return db_connect()
+
+    def release(self, conn):
+        with self.lock:
+            if (self.pid == os.getpid() and len(self.idle) < self.size):
+                self.idle.append(conn)
+                return
+        self.discard(conn)
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def clear(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            self.discard(conn)
+
+
+pool = ConnectionPool()
+
+"""Statements sent to the reference database and rows fetched from it by
+   this process, updated under stats_lock by the threads of the process
+"""
+db_stats = {'queries': 0, 'rows': 0}
+stats_lock = threading.Lock()
+
+
+def count_db_stats(queries=0, rows=0):
+    with stats_lock:
+        db_stats['queries'] = db_stats['queries'] + queries
+        db_stats['rows'] = db_stats['rows'] + rows
+
+
+"""Cursor that adds its statements and fetched rows to db_stats
+"""
+class CountingCursor(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, *args):
+        count_db_stats(queries=1)
+        return self.cursor.execute(*args)
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            count_db_stats(rows=1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        count_db_stats(rows=len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        count_db_stats(rows=len(rows))
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class CountingConnection(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self, *args):
+        return CountingCursor(self.conn.cursor(*args))
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+"""Persistent lookup cache used by db_connection(cached=True), if any
+"""
+lookup_cache = None
+
+
+def set_lookup_cache(cache):
+    global lookup_cache
+    if (lookup_cache is not None and lookup_cache is not cache):
+        lookup_cache.close()
+    lookup_cache = cache
+
+
+"""Borrow a pooled connection to the reference database:
+   with db_connection() as conn:
+       cursor = conn.cursor()
+   The connection goes back to the pool afterwards, or is closed if the
+   block raised. With cached=True and a lookup cache set, the cursors
+   answer statements seen before (in this or an earlier job) from the
+   cache, and a connection is only borrowed for the first one it cannot
+"""
+@contextmanager
+def db_connection(cached=False):
+    borrowed = []
+
+    def connect():
+        borrowed.append(pool.acquire())
+        return CountingConnection(borrowed[0])
 
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
     try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
-
-    # Extract database connection parameters
-    rds_host = rds_secret['host']
-    mysql_port = rds_secret['port']
-    username = rds_secret['username']
-    password = rds_secret['password']
-    database_name = 'annotator'
-
-    # Return a connection to the database
-    return pymysql.connect(
-        host=rds_host,
-        port=mysql_port,
-        user=username,
-        passwd=password,
-        db=database_name)
+        if (cached and lookup_cache is not None):
+            yield lc.CachingConnection(connect, lookup_cache)
+        else:
+            yield connect()
+    except BaseException:
+        for conn in borrowed:
+            pool.discard(conn)
+        raise
+    for conn in borrowed:
+        pool.release(conn)
 
 
 """Column inices for pileup and VCF
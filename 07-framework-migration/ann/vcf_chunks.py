@@ -0,0 +1,218 @@
+# vcf_chunks.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Chunked, column-wise VCF reading and writing for AnnTools
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import numpy as np
+
+import bgzf
+
+"""Data lines per chunk
+"""
+CHUNK_SIZE = 10000
+
+"""Columns located in every record: CHROM POS ID REF ALT QUAL FILTER INFO
+"""
+CHROM, POS, ID, REF, ALT, QUAL, FILTER, INFO = range(0, 8)
+COLUMNS = 8
+
+
+"""Parses the decimal numbers buffer[starts:ends] of every record at once
+"""
+def parseInts(data, starts, ends):
+    lens = ends - starts
+    if (len(lens) == 0):
+        return np.zeros(0, dtype=np.int64)
+    if (lens.min() <= 0):
+        raise ValueError(f"Empty position in VCF record {int(np.argmin(lens)) + 1}")
+    cols = np.arange(int(lens.max()))
+    mask = cols < lens[:, None]
+    idx = np.minimum(starts[:, None] + cols, len(data) - 1)
+    digits = data[idx].astype(np.int64) - 48
+    bad = mask & ((digits < 0) | (digits > 9))
+    if bad.any():
+        raise ValueError("Non-numeric position in VCF record " +
+            f"{int(np.flatnonzero(bad.any(axis=1))[0]) + 1}")
+    powers = np.where(mask, lens[:, None] - 1 - cols, 0)
+    return np.where(mask, digits * (10 ** powers), 0).sum(axis=1)
+
+
+"""Moves starts and ends inward past blanks, like str.strip() on every
+   field (the stages write fields separated by a tab and a space)
+"""
+def trimFields(data, starts, ends):
+    while True:
+        blank = (starts < ends) & (data[np.minimum(starts, len(data) - 1)] == 32)
+        if not blank.any():
+            break
+        starts[blank] = starts[blank] + 1
+    while True:
+        blank = (starts < ends) & (data[np.maximum(ends - 1, 0)] == 32)
+        if not blank.any():
+            break
+        ends[blank] = ends[blank] - 1
+
+
+"""A chunk of VCF data lines parsed column-wise. The text stays in one
+   buffer; records are described by arrays:
+     lineStarts, lineEnds   - each record's bytes (without the newline)
+     fieldStarts, fieldEnds - (records x 8) offsets of the first 8 columns,
+                              without surrounding blanks (empty at the line
+                              end if a column is missing)
+     chrom                  - code of each record's CHROM in chroms
+     pos                    - POS as int64
+"""
+class VcfChunk(object):
+    def __init__(self, buffer):
+        if not buffer.endswith(b'\n'):
+            buffer = buffer + b'\n'
+        self.buffer = buffer
+        data = np.frombuffer(buffer, dtype=np.uint8)
+
+        newlines = np.flatnonzero(data == 10)
+        self.lineStarts = np.concatenate(([0], newlines[:-1] + 1))
+        self.lineEnds = newlines - (data[np.maximum(newlines - 1, 0)] == 13)
+
+        tabs = np.flatnonzero(data == 9)
+        first = np.searchsorted(tabs, self.lineStarts)
+        ntabs = np.searchsorted(tabs, self.lineEnds) - first
+        if (len(ntabs) > 0 and ntabs.min() < 1):
+            raise ValueError("Missing POS column in VCF record " +
+                f"{int(np.argmin(ntabs)) + 1}")
+
+        n = len(self.lineStarts)
+        last = max(len(tabs) - 1, 0)
+        self.fieldStarts = np.empty((n, COLUMNS), dtype=np.int64)
+        self.fieldEnds = np.empty((n, COLUMNS), dtype=np.int64)
+        for k in range(0, COLUMNS):
+            if (k == 0):
+                self.fieldStarts[:, k] = self.lineStarts
+            else:
+                self.fieldStarts[:, k] = np.where(ntabs >= k,
+                    tabs[np.minimum(first + k - 1, last)] + 1, self.lineEnds)
+            self.fieldEnds[:, k] = np.where(ntabs > k,
+                tabs[np.minimum(first + k, last)], self.lineEnds)
+        trimFields(data, self.fieldStarts, self.fieldEnds)
+
+        # Chromosome names as fixed-width byte strings, coded by np.unique
+        starts = self.fieldStarts[:, CHROM]
+        lens = self.fieldEnds[:, CHROM] - starts
+        width = max(int(lens.max()) if (n > 0) else 0, 1)
+        cols = np.arange(width)
+        names = np.where(cols < lens[:, None],
+            data[np.minimum(starts[:, None] + cols, len(data) - 1)], 0)
+        names = np.ascontiguousarray(names.astype(np.uint8))\
+            .view('S' + str(width)).ravel()
+        chroms, codes = np.unique(names, return_inverse=True)
+        self.chroms = [c.decode('utf-8') for c in chroms]
+        self.chrom = codes.astype(np.int32)
+
+        self.pos = parseInts(data, self.fieldStarts[:, POS],
+            self.fieldEnds[:, POS])
+
+    def __len__(self):
+        return len(self.lineStarts)
+
+    def field(self, i, k):
+        return self.buffer[self.fieldStarts[i, k]:self.fieldEnds[i, k]]
+
+    def ref(self, i):
+        return self.field(i, REF)
+
+    def alt(self, i):
+        return self.field(i, ALT)
+
+    def info(self, i):
+        return self.field(i, INFO)
+
+    def line(self, i):
+        return self.buffer[self.lineStarts[i]:self.lineEnds[i]]
+
+    """CHROM of every record as a string array
+    """
+    def chromNames(self):
+        return np.array(self.chroms, dtype=object)[self.chrom] \
+            if (len(self) > 0) else np.zeros(0, dtype=object)
+
+
+"""Chunk of the data lines (str or bytes) among lines; headers are skipped
+"""
+def fromLines(lines):
+    data = []
+    for line in lines:
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        if not line.startswith(b'#'):
+            data.append(line if line.endswith(b'\n') else line + b'\n')
+    return VcfChunk(b''.join(data))
+
+
+"""Reads a VCF file, plain or gzip-compressed, as its header lines
+   followed by chunks of up to size data lines:
+   reader = VcfReader(path)
+   for chunk in reader: ...
+"""
+class VcfReader(object):
+    def __init__(self, path, size=CHUNK_SIZE):
+        self.fh = bgzf.openBinary(path)
+        self.size = size
+        self.headers = []
+        self.pending = None
+        for line in self.fh:
+            if line.startswith(b'#'):
+                self.headers.append(line.rstrip(b'\r\n').decode('utf-8'))
+            else:
+                self.pending = line
+                break
+
+    def __iter__(self):
+        lines = [] if (self.pending is None) else [self.pending]
+        self.pending = None
+        for line in self.fh:
+            lines.append(line)
+            if (len(lines) >= self.size):
+                yield VcfChunk(b''.join(lines))
+                lines = []
+        if (len(lines) > 0):
+            yield VcfChunk(b''.join(lines))
+
+    def close(self):
+        self.fh.close()
+
+
+"""Writes header lines and then chunks, optionally replacing the INFO
+   column of every record; BGZF-compressed if path ends in .gz
+"""
+class VcfWriter(object):
+    def __init__(self, path, headers=[]):
+        self.fh = bgzf.BgzfWriter(path) if path.endswith('.gz') \
+            else open(path, 'wb')
+        for line in headers:
+            self.fh.write(line.encode('utf-8') + b'\n')
+
+    def write(self, chunk, infos=None):
+        if infos is None:
+            for i in range(0, len(chunk)):
+                self.fh.write(chunk.line(i) + b'\n')
+            return
+        buffer = chunk.buffer
+        parts = []
+        for i in range(0, len(chunk)):
+            info = infos[i]
+            if isinstance(info, str):
+                info = info.encode('utf-8')
+            parts.append(buffer[chunk.lineStarts[i]:chunk.fieldStarts[i, INFO]])
+            parts.append(info)
+            parts.append(buffer[chunk.fieldEnds[i, INFO]:chunk.lineEnds[i]])
+            parts.append(b'\n')
+        self.fh.write(b''.join(parts))
+
+    def close(self):
+        self.fh.close()
+
+### EOF
@@ -0,0 +1,168 @@
+# worker_pool.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Pre-forked pool of warm annotation workers
+#
+# A job run as 'python run.py ...' starts a new interpreter that imports
+# boto3, pymysql and AnnTools, reads the configuration and connects to AWS
+# and the reference database before it annotates a single line. The
+# workers of this pool are forked once, with those modules imported, open
+# their clients and a database connection up front and then run job after
+# job in-process, each handed to them over a pipe.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import atexit
+import traceback
+import multiprocessing
+
+"""Jobs a worker runs before it is replaced by a fresh one (0 = never), so
+   that memory a job leaves behind is given back
+"""
+MAX_JOBS = 50
+
+
+"""Body of a worker process: calls warm, then runs target on the
+   arguments of each job read from conn and sends back the job id and a
+   return code (0, the code of sys.exit, or 1 if the job raised), until
+   conn is closed
+"""
+def work(conn, target, warm):
+    if warm is not None:
+        try:
+            warm()
+        except Exception:
+            traceback.print_exc()
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        (job_id, args) = task
+        try:
+            target(*args)
+            returncode = 0
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            returncode = 1
+        sys.stdout.flush()
+        try:
+            conn.send((job_id, returncode))
+        except OSError:
+            break
+    conn.close()
+
+
+class Worker(object):
+    def __init__(self, context, target, warm):
+        (self.conn, child) = context.Pipe()
+        self.process = context.Process(target=work,
+            args=(child, target, warm))
+        self.process.start()
+        child.close()
+        self.jobs = 0
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.conn.close()
+
+
+"""A job running on a worker, polled like a child process
+"""
+class WorkerTask(object):
+    def __init__(self, pool, worker, job_id):
+        self.pool = pool
+        self.worker = worker
+        self.job_id = job_id
+        self.pid = worker.process.pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            self.returncode = self.pool.collect(self.worker)
+        return self.returncode
+
+
+"""'size' worker processes forked up front that run target(*job.args) for
+   the jobs launched on them; warm is called once in each worker before
+   its first job. Launches jobs for job_scheduler.JobScheduler. The
+   workers are stopped when the process exits
+"""
+class WorkerPool(object):
+    def __init__(self, size, target, warm=None, max_jobs=MAX_JOBS):
+        self.context = multiprocessing.get_context('fork')
+        self.target = target
+        self.warm = warm
+        self.max_jobs = max_jobs
+        self.idle = [self.spawn() for i in range(0, size)]
+        self.busy = []
+        atexit.register(self.close)
+
+    def spawn(self):
+        return Worker(self.context, self.target, self.warm)
+
+    """Hands job to an idle worker (a new one if all are busy or the idle
+       one died) and returns its task
+    """
+    def launch(self, job):
+        worker = self.idle.pop() if (len(self.idle) > 0) else self.spawn()
+        try:
+            worker.conn.send((job.job_id, job.args))
+        except (OSError, ValueError):
+            worker.stop()
+            worker = self.spawn()
+            worker.conn.send((job.job_id, job.args))
+        worker.jobs = worker.jobs + 1
+        self.busy.append(worker)
+        return WorkerTask(self, worker, job.job_id)
+
+    """Return code of the job on worker, or None while it runs. The worker
+       is idle again afterwards; one that died during the job, or has run
+       max_jobs, is replaced
+    """
+    def collect(self, worker):
+        if worker not in self.busy:
+            return 1
+        try:
+            if not worker.conn.poll():
+                if worker.process.is_alive():
+                    return None
+                raise EOFError
+            (job_id, returncode) = worker.conn.recv()
+            self.busy.remove(worker)
+        except (EOFError, OSError):
+            self.busy.remove(worker)
+            worker.conn.close()
+            worker.process.join()
+            self.idle.append(self.spawn())
+            return worker.process.exitcode or 1
+        if (self.max_jobs > 0 and worker.jobs >= self.max_jobs):
+            worker.stop()
+            self.idle.append(self.spawn())
+        else:
+            self.idle.append(worker)
+        return returncode
+
+    """Stops the workers, waiting for the busy ones to finish their job
+    """
+    def close(self):
+        workers = self.idle + self.busy
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.process.join()
+        self.idle = []
+        self.busy = []
+
+### EOF